@@ -3,37 +3,84 @@
 # Copyright 2023 Canonical, Ltd.
 #
 
+import hashlib
 import json
 import logging
 import socket
 import subprocess
 import time
-from typing import Any, Union
+from pathlib import Path
+from typing import Any, List, Optional, Tuple, Union
 
 from charms.grafana_agent.v0.cos_agent import COSAgentProvider
 from ops import CharmBase, main
 from ops.charm import (
+    ActionEvent,
     ConfigChangedEvent,
     InstallEvent,
     LeaderElectedEvent,
     RelationBrokenEvent,
     RelationChangedEvent,
     RelationDepartedEvent,
+    RelationEvent,
     RelationJoinedEvent,
     RemoveEvent,
     UpdateStatusEvent,
     UpgradeCharmEvent,
 )
-from ops.framework import StoredState
-from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
+from ops.framework import CommitEvent, PreCommitEvent, StoredState
+from ops.model import (
+    ActiveStatus,
+    BlockedStatus,
+    MaintenanceStatus,
+    ModelError,
+    Relation,
+    Unit,
+    WaitingStatus,
+)
 
 import containerd
+import images
+import k8s_api
 import metrics
 import microk8s
 import util
 
 LOG = logging.getLogger(__name__)
 
+# config options that each configuration handler depends on. a handler only runs when one of
+# its options has changed since it was last applied. See MicroK8sCharm._config_changed
+CONFIG_HANDLERS = {
+    "containerd_proxy": ["containerd_http_proxy", "containerd_https_proxy", "containerd_no_proxy"],
+    "containerd_registries": ["containerd_custom_registries"],
+    "containerd_performance": [
+        "containerd_max_concurrent_downloads",
+        "containerd_snapshotter",
+        "containerd_discard_unpacked_layers",
+        "containerd_max_container_log_line_size",
+    ],
+    "addons": ["addons", "hostpath_storage"],
+    "certificate_reissue": ["automatic_certificate_reissue"],
+    "extra_sans": ["extra_sans"],
+    "rbac": ["rbac"],
+    "kubelet_args": ["kubelet_args"],
+    "prepull_images": ["prepull_images", "containerd_custom_registries"],
+}
+
+# maximum age (in seconds) of node status digests that do not include their own max_age, e.g.
+# published by an older charm revision. see the node_status_max_age config option
+NODE_STATUS_MAX_AGE = 600
+
+# join tokens are valid for JOIN_TOKEN_TTL seconds and are shared by all joining nodes. the
+# leader rotates the token once less than JOIN_TOKEN_MIN_TTL seconds of validity remain, so
+# that nodes never receive a token that is about to expire
+JOIN_TOKEN_TTL = 7200
+JOIN_TOKEN_MIN_TTL = 3600
+
+# seconds that an admitted worker counts against the join concurrency limit. workers that do
+# not join within the window no longer hold their slot
+JOIN_SLOT_WINDOW = 300
+
 
 class MicroK8sCharm(CharmBase):
     _state = StoredState()
@@ -46,6 +93,22 @@ class MicroK8sCharm(CharmBase):
     def _set_peer_data(self, key: str, new_data: Any):
         self.model.get_relation("peer").data[self.app][key] = json.dumps(new_data)
 
+    def _config_fingerprint(self, handler: str) -> dict:
+        """return fingerprints of the current values of the config options used by handler"""
+        return {
+            key: hashlib.sha256(json.dumps(self.config.get(key)).encode()).hexdigest()
+            for key in CONFIG_HANDLERS[handler]
+        }
+
+    def _config_changed(self, handler: str) -> bool:
+        """return True if any config option used by handler changed since it was last applied"""
+        applied = self._state.applied_config.get(handler)
+        return applied is None or dict(applied) != self._config_fingerprint(handler)
+
+    def _config_applied(self, handler: str):
+        """record that handler applied the current values of its config options"""
+        self._state.applied_config[handler] = self._config_fingerprint(handler)
+
     def __init__(self, *args):
         super().__init__(*args)
 
@@ -58,13 +121,26 @@ class MicroK8sCharm(CharmBase):
             installed=False,
             joined=False,
             hostnames={},
+            applied_config={},
+            kubernetes_version={},
+            kubeconfig_fingerprint=None,
+            launch_configuration={},
+            snap_file_digest=None,
+            node_ready_wait={},
         )
 
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
+        self.framework.observe(self.framework.on.commit, self._on_commit)
+
         if self.config["role"] == "worker":
             # lifecycle
             self.framework.observe(self.on.remove, self.on_remove)
             self.framework.observe(self.on.upgrade_charm, self.on_upgrade)
+            self.framework.observe(self.on.upgrade_charm, self.run_upgrade)
+            self.framework.observe(self.on.upgrade_charm, self.announce_joined)
             self.framework.observe(self.on.install, self.on_install)
+            self.framework.observe(self.on.update_status, self.announce_joined)
+            self.framework.observe(self.on.update_status, self.run_upgrade)
             self.framework.observe(self.on.update_status, self.update_status)
 
             # configuration
@@ -72,12 +148,18 @@ class MicroK8sCharm(CharmBase):
             self.framework.observe(self.on.config_changed, self.on_install)
             self.framework.observe(self.on.config_changed, self.config_containerd_proxy)
             self.framework.observe(self.on.config_changed, self.config_containerd_registries)
+            self.framework.observe(self.on.config_changed, self.config_containerd_performance)
+            self.framework.observe(self.on.config_changed, self.config_kubelet_args)
+            self.framework.observe(self.on.config_changed, self.config_prepull_images)
             self.framework.observe(self.on.config_changed, self.update_status)
+            self.framework.observe(self.on.reconcile_action, self.on_reconcile_action)
 
             # clustering
             self.framework.observe(self.on.control_plane_relation_joined, self.on_install)
             self.framework.observe(self.on.control_plane_relation_joined, self.announce_hostname)
             self.framework.observe(self.on.control_plane_relation_changed, self.join_cluster)
+            self.framework.observe(self.on.control_plane_relation_changed, self.announce_joined)
+            self.framework.observe(self.on.control_plane_relation_changed, self.run_upgrade)
             self.framework.observe(self.on.control_plane_relation_broken, self.leave_cluster)
             self.framework.observe(self.on.control_plane_relation_broken, self.update_status)
 
@@ -90,11 +172,19 @@ class MicroK8sCharm(CharmBase):
             # lifecycle
             self.framework.observe(self.on.remove, self.on_remove)
             self.framework.observe(self.on.upgrade_charm, self.on_upgrade)
+            self.framework.observe(self.on.upgrade_charm, self.schedule_upgrades)
+            self.framework.observe(self.on.upgrade_charm, self.run_upgrade)
             self.framework.observe(self.on.install, self.on_install)
             self.framework.observe(self.on.install, self.bootstrap_cluster)
             self.framework.observe(self.on.install, self.open_ports)
             self.framework.observe(self.on.leader_elected, self.remove_departed_nodes)
             self.framework.observe(self.on.leader_elected, self.update_status)
+            self.framework.observe(self.on.leader_elected, self.rotate_join_token)
+            self.framework.observe(self.on.update_status, self.rotate_join_token)
+            self.framework.observe(self.on.update_status, self.schedule_joins)
+            self.framework.observe(self.on.update_status, self.schedule_upgrades)
+            self.framework.observe(self.on.update_status, self.run_upgrade)
+            self.framework.observe(self.on.update_status, self.publish_node_status)
             self.framework.observe(self.on.update_status, self.update_status)
             self.framework.observe(self.on.update_status, self.update_metrics_tls_auth)
 
@@ -103,11 +193,16 @@ class MicroK8sCharm(CharmBase):
             self.framework.observe(self.on.config_changed, self.on_install)
             self.framework.observe(self.on.config_changed, self.config_containerd_proxy)
             self.framework.observe(self.on.config_changed, self.config_containerd_registries)
-            self.framework.observe(self.on.config_changed, self.config_hostpath_storage)
+            self.framework.observe(self.on.config_changed, self.config_containerd_performance)
+            self.framework.observe(self.on.config_changed, self.config_addons)
             self.framework.observe(self.on.config_changed, self.config_certificate_reissue)
             self.framework.observe(self.on.config_changed, self.config_extra_sans)
             self.framework.observe(self.on.config_changed, self.config_rbac)
+            self.framework.observe(self.on.config_changed, self.config_kubelet_args)
+            self.framework.observe(self.on.config_changed, self.config_prepull_images)
+            self.framework.observe(self.on.config_changed, self.schedule_joins)
             self.framework.observe(self.on.config_changed, self.update_status)
+            self.framework.observe(self.on.reconcile_action, self.on_reconcile_action)
 
             # clustering
             self.framework.observe(self.on.peer_relation_joined, self.add_node)
@@ -116,14 +211,22 @@ class MicroK8sCharm(CharmBase):
             self.framework.observe(self.on.peer_relation_joined, self.join_cluster)
             self.framework.observe(self.on.peer_relation_changed, self.record_hostnames)
             self.framework.observe(self.on.peer_relation_changed, self.join_cluster)
+            self.framework.observe(self.on.peer_relation_changed, self.schedule_upgrades)
+            self.framework.observe(self.on.peer_relation_changed, self.run_upgrade)
             self.framework.observe(self.on.peer_relation_departed, self.on_relation_departed)
             self.framework.observe(self.on.peer_relation_departed, self.remove_departed_nodes)
+            self.framework.observe(self.on.peer_relation_departed, self.schedule_upgrades)
             self.framework.observe(self.on.peer_relation_departed, self.update_status)
             self.framework.observe(self.on.workers_relation_joined, self.add_node)
+            self.framework.observe(self.on.workers_relation_joined, self.schedule_joins)
             self.framework.observe(self.on.workers_relation_joined, self.update_metrics_tls_auth)
             self.framework.observe(self.on.workers_relation_changed, self.record_hostnames)
+            self.framework.observe(self.on.workers_relation_changed, self.schedule_joins)
+            self.framework.observe(self.on.workers_relation_changed, self.schedule_upgrades)
             self.framework.observe(self.on.workers_relation_departed, self.on_relation_departed)
             self.framework.observe(self.on.workers_relation_departed, self.remove_departed_nodes)
+            self.framework.observe(self.on.workers_relation_departed, self.schedule_joins)
+            self.framework.observe(self.on.workers_relation_departed, self.schedule_upgrades)
             self.framework.observe(self.on.workers_relation_departed, self.update_status)
 
             # observability
@@ -150,6 +253,17 @@ class MicroK8sCharm(CharmBase):
             self.framework.observe(self.on.kubernetes_info_relation_joined, self._k8s_info)
             self.framework.observe(self.on.kubernetes_info_relation_changed, self._k8s_info)
 
+    def _on_pre_commit(self, _: PreCommitEvent):
+        # apply launch configuration and restart services once, after all handlers of the hook
+        # have changed their configuration
+        self._state.launch_configuration = microk8s.apply_pending_launch_configuration(
+            self._state.launch_configuration
+        )
+        microk8s.restart_pending_services()
+
+    def _on_commit(self, _: CommitEvent):
+        util.log_retry_stats()
+
     def _k8s_info(self, event: RelationJoinedEvent):
         if not self.unit.is_leader():
             return
@@ -165,9 +279,210 @@ class MicroK8sCharm(CharmBase):
         except subprocess.CalledProcessError:
             LOG.exception("failed to remove microk8s")
 
+    def _resource(self, name: str) -> Optional[Path]:
+        """return the path to an attached file resource. empty resources are ignored"""
+        try:
+            path = self.model.resources.fetch(name)
+        except (ModelError, NameError):
+            return None
+
+        return path if path.stat().st_size > 0 else None
+
+    def _snap_resource(self) -> Tuple[Optional[Path], Optional[Path]]:
+        """return paths to the attached microk8s snap and assertion files, if any"""
+        snap_file = self._resource("microk8s-snap")
+        if not snap_file:
+            return None, None
+
+        return snap_file, self._resource("microk8s-assert")
+
+    def _upgrade_relation(self) -> Optional[Relation]:
+        """return the relation used to coordinate upgrades with the control plane leader"""
+        if self.config["role"] == "worker":
+            return self.model.get_relation("control-plane")
+        return self.model.get_relation("peer")
+
+    def _reset_configuration(self):
+        """forget the applied configuration, so that all of it is applied again. config handlers
+        run on the next config-changed, the DNS launch configuration is scheduled right away"""
+        self._state.applied_config = {}
+        self._state.launch_configuration = {}
+        self.config_dns(None)
+
+    def _record_snap_file(self, snap_file: Optional[Path]):
+        """remember the snap file the unit was installed from, see _snap_changed()"""
+        self._state.snap_file_digest = microk8s.snap_file_digest(snap_file) if snap_file else None
+
+    def _snap_changed(self) -> bool:
+        """return True if refreshing the snap would change it. only then nodes are drained"""
+        snap_file, _ = self._snap_resource()
+        if snap_file:
+            return microk8s.snap_file_digest(snap_file) != self._state.snap_file_digest
+        return microk8s.snap_channel_changed()
+
+    def _upgrade_unit(self):
+        snap_file, assert_file = self._snap_resource()
+        microk8s.upgrade(snap_file, assert_file)
+        self._record_snap_file(snap_file)
+
+        # the new charm revision re-applies all configuration on the next config-changed
+        self._reset_configuration()
+
     def on_upgrade(self, _: UpgradeCharmEvent):
-        # TODO(neoaggelos): Figure out an orchestrated upgrade strategy
-        microk8s.upgrade()
+        relation = self._upgrade_relation()
+        if not self._state.joined or relation is None or not self._snap_changed():
+            self._upgrade_unit()
+            return
+
+        # the leader upgrades nodes one by one, see schedule_upgrades
+        LOG.info("waiting for the leader to schedule the upgrade")
+        relation.data[self.unit]["upgrade"] = "pending"
+        self.unit.status = WaitingStatus("waiting for upgrade slot")
+
+    def run_upgrade(self, _: Union[RelationEvent, UpdateStatusEvent, UpgradeCharmEvent]):
+        relation = self._upgrade_relation()
+        if relation is None:
+            return
+
+        state = relation.data[self.unit].get("upgrade")
+        if state == "pending":
+            upgrade_admitted = relation.data[relation.app].get("upgrade_admitted")
+            # control planes that do not schedule upgrades let workers upgrade right away
+            if upgrade_admitted is None and relation.app != self.app:
+                upgrade_admitted = json.dumps({self.unit.name: time.time()})
+
+            if self.unit.name not in json.loads(upgrade_admitted or "{}"):
+                self.unit.status = WaitingStatus("waiting for upgrade slot")
+                return
+
+            self.unit.status = MaintenanceStatus("upgrading MicroK8s")
+            start = time.monotonic()
+            self._upgrade_unit()
+            LOG.info("upgraded MicroK8s in %.2f seconds", time.monotonic() - start)
+            relation.data[self.unit]["upgrade"] = state = "upgraded"
+
+            # the upgrade may run long after upgrade-charm, re-apply the configuration now
+            self.on.config_changed.emit()
+
+        if state != "upgraded":
+            return
+
+        # do not report the upgrade as done before the node is ready again
+        if not self._wait_node_ready(use_digest=False):
+            return
+
+        relation.data[self.unit]["upgrade"] = "done"
+        if self.unit.is_leader():
+            self.schedule_upgrades(None)
+
+    def _admit_upgrade(self, unit: Unit, single_node: bool) -> bool:
+        """drain the node of a unit before it is upgraded. nodes are drained in the background,
+        returns True once the node is drained and the unit may upgrade"""
+        hostname = self._state.hostnames.get(unit.name)
+        if unit == self.unit:
+            hostname = socket.gethostname()
+
+        if hostname and not single_node:
+            status = microk8s.get_drain_node_status(hostname)
+            if status == "running":
+                LOG.info("waiting for node %s to be drained", hostname)
+                return False
+            if status != "done":
+                if status == "failed":
+                    LOG.warning("failed to drain node %s, will retry", hostname)
+                microk8s.start_drain_node(hostname)
+                return False
+
+            microk8s.clear_drain_node(hostname)
+
+        LOG.info("admit %s to upgrade", unit.name)
+        return True
+
+    def _finish_upgrade(self, unit: Unit, started: float) -> bool:
+        """uncordon the node of a unit after it is upgraded. returns False if it failed"""
+        hostname = self._state.hostnames.get(unit.name)
+        if unit == self.unit:
+            hostname = socket.gethostname()
+
+        if hostname:
+            try:
+                microk8s.uncordon_node(hostname)
+            except subprocess.CalledProcessError:
+                LOG.exception("failed to uncordon node %s, will retry", hostname)
+                return False
+
+        LOG.info("%s upgraded in %.2f seconds", unit.name, time.time() - started)
+        return True
+
+    def schedule_upgrades(self, _: Union[RelationEvent, UpdateStatusEvent, UpgradeCharmEvent]):
+        """upgrade control plane nodes one at a time, then workers in batches of
+        upgrade_batch_size nodes. nodes are drained before and uncordoned after the upgrade"""
+        if not self._state.joined or not self.unit.is_leader():
+            return
+
+        peer = self.model.get_relation("peer")
+        groups = [(peer, [self.unit, *peer.units])]
+        groups.extend(
+            (relation, list(relation.units)) for relation in self.model.relations["workers"]
+        )
+        single_node = sum(len(units) for _, units in groups) == 1
+
+        now = time.time()
+        admitted = {}
+        for relation, units in groups:
+            by_name = {unit.name: unit for unit in units}
+            current = json.loads(relation.data[self.app].get("upgrade_admitted") or "{}")
+            admitted[relation.id] = {}
+            for name, started in current.items():
+                # forget departed units, uncordon units that finished upgrading
+                unit = by_name.get(name)
+                if unit is None:
+                    continue
+                if relation.data[unit].get("upgrade") != "done" or not self._finish_upgrade(
+                    unit, started
+                ):
+                    admitted[relation.id][name] = started
+
+        def pending(relation: Relation, units: List[Unit]) -> List[Unit]:
+            return sorted(
+                (
+                    unit
+                    for unit in units
+                    if relation.data[unit].get("upgrade") == "pending"
+                    and unit.name not in admitted[relation.id]
+                ),
+                key=lambda unit: int(unit.name.split("/")[-1]),
+            )
+
+        # control plane nodes first, one at a time
+        control_plane_pending = pending(peer, groups[0][1])
+        if control_plane_pending or admitted[peer.id]:
+            if not admitted[peer.id]:
+                unit = control_plane_pending[0]
+                if self._admit_upgrade(unit, single_node):
+                    admitted[peer.id][unit.name] = now
+        else:
+            batch_size = max(1, self.config["upgrade_batch_size"])
+            in_flight = sum(len(admitted[relation.id]) for relation, _ in groups[1:])
+            for relation, units in groups[1:]:
+                for unit in pending(relation, units):
+                    if in_flight >= batch_size:
+                        break
+                    # nodes that are still draining take up a slot in the batch
+                    if self._admit_upgrade(unit, single_node):
+                        admitted[relation.id][unit.name] = now
+                    in_flight += 1
+
+        for relation, _ in groups:
+            upgrade_admitted = json.dumps(admitted[relation.id], sort_keys=True)
+            if relation.data[self.app].get("upgrade_admitted") != upgrade_admitted:
+                relation.data[self.app]["upgrade_admitted"] = upgrade_admitted
+
+    def on_reconcile_action(self, event: ActionEvent):
+        LOG.info("forcing reconcile of all configuration options")
+        self._reset_configuration()
+        self.on.config_changed.emit()
+        event.set_results({"status": self.unit.status.message})
 
     def on_install(self, _: InstallEvent):
         if self._state.installed:
@@ -177,11 +492,29 @@ class MicroK8sCharm(CharmBase):
         util.install_required_packages()
 
         self.unit.status = MaintenanceStatus("installing MicroK8s")
-        microk8s.install()
+        snap_file, assert_file = self._snap_resource()
+        microk8s.install(snap_file, assert_file)
+        self._record_snap_file(snap_file)
 
         self.unit.status = MaintenanceStatus("initial containerd configuration")
+        self._state.applied_config = {}
         self.config_containerd_proxy(None)
         self.config_containerd_registries(None)
+        self.config_containerd_performance(None)
+        # containerd must use the new configuration to pull images while the node comes up
+        microk8s.restart_pending_services()
+
+        image_bundle = self._resource("image-bundle")
+        if image_bundle:
+            if not isinstance(self.unit.status, BlockedStatus):
+                self.unit.status = MaintenanceStatus("importing container images")
+            start = time.monotonic()
+            try:
+                microk8s.import_images(image_bundle)
+                LOG.info("imported container images in %.2f seconds", time.monotonic() - start)
+            except subprocess.CalledProcessError:
+                LOG.exception("failed to import container images, they will be pulled instead")
+
         try:
             if not isinstance(self.unit.status, BlockedStatus):
                 microk8s.wait_ready()
@@ -195,6 +528,8 @@ class MicroK8sCharm(CharmBase):
         if self.config["role"] != self._state.role:
             msg = f"role cannot change from '{self._state.role}' after deployment"
             self.unit.status = BlockedStatus(msg)
+        elif self.config["join_concurrency"] < 0:
+            self.unit.status = BlockedStatus("join_concurrency must not be negative")
         else:
             self.unit.status = MaintenanceStatus("maintenance")
 
@@ -202,59 +537,211 @@ class MicroK8sCharm(CharmBase):
         if isinstance(self.unit.status, BlockedStatus):
             return
 
+        if not self._config_changed("containerd_proxy"):
+            return
+
         microk8s.set_containerd_proxy_options(
             self.config["containerd_http_proxy"],
             self.config["containerd_https_proxy"],
             self.config["containerd_no_proxy"],
         )
+        self._config_applied("containerd_proxy")
 
     def config_containerd_registries(self, _: ConfigChangedEvent):
         if isinstance(self.unit.status, BlockedStatus):
             return
 
+        if not self._config_changed("containerd_registries"):
+            return
+
         try:
             registries = containerd.parse_registries(self.config["containerd_custom_registries"])
-            if registries:
-                self.unit.status = MaintenanceStatus("configure containerd registries")
-                containerd.ensure_registry_configs(registries)
+            self.unit.status = MaintenanceStatus("configure containerd registries")
+            result = containerd.ensure_registry_configs(registries)
+            LOG.info("Containerd registry configuration applied (%s)", result)
+            self._config_applied("containerd_registries")
         except (ValueError, subprocess.CalledProcessError, OSError):
             LOG.exception("failed to configure containerd registries")
             self.unit.status = BlockedStatus(
                 "failed to apply containerd_custom_registries, check logs for details"
             )
 
+    def config_containerd_performance(self, _: ConfigChangedEvent):
+        if isinstance(self.unit.status, BlockedStatus):
+            return
+
+        if not self._config_changed("containerd_performance"):
+            return
+
+        try:
+            containerd.ensure_performance_config(
+                self.config["containerd_max_concurrent_downloads"],
+                self.config["containerd_snapshotter"],
+                self.config["containerd_discard_unpacked_layers"],
+                self.config["containerd_max_container_log_line_size"],
+            )
+            self._config_applied("containerd_performance")
+        except (ValueError, OSError):
+            LOG.exception("failed to configure containerd")
+            self.unit.status = BlockedStatus(
+                "failed to apply containerd configuration, check logs for details"
+            )
+
     def config_rbac(self, _: ConfigChangedEvent):
         if isinstance(self.unit.status, BlockedStatus):
             return
 
-        if self._state.joined:
+        if self._state.joined and self._config_changed("rbac"):
             self.unit.status = MaintenanceStatus("configuring RBAC")
             microk8s.wait_ready()
             microk8s.configure_rbac(self.config["rbac"])
+            self._config_applied("rbac")
 
-    def config_hostpath_storage(self, _: ConfigChangedEvent):
+    def config_kubelet_args(self, _: ConfigChangedEvent):
         if isinstance(self.unit.status, BlockedStatus):
             return
 
-        if self._state.joined and self.unit.is_leader():
-            microk8s.configure_hostpath_storage(self.config["hostpath_storage"])
+        if not self._state.joined or not self._config_changed("kubelet_args"):
+            return
+
+        try:
+            args = microk8s.parse_kubelet_args(self.config["kubelet_args"])
+        except ValueError:
+            LOG.exception("invalid kubelet_args")
+            self.unit.status = BlockedStatus("invalid kubelet_args, check logs for details")
+            return
+
+        microk8s.configure_kubelet_args(
+            args, list(self._state.launch_configuration.get("extraKubeletArgs", {}))
+        )
+        self._config_applied("kubelet_args")
+
+    def config_prepull_images(self, _: ConfigChangedEvent):
+        if isinstance(self.unit.status, BlockedStatus):
+            return
+
+        if not self._state.joined or not self._config_changed("prepull_images"):
+            return
+
+        image_list = images.parse_images(self.config["prepull_images"])
+        registries = []
+        if image_list:
+            try:
+                registries = containerd.parse_registries(
+                    self.config["containerd_custom_registries"]
+                )
+            except ValueError:
+                # reported by config_containerd_registries
+                pass
+
+        images.start_prepull(image_list, registries)
+        self._config_applied("prepull_images")
+
+    def config_addons(self, _: ConfigChangedEvent):
+        if isinstance(self.unit.status, BlockedStatus):
+            return
+
+        if not self._state.joined or not self.unit.is_leader():
+            return
+
+        if not self._config_changed("addons"):
+            return
+
+        try:
+            addons = microk8s.parse_addons(self.config["addons"])
+        except ValueError:
+            LOG.exception("failed to parse addons")
+            self.unit.status = BlockedStatus("invalid addons, check logs for details")
+            return
+
+        if self.config["hostpath_storage"]:
+            addons.setdefault("hostpath-storage", "hostpath-storage")
+
+        # disable addons that were enabled by the charm and are no longer desired
+        disable = [name for name in self._get_peer_data("managed_addons", []) if name not in addons]
+        if not self.config["hostpath_storage"] and "hostpath-storage" not in addons:
+            disable.append("hostpath-storage")
+
+        self.unit.status = MaintenanceStatus("configuring addons")
+        enabled = microk8s.configure_addons(list(addons.values()), sorted(set(disable)))
+
+        # only addons enabled by the charm are disabled when removed from the list, not those
+        # that were already enabled before the charm managed them
+        managed = set(self._get_peer_data("managed_addons", [])) | set(enabled)
+        self._set_peer_data("managed_addons", sorted(name for name in managed if name in addons))
+        self._config_applied("addons")
 
     def config_certificate_reissue(self, _: ConfigChangedEvent):
         if isinstance(self.unit.status, BlockedStatus):
             return
 
-        if self._state.joined and not self.config["automatic_certificate_reissue"]:
+        if not self._state.joined or not self._config_changed("certificate_reissue"):
+            return
+
+        if not self.config["automatic_certificate_reissue"]:
             self.unit.status = MaintenanceStatus("disabling automatic certificate reissue")
             microk8s.wait_ready()
             microk8s.disable_cert_reissue()
+        self._config_applied("certificate_reissue")
 
     def config_extra_sans(self, _: ConfigChangedEvent):
         if isinstance(self.unit.status, BlockedStatus):
             return
 
-        if self._state.joined:
+        if self._state.joined and self._config_changed("extra_sans"):
             self.unit.status = MaintenanceStatus("configuring extra SANs")
             microk8s.configure_extra_sans(self.config["extra_sans"])
+            self._config_applied("extra_sans")
+
+    def _published_node_ready(self) -> bool:
+        """return True if the node status digest published by the leader is recent and
+        reports that this node is ready"""
+        relation_name = "control-plane" if self._state.role == "worker" else "peer"
+        relation = self.model.get_relation(relation_name)
+        try:
+            digest = json.loads(relation.data[relation.app]["node_status"])
+            if time.time() - digest["timestamp"] > digest.get("max_age", NODE_STATUS_MAX_AGE):
+                LOG.debug("node status digest is stale")
+                return False
+
+            return digest["nodes"][socket.gethostname()]["ready"]
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return False
+
+    def _wait_node_ready(self, use_digest: bool = True) -> bool:
+        """wait until the node is Ready, with exponential backoff and a deadline of
+        `node_ready_timeout` seconds. the duration of the last wait is kept in node_ready_wait.
+        returns True if the node became ready in time"""
+        if use_digest and self._published_node_ready():
+            self.unit.status = ActiveStatus("node is ready")
+            return True
+
+        hostname = socket.gethostname()
+        timeout = self.config["node_ready_timeout"]
+        backoff = 2
+
+        start = time.monotonic()
+        self.unit.status = microk8s.get_unit_status(hostname)
+        while not isinstance(self.unit.status, ActiveStatus):
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                break
+
+            time.sleep(min(backoff, remaining))
+            backoff = min(backoff * 2, 30)
+            self.unit.status = microk8s.get_unit_status(hostname)
+
+        elapsed = time.monotonic() - start
+        ready = isinstance(self.unit.status, ActiveStatus)
+        self._state.node_ready_wait = {"seconds": round(elapsed, 2), "ready": ready}
+        if ready:
+            LOG.info("node %s ready after %.2f seconds", hostname, elapsed)
+            return True
+
+        LOG.warning("node %s not ready after %.2f seconds", hostname, elapsed)
+        if not isinstance(self.unit.status, WaitingStatus):
+            self.unit.status = WaitingStatus("waiting for node to become ready")
+        return False
 
     def update_status(self, _: Union[UpdateStatusEvent, ConfigChangedEvent]):
         if isinstance(self.unit.status, BlockedStatus):
@@ -264,17 +751,26 @@ class MicroK8sCharm(CharmBase):
             self.unit.status = WaitingStatus("waiting for control plane")
             return
 
-        self.unit.status = microk8s.get_unit_status(socket.gethostname())
-        while not isinstance(self.unit.status, ActiveStatus):
-            time.sleep(2)
-            self.unit.status = microk8s.get_unit_status(socket.gethostname())
+        if not self._wait_node_ready():
+            return
+
+        progress = images.get_prepull_progress()
+        if progress and not progress["done"]:
+            msg = f"pre-pulling images ({progress['pulled']}/{progress['total']})"
+            self.unit.status = ActiveStatus(msg)
 
-        k8s_version = microk8s.get_kubernetes_version()
-        if k8s_version:
-            self.unit.set_workload_version(k8s_version)
+        # the kubernetes version only changes with the snap revision
+        revision = microk8s.get_snap_revision()
+        if revision is None or self._state.kubernetes_version.get("revision") != revision:
+            k8s_version = microk8s.get_kubernetes_version()
+            if k8s_version:
+                self._state.kubernetes_version = {"revision": revision, "version": k8s_version}
+                self.unit.set_workload_version(k8s_version)
 
         if self._state.role != "worker":
-            microk8s.write_local_kubeconfig()
+            self._state.kubeconfig_fingerprint = microk8s.write_local_kubeconfig(
+                self._state.kubeconfig_fingerprint
+            )
 
     def config_dns(self, _: Union[RelationJoinedEvent, RelationChangedEvent]):
         if isinstance(self.unit.status, BlockedStatus):
@@ -320,21 +816,17 @@ class MicroK8sCharm(CharmBase):
         if self._state.joined and self.unit.is_leader():
             remove_nodes = self._get_peer_data("remove_nodes", [])
 
-            new_remove_nodes = []
-            for hostname in set(remove_nodes):
-                # skip self, someone else will remove us when they become leader
-                if hostname == socket.gethostname():
-                    new_remove_nodes.append(hostname)
-                    continue
+            # skip self, someone else will remove us when they become leader
+            hostname = socket.gethostname()
+            skipped = [hostname] if hostname in remove_nodes else []
+            departed = sorted(set(remove_nodes) - {hostname})
 
-                self.unit.status = MaintenanceStatus(f"removing node {hostname}")
-                try:
-                    microk8s.remove_node(hostname)
-                except subprocess.CalledProcessError:
-                    new_remove_nodes.append(hostname)
-                    LOG.exception("failed to remove departing node %s", hostname)
+            failed = []
+            if departed:
+                self.unit.status = MaintenanceStatus(f"removing {len(departed)} departed nodes")
+                failed = microk8s.remove_nodes(departed, self.config["node_removal_concurrency"])
 
-            self._set_peer_data("remove_nodes", new_remove_nodes)
+            self._set_peer_data("remove_nodes", skipped + failed)
 
     def open_ports(self, _: InstallEvent):
         self.unit.open_port("tcp", 16443)
@@ -358,13 +850,70 @@ class MicroK8sCharm(CharmBase):
             LOG.info("join URL not yet available")
             return
 
+        # the control plane admits a limited number of workers at a time
+        join_slots = event.relation.data[event.app].get("join_slots")
+        if join_slots and self.unit.name not in json.loads(join_slots).get("admitted", {}):
+            LOG.info("waiting for a join slot")
+            self.unit.status = WaitingStatus("waiting for join slot")
+            return
+
         self.unit.status = MaintenanceStatus("joining cluster")
         microk8s.join(join_url, self.config["role"] == "worker")
         microk8s.wait_ready()
 
+        event.relation.data[self.unit]["joined"] = "true"
         self._state.joined = True
+        self._reset_configuration()
         self.on.config_changed.emit()
 
+    def announce_joined(self, _: Union[RelationEvent, UpgradeCharmEvent, UpdateStatusEvent]):
+        """publish that the unit has joined, also for units that joined before the control plane
+        started scheduling joins, so that they do not hold join slots"""
+        relation = self.model.get_relation("control-plane")
+        if not self._state.joined or relation is None:
+            return
+
+        if relation.data[self.unit].get("joined") != "true":
+            relation.data[self.unit]["joined"] = "true"
+
+    def schedule_joins(self, _: Union[RelationEvent, UpdateStatusEvent]):
+        """admit up to join_concurrency workers to join the cluster at the same time"""
+        if not self.unit.is_leader():
+            return
+
+        limit = self.config["join_concurrency"]
+        if limit < 0:
+            LOG.warning("invalid join_concurrency %d, not admitting workers", limit)
+            return
+
+        now = time.time()
+        for relation in self.model.relations["workers"]:
+            join_slots = json.loads(relation.data[self.app].get("join_slots") or "{}")
+
+            pending = sorted(
+                (u.name for u in relation.units if relation.data[u].get("joined") != "true"),
+                key=lambda name: int(name.split("/")[-1]),
+            )
+
+            # forget units that have joined or departed
+            admitted = {
+                unit: timestamp
+                for unit, timestamp in join_slots.get("admitted", {}).items()
+                if unit in pending
+            }
+            in_flight = [unit for unit, ts in admitted.items() if now - ts < JOIN_SLOT_WINDOW]
+            for unit in pending:
+                if limit and len(in_flight) >= limit:
+                    break
+                if unit not in admitted:
+                    admitted[unit] = now
+                    in_flight.append(unit)
+
+            new_join_slots = {"limit": limit, "window": JOIN_SLOT_WINDOW, "admitted": admitted}
+            if new_join_slots != join_slots:
+                LOG.info("admitted %d of %d pending workers", len(in_flight), len(pending))
+                relation.data[self.app]["join_slots"] = json.dumps(new_join_slots)
+
     def leave_cluster(self, _: RelationBrokenEvent):
         if not self._state.joined:
             return
@@ -376,14 +925,45 @@ class MicroK8sCharm(CharmBase):
         self._state.installed = False
         self._state.joined = False
 
+    def _join_token(self) -> str:
+        """return the current join token, or create a new one if it expires soon. tokens are
+        only known to the node that created them, tokens of a previous leader are replaced"""
+        join_token = self._get_peer_data("join_token", {})
+        if (
+            join_token.get("unit") == self.unit.name
+            and join_token.get("expires", 0) - time.time() > JOIN_TOKEN_MIN_TTL
+        ):
+            return join_token["token"]
+
+        token = microk8s.add_node(JOIN_TOKEN_TTL)
+        self._set_peer_data(
+            "join_token",
+            {"token": token, "expires": time.time() + JOIN_TOKEN_TTL, "unit": self.unit.name},
+        )
+        return token
+
+    def _publish_join_url(self, relation: Relation, token: str):
+        relation.data[self.app]["join_url"] = "{}:25000/{}".format(
+            self.model.get_binding(relation).network.ingress_address, token
+        )
+
     def add_node(self, event: RelationJoinedEvent):
         if not self.unit.is_leader():
             return
 
-        token = microk8s.add_node()
-        event.relation.data[self.app]["join_url"] = "{}:25000/{}".format(
-            self.model.get_binding(event.relation).network.ingress_address, token
-        )
+        self._publish_join_url(event.relation, self._join_token())
+
+    def rotate_join_token(self, _: Union[LeaderElectedEvent, UpdateStatusEvent]):
+        if not self._state.joined or not self.unit.is_leader():
+            return
+
+        # only keep a token if nodes have joined before
+        if not self._get_peer_data("join_token", {}):
+            return
+
+        token = self._join_token()
+        for relation in self.model.relations["peer"] + self.model.relations["workers"]:
+            self._publish_join_url(relation, token)
 
     def apply_observability_resources(self, _: RelationJoinedEvent):
         if isinstance(self.unit.status, BlockedStatus):
@@ -392,13 +972,41 @@ class MicroK8sCharm(CharmBase):
         if self._state.joined and self.unit.is_leader():
             metrics.apply_required_resources()
 
+    def publish_node_status(self, _: UpdateStatusEvent):
+        if not self._state.joined or not self.unit.is_leader():
+            return
+
+        relations = self.model.relations["peer"] + self.model.relations["workers"]
+        max_age = self.config["node_status_max_age"]
+        if max_age <= 0:
+            for relation in relations:
+                relation.data[self.app].pop("node_status", None)
+            return
+
+        try:
+            nodes = microk8s.get_node_statuses()
+        except (k8s_api.ApiError, OSError, ValueError):
+            LOG.exception("failed to retrieve status of cluster nodes")
+            return
+
+        # every publish fires relation-changed on all units. publish when the status of a node
+        # changes, an unchanged digest is only refreshed before units consider it stale
+        digest = self._get_peer_data("node_status", {})
+        age = time.time() - digest.get("timestamp", 0)
+        if digest.get("nodes") == nodes and digest.get("max_age") == max_age and age < max_age / 2:
+            return
+
+        digest = json.dumps({"timestamp": time.time(), "max_age": max_age, "nodes": nodes})
+        for relation in relations:
+            relation.data[self.app]["node_status"] = digest
+
     def update_metrics_tls_auth(self, _: Any):
         if not self.unit.is_leader() or not self.model.relations["cos-agent"]:
             return
 
         try:
             crt, key = metrics.get_tls_auth()
-        except subprocess.CalledProcessError:
+        except (subprocess.CalledProcessError, k8s_api.ApiError, OSError, ValueError):
             LOG.exception("failed to retrieve tls_auth for observability")
             return
 
@@ -5,9 +5,10 @@ import base64
 import json
 import logging
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import pydantic
+import tomli
 import tomli_w
 from urllib3.util import parse_url
 
@@ -17,6 +18,58 @@ import util
 LOG = logging.getLogger(__name__)
 
 
+def _host_config(
+    capabilities: List[str],
+    ca_file: Optional[Path] = None,
+    cert_file: Optional[Path] = None,
+    key_file: Optional[Path] = None,
+    skip_verify: Optional[bool] = None,
+    override_path: Optional[bool] = None,
+) -> dict:
+    """return the hosts.toml configuration of a single registry host"""
+    host_config = {"capabilities": capabilities}
+    if ca_file:
+        host_config["ca"] = ca_file.as_posix()
+    if cert_file and key_file:
+        host_config["client"] = [[cert_file.as_posix(), key_file.as_posix()]]
+    elif cert_file:
+        host_config["client"] = cert_file.as_posix()
+
+    if skip_verify:
+        host_config["skip_verify"] = True
+    if override_path:
+        host_config["override_path"] = True
+
+    return host_config
+
+
+class Mirror(pydantic.BaseModel, extra=pydantic.Extra.forbid):
+    # e.g. "http://10.0.0.10:5000"
+    url: pydantic.AnyHttpUrl
+
+    # operations allowed on the mirror, any of "pull", "resolve" and "push"
+    capabilities: List[str] = ["pull", "resolve"]
+
+    # TLS configuration
+    ca_file: Optional[str] = None
+    cert_file: Optional[str] = None
+    key_file: Optional[str] = None
+    skip_verify: Optional[bool] = None
+
+    # misc configuration
+    override_path: Optional[bool] = None
+
+    @pydantic.validator("capabilities")
+    def validate_capabilities(cls, v):
+        if not v or not set(v).issubset({"pull", "resolve", "push"}):
+            raise ValueError("capabilities must be a list of 'pull', 'resolve' and 'push'")
+        return v
+
+    @pydantic.validator("ca_file", "cert_file", "key_file")
+    def parse_base64_file(cls, v):
+        return base64.b64decode(v.encode()).decode()
+
+
 class Registry(pydantic.BaseModel, extra=pydantic.Extra.forbid):
     # e.g. "https://registry-1.docker.io"
     url: pydantic.AnyHttpUrl
@@ -37,6 +90,9 @@ class Registry(pydantic.BaseModel, extra=pydantic.Extra.forbid):
     # misc configuration
     override_path: Optional[bool] = None
 
+    # mirrors, tried in order before the registry url
+    mirrors: List[Mirror] = []
+
     def __init__(self, *args, **kwargs):
         super(Registry, self).__init__(*args, **kwargs)
 
@@ -66,6 +122,9 @@ class Registry(pydantic.BaseModel, extra=pydantic.Extra.forbid):
     def get_hosts_toml_path(self) -> Path:
         return microk8s.snap_data_dir() / "args" / "certs.d" / self.host / "hosts.toml"
 
+    def get_mirror_file_path(self, idx: int, name: str) -> Path:
+        return microk8s.snap_data_dir() / "args" / "certs.d" / self.host / f"mirror-{idx}" / name
+
     def get_auth_config(self):
         """return auth configuration for registry"""
         if not self.username or not self.password:
@@ -78,49 +137,51 @@ class Registry(pydantic.BaseModel, extra=pydantic.Extra.forbid):
         }
 
     def get_hosts_toml(self):
-        """return data for hosts.toml file"""
-        host_config = {"capabilities": ["pull", "resolve"]}
+        """return data for hosts.toml file. mirrors are listed first, so that containerd tries
+        them in order before falling back to the registry url"""
+        hosts = {}
+        for idx, mirror in enumerate(self.mirrors):
+            hosts[mirror.url] = _host_config(
+                mirror.capabilities,
+                self.get_mirror_file_path(idx, "ca.crt") if mirror.ca_file else None,
+                self.get_mirror_file_path(idx, "client.crt") if mirror.cert_file else None,
+                self.get_mirror_file_path(idx, "client.key") if mirror.key_file else None,
+                mirror.skip_verify,
+                mirror.override_path,
+            )
+
+        hosts[self.url] = _host_config(
+            ["pull", "resolve"],
+            self.get_ca_file_path() if self.ca_file else None,
+            self.get_cert_file_path() if self.cert_file else None,
+            self.get_key_file_path() if self.key_file else None,
+            self.skip_verify,
+            self.override_path,
+        )
+
+        return {"server": self.url, "host": hosts}
+
+    def get_config_files(self) -> Dict[Path, str]:
+        """return the contents of all certs.d files of the registry, keyed by path"""
+        files = {}
         if self.ca_file:
-            host_config["ca"] = self.get_ca_file_path().as_posix()
-        if self.cert_file and self.key_file:
-            host_config["client"] = [
-                [self.get_cert_file_path().as_posix(), self.get_key_file_path().as_posix()]
-            ]
-        elif self.cert_file:
-            host_config["client"] = self.get_cert_file_path().as_posix()
-
-        if self.skip_verify:
-            host_config["skip_verify"] = True
-        if self.override_path:
-            host_config["override_path"] = True
-
-        return {
-            "server": self.url,
-            "host": {self.url: host_config},
-        }
-
-    def ensure_certificates(self):
-        """ensure client and ca certificates"""
-        ca_file_path = self.get_ca_file_path()
-        if self.ca_file:
-            LOG.debug("Configure custom CA %s", ca_file_path)
-            util.ensure_file(ca_file_path, self.ca_file, 0o600, 0, 0)
-        else:
-            ca_file_path.unlink(missing_ok=True)
-
-        cert_file_path = self.get_cert_file_path()
+            files[self.get_ca_file_path()] = self.ca_file
         if self.cert_file:
-            LOG.debug("Configure client certificate %s", cert_file_path)
-            util.ensure_file(cert_file_path, self.cert_file, 0o600, 0, 0)
-        else:
-            cert_file_path.unlink(missing_ok=True)
-
-        key_file_path = self.get_key_file_path()
+            files[self.get_cert_file_path()] = self.cert_file
         if self.key_file:
-            LOG.debug("Configure client key %s", key_file_path)
-            util.ensure_file(key_file_path, self.key_file, 0o600, 0, 0)
-        else:
-            key_file_path.unlink(missing_ok=True)
+            files[self.get_key_file_path()] = self.key_file
+
+        for idx, mirror in enumerate(self.mirrors):
+            for name, data in (
+                ("ca.crt", mirror.ca_file),
+                ("client.crt", mirror.cert_file),
+                ("client.key", mirror.key_file),
+            ):
+                if data:
+                    files[self.get_mirror_file_path(idx, name)] = data
+
+        files[self.get_hosts_toml_path()] = tomli_w.dumps(self.get_hosts_toml())
+        return files
 
 
 class RegistryConfigs(pydantic.BaseModel, extra=pydantic.Extra.forbid):
@@ -141,32 +202,231 @@ def parse_registries(json_str: str) -> List[Registry]:
     return RegistryConfigs(registries=parsed).registries
 
 
-def ensure_registry_configs(registries: List[Registry]):
-    """ensure containerd configuration files match the specified registries.
-    restart containerd service if needed"""
+def get_manifest_path() -> Path:
+    return microk8s.snap_data_dir() / "args" / "certs.d" / ".microk8s-charm-manifest.json"
+
+
+def _read_manifest() -> List[str]:
+    try:
+        return json.loads(get_manifest_path().read_text())["files"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return []
+
+
+def sync_config_files(files: Dict[Path, str]) -> List[Path]:
+    """sync the certs.d tree with the desired files. Only files whose contents differ are written.
+    Files written by a previous sync that are no longer desired are removed, along with their
+    directories once empty. The list of owned files is kept in a manifest. Returns changed paths"""
+    certs_dir = microk8s.snap_data_dir() / "args" / "certs.d"
+
+    changed = []
+    for path, data in files.items():
+        if path.exists() and path.read_text() == data:
+            continue
+        LOG.debug("Update %s", path)
+        util.ensure_file(path, data, 0o600, 0, 0)
+        changed.append(path)
+
+    desired = sorted(path.relative_to(certs_dir).as_posix() for path in files)
+    owned = _read_manifest()
+    for name in sorted(set(owned) - set(desired), reverse=True):
+        path = certs_dir / name
+        LOG.info("Remove stale registry configuration %s", path)
+        path.unlink(missing_ok=True)
+        changed.append(path)
+
+        # remove empty parent directories, up to certs.d
+        for parent in path.parents:
+            if parent == certs_dir or not parent.is_dir() or any(parent.iterdir()):
+                break
+            parent.rmdir()
+
+    if owned != desired:
+        util.ensure_file(get_manifest_path(), json.dumps({"files": desired}), 0o600, 0, 0)
+
+    return changed
+
+
+# how registry configuration changes were applied, see ensure_registry_configs()
+APPLY_NONE = "none"
+APPLY_LIVE = "live"
+APPLY_RESTART = "restart"
+
+# text block appended to containerd-template.toml by previous charm revisions
+LEGACY_TEMPLATE_BLOCK_MARKER = "# {mark} managed by microk8s charm"
+
+# containerd CRI plugin table
+CRI_PLUGIN = ("plugins", "io.containerd.grpc.v1.cri")
+
+
+def get_template_path() -> Path:
+    return microk8s.snap_data_dir() / "args" / "containerd-template.toml"
+
+
+def get_template_manifest_path() -> Path:
+    return microk8s.snap_data_dir() / "args" / ".containerd-template-charm.json"
+
+
+def _strip_legacy_block(data: str) -> str:
+    marker_begin = "\n" + LEGACY_TEMPLATE_BLOCK_MARKER.replace("{mark}", "begin") + "\n"
+    marker_end = "\n" + LEGACY_TEMPLATE_BLOCK_MARKER.replace("{mark}", "end") + "\n"
+
+    begin_index = data.find(marker_begin)
+    end_index = data.find(marker_end, begin_index + 1)
+    if begin_index == -1 or end_index == -1:
+        return data
+
+    end_index += len(marker_end)
+    return data[:begin_index] + "\n" + data[end_index:]
+
+
+def _set_key(doc: dict, path: Tuple[str, ...], value: Any):
+    for key in path[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[path[-1]] = value
+
+
+def _get_key(doc: dict, path: Tuple[str, ...]) -> Tuple[bool, Any]:
+    for key in path:
+        if not isinstance(doc, dict) or key not in doc:
+            return False, None
+        doc = doc[key]
+    return True, doc
+
+
+def _delete_key(doc: dict, path: Tuple[str, ...]):
+    for key in path[:-1]:
+        doc = doc.get(key)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(path[-1], None)
+
+
+def ensure_template_config(section: str, values: Dict[Tuple[str, ...], Any]) -> bool:
+    """merge charm-owned keys into containerd-template.toml. `values` maps key paths, e.g.
+    ("plugins", "io.containerd.grpc.v1.cri", "registry", "configs", "docker.io"), to tables or
+    values.
+
+    keys that `section` set previously and are no longer in `values` are released: the value
+    they had before the charm took them over is restored, or they are removed. ownership and
+    previous values are kept in a manifest next to the template.
+
+    the template is only written if the resulting configuration differs semantically, so
+    formatting and key order do not matter. returns True if the configuration has changed"""
+    path = get_template_path()
+    data = path.read_text() if path.exists() else ""
+    stripped = _strip_legacy_block(data)
+
+    try:
+        manifest = json.loads(get_template_manifest_path().read_text())
+    except (OSError, ValueError):
+        manifest = {}
+
+    try:
+        current = tomli.loads(stripped)
+    except tomli.TOMLDecodeError as e:
+        raise ValueError(f"failed to parse {path}: {e}") from e
+
+    desired = tomli.loads(stripped)
+    owned = {tuple(entry["key"]): entry for entry in manifest.get(section, [])}
+    for key_path, entry in owned.items():
+        if key_path in values:
+            continue
+        if "previous" in entry:
+            _set_key(desired, key_path, entry["previous"])
+        else:
+            _delete_key(desired, key_path)
+
+    entries = []
+    for key_path, value in values.items():
+        entry = owned.get(key_path)
+        if entry is None:
+            entry = {"key": list(key_path)}
+            found, previous = _get_key(desired, key_path)
+            if found:
+                entry["previous"] = previous
+        _set_key(desired, key_path, value)
+        entries.append(entry)
+
+    # the template is written first, so that the manifest never claims keys that are not set
+    changed = desired != current or stripped != data
+    if changed:
+        LOG.info("Update containerd configuration (%s)", section)
+        util.ensure_file(path, tomli_w.dumps(desired), 0o600, 0, 0)
+
+    if manifest.get(section, []) != entries:
+        manifest[section] = entries
+        util.ensure_file(get_template_manifest_path(), json.dumps(manifest), 0o600, 0, 0)
+
+    return changed
+
+
+def ensure_registry_configs(registries: List[Registry]) -> str:
+    """ensure containerd configuration files match the specified registries. configuration of
+    registries that are no longer specified is removed.
+
+    containerd reloads the certs.d hosts.toml files and certificates on every pull, so changes
+    there apply live. registry credentials are part of the CRI configuration, a containerd
+    restart is scheduled only when those change. returns APPLY_NONE, APPLY_LIVE or APPLY_RESTART
+    """
+    files = {}
     auth_config = {}
     for r in registries:
         LOG.info("Configure registry %s (%s)", r.host, r.url)
-
-        r.ensure_certificates()
-        util.ensure_file(r.get_hosts_toml_path(), tomli_w.dumps(r.get_hosts_toml()), 0o600, 0, 0)
+        files.update(r.get_config_files())
 
         if r.username and r.password:
             LOG.debug("Configure username and password for %s (%s)", r.url, r.host)
             auth_config.update(**r.get_auth_config())
 
-    if not auth_config:
-        return
-
-    registry_configs = {
-        "plugins": {"io.containerd.grpc.v1.cri": {"registry": {"configs": auth_config}}}
-    }
-
-    containerd_toml_path = microk8s.snap_data_dir() / "args" / "containerd-template.toml"
-    containerd_toml = containerd_toml_path.read_text() if containerd_toml_path.exists() else ""
-    new_containerd_toml = util.ensure_block(
-        containerd_toml, tomli_w.dumps(registry_configs), "# {mark} managed by microk8s charm"
-    )
-    if util.ensure_file(containerd_toml_path, new_containerd_toml, 0o600, 0, 0):
-        LOG.info("Restart containerd to apply registry configurations")
-        util.ensure_call(["snap", "restart", "microk8s.daemon-containerd"])
+    result = APPLY_LIVE if sync_config_files(files) else APPLY_NONE
+
+    # credentials are owned per registry host, configs of other hosts are left alone
+    values = {(*CRI_PLUGIN, "registry", "configs", host): c for host, c in auth_config.items()}
+    if ensure_template_config("registries", values):
+        LOG.info("Restart containerd to apply registry credentials")
+        microk8s.schedule_restart("microk8s.daemon-containerd")
+        result = APPLY_RESTART
+
+    if result == APPLY_LIVE:
+        LOG.info("Registry hosts configuration applied without restarting containerd")
+
+    return result
+
+
+# snapshotters that may be configured with ensure_performance_config()
+SNAPSHOTTERS = ("overlayfs", "native", "zfs")
+
+
+def ensure_performance_config(
+    max_concurrent_downloads: int = 0,
+    snapshotter: str = "",
+    discard_unpacked_layers: bool = False,
+    max_container_log_line_size: int = 0,
+) -> bool:
+    """configure containerd image pull and logging settings. unset values (0, "", False) keep the
+    MicroK8s defaults. schedule a containerd restart if the configuration changed. raises
+    ValueError for invalid values"""
+    if max_concurrent_downloads < 0:
+        raise ValueError(f"invalid max_concurrent_downloads {max_concurrent_downloads}")
+    if snapshotter and snapshotter not in SNAPSHOTTERS:
+        raise ValueError(f"invalid snapshotter {snapshotter}, must be one of {SNAPSHOTTERS}")
+    if max_container_log_line_size < -1:
+        raise ValueError(f"invalid max_container_log_line_size {max_container_log_line_size}")
+
+    values = {}
+    if max_concurrent_downloads:
+        values[(*CRI_PLUGIN, "max_concurrent_downloads")] = max_concurrent_downloads
+    if max_container_log_line_size:
+        values[(*CRI_PLUGIN, "max_container_log_line_size")] = max_container_log_line_size
+    if snapshotter:
+        values[(*CRI_PLUGIN, "containerd", "snapshotter")] = snapshotter
+    if discard_unpacked_layers:
+        values[(*CRI_PLUGIN, "containerd", "discard_unpacked_layers")] = True
+
+    if not ensure_template_config("performance", values):
+        return False
+
+    LOG.info("Restart containerd to apply performance configuration")
+    microk8s.schedule_restart("microk8s.daemon-containerd")
+    return True
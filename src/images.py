@@ -0,0 +1,223 @@
+#
+# Copyright 2023 Canonical, Ltd.
+#
+import concurrent.futures
+import json
+import logging
+import os
+import pty
+import re
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import containerd
+import microk8s
+import util
+
+LOG = logging.getLogger(__name__)
+
+# maximum number of images pulled at the same time
+PULL_CONCURRENCY = 4
+
+# pulls are retried a few times, the next pre-pull job retries images that still failed
+PULL_RETRY_POLICY = util.RetryPolicy(max_attempts=3, backoff=5, max_backoff=20, jitter=0.2)
+
+
+def prepull_dir() -> Path:
+    return util.charm_dir() / ".prepull"
+
+
+def parse_images(value: str) -> List[str]:
+    """parse a list of image references, separated by whitespace or commas"""
+    return [image for image in re.split(r"[\s,]+", value.strip()) if image]
+
+
+def normalize_image(image: str) -> str:
+    """return the fully qualified reference of an image, as listed by containerd.
+    e.g. nginx -> docker.io/library/nginx:latest"""
+    name, digest = image.split("@", 1) if "@" in image else (image, None)
+
+    domain, _, path = name.partition("/")
+    if not path or ("." not in domain and ":" not in domain and domain != "localhost"):
+        domain, path = "docker.io", name
+    if domain == "docker.io" and "/" not in path:
+        path = f"library/{path}"
+
+    if digest:
+        return f"{domain}/{path}@{digest}"
+    if ":" not in path.rsplit("/", 1)[-1]:
+        path = f"{path}:latest"
+
+    return f"{domain}/{path}"
+
+
+def list_images() -> set:
+    """return the references of all images known to containerd"""
+    p = util.ensure_call(
+        ["microk8s", "ctr", "--namespace", "k8s.io", "image", "ls", "--quiet"], capture_output=True
+    )
+    return set(p.stdout.decode().split())
+
+
+def _run_with_password(cmd: List[str], password: str) -> subprocess.CompletedProcess:
+    """run a command that prompts for a password. `ctr` reads the password from its terminal,
+    so stdin is a pseudo-terminal. The password is not part of the command line"""
+    master, slave = pty.openpty()
+    try:
+        os.write(master, f"{password}\n".encode())
+        return util.run(cmd, stdin=slave, capture_output=True)
+    finally:
+        os.close(slave)
+        os.close(master)
+
+
+def pull_image(image: str, credentials: Optional[str] = None):
+    """`microk8s ctr image pull`. Registry mirrors and certificates are read from the hosts.toml
+    files in the containerd certs.d directory. credentials are "username:password", only the
+    username is passed on the command line"""
+    cmd = ["microk8s", "ctr", "--namespace", "k8s.io", "image", "pull"]
+    cmd.extend(["--hosts-dir", (microk8s.snap_data_dir() / "args" / "certs.d").as_posix()])
+    if not credentials:
+        util.ensure_call([*cmd, image], capture_output=True, policy=PULL_RETRY_POLICY)
+        return
+
+    username, _, password = credentials.partition(":")
+    util.ensure_func(
+        _run_with_password,
+        [*cmd, "--user", username, image],
+        password,
+        retry_on=subprocess.CalledProcessError,
+        policy=PULL_RETRY_POLICY,
+        name="microk8s ctr",
+    )
+
+
+def _write_progress(progress: dict):
+    path = prepull_dir() / "progress.json"
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(progress))
+    tmp_path.replace(path)
+
+
+def run_prepull(images: List[str], credentials: Dict[str, str]):
+    """pull missing images with up to PULL_CONCURRENCY concurrent pulls. progress is written
+    to the prepull directory after each image, see get_prepull_progress()"""
+    start = time.monotonic()
+    try:
+        present = list_images()
+    except subprocess.CalledProcessError:
+        LOG.exception("failed to list images, pull all")
+        present = set()
+
+    missing = [image for image in images if normalize_image(image) not in present]
+    LOG.info("Pre-pull %d images (%d already present)", len(missing), len(images) - len(missing))
+
+    progress = {
+        "pid": os.getpid(),
+        "total": len(images),
+        "pulled": len(images) - len(missing),
+        "failed": [],
+        "done": False,
+    }
+    _write_progress(progress)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PULL_CONCURRENCY) as pool:
+        futures = {}
+        for image in missing:
+            ref = normalize_image(image)
+            domain = ref.split("/", 1)[0]
+            futures[pool.submit(pull_image, ref, credentials.get(domain))] = image
+
+        for future in concurrent.futures.as_completed(futures):
+            image = futures[future]
+            try:
+                future.result()
+                progress["pulled"] += 1
+            except subprocess.CalledProcessError:
+                LOG.exception("failed to pull image %s", image)
+                progress["failed"].append(image)
+
+            _write_progress(progress)
+
+    progress["done"] = True
+    _write_progress(progress)
+    LOG.info("Pre-pulled %d images in %.2f seconds", len(missing), time.monotonic() - start)
+
+
+def get_prepull_progress() -> Optional[dict]:
+    """return the progress of the last pre-pull job, if any"""
+    try:
+        progress = json.loads((prepull_dir() / "progress.json").read_text())
+    except (OSError, ValueError):
+        return None
+
+    if not progress.get("done"):
+        try:
+            os.kill(progress["pid"], 0)
+        except ProcessLookupError:
+            # job was interrupted, e.g. the machine rebooted
+            progress["done"] = True
+
+    return progress
+
+
+def stop_prepull():
+    """stop the running pre-pull job, if any"""
+    progress = get_prepull_progress()
+    if not progress or progress.get("done"):
+        return
+
+    # the job runs in its own session, stop the pulls it started as well
+    try:
+        os.killpg(progress["pid"], signal.SIGTERM)
+        LOG.info("Stopped pre-pull job (pid %d)", progress["pid"])
+    except OSError:
+        pass
+
+
+def start_prepull(images: List[str], registries: List[containerd.Registry]):
+    """start pulling images in a background process. Credentials are taken from the configured
+    registries. A pre-pull job that is already running is stopped first"""
+    stop_prepull()
+
+    path = prepull_dir()
+    path.mkdir(mode=0o700, exist_ok=True)
+    (path / "progress.json").unlink(missing_ok=True)
+    (path / "job.json").unlink(missing_ok=True)
+    if not images:
+        return
+
+    credentials = {
+        r.host: f"{r.username}:{r.password}" for r in registries if r.username and r.password
+    }
+    # the job file contains registry credentials, the job removes it once it has read it
+    util.ensure_file(
+        path / "job.json", json.dumps({"images": images, "credentials": credentials}), 0o600, 0, 0
+    )
+
+    LOG.info("Start pre-pull of %d images in the background", len(images))
+    with open(path / "prepull.log", "ab") as log:
+        subprocess.Popen(
+            [sys.executable, Path(__file__).as_posix(), (path / "job.json").as_posix()],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+
+
+def run_prepull_job(job_file: Path):
+    """run the pre-pull job written by start_prepull(). The job file contains registry
+    credentials, it is removed as soon as it has been read"""
+    job = json.loads(job_file.read_text())
+    job_file.unlink()
+    run_prepull(job["images"], job["credentials"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    run_prepull_job(Path(sys.argv[1]))
@@ -0,0 +1,250 @@
+#
+# Copyright 2023 Canonical, Ltd.
+#
+import base64
+import http.client
+import json
+import logging
+import os
+import ssl
+import tempfile
+import urllib.parse
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import yaml
+
+LOG = logging.getLogger(__name__)
+
+# field manager used for server-side apply
+FIELD_MANAGER = "microk8s-charm"
+
+# kinds that are not namespaced. all other kinds are assumed to be namespaced
+CLUSTER_SCOPED_KINDS = {
+    "ClusterRole",
+    "ClusterRoleBinding",
+    "CustomResourceDefinition",
+    "Namespace",
+    "Node",
+    "PersistentVolume",
+    "StorageClass",
+}
+
+
+class ApiError(Exception):
+    """the Kubernetes API server responded with an error status code"""
+
+    def __init__(self, status: int, reason: str, body: str = ""):
+        super().__init__(f"{status} {reason}: {body}")
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+def resource_path(
+    api_version: str, kind: str, name: Optional[str] = None, namespace: Optional[str] = None
+) -> str:
+    """return API path for a resource (or collection of resources if name is not set)"""
+    parts = ["/api/v1" if api_version == "v1" else f"/apis/{api_version}"]
+    if namespace and kind not in CLUSTER_SCOPED_KINDS:
+        parts.append(f"namespaces/{namespace}")
+
+    # naive pluralization is enough for the kinds managed by the charm
+    parts.append(f"{kind.lower()}s")
+    if name:
+        parts.append(name)
+
+    return "/".join(parts)
+
+
+class Client:
+    """minimal Kubernetes API client. A single connection to the API server is kept open and
+    reused for all requests"""
+
+    def __init__(
+        self,
+        server: str,
+        ssl_context: Optional[ssl.SSLContext] = None,
+        token: Optional[str] = None,
+        timeout: float = 30,
+    ):
+        url = urllib.parse.urlsplit(server)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.ssl_context = ssl_context
+        self.token = token
+        self.timeout = timeout
+
+        self._conn: Optional[http.client.HTTPConnection] = None
+
+    @classmethod
+    def from_kubeconfig(cls, kubeconfig: Path) -> "Client":
+        """create a client using the current context of a kubeconfig file. Raises OSError if
+        the file cannot be read and ValueError if it is not a valid kubeconfig"""
+        data = kubeconfig.read_text()
+        try:
+            return cls._from_kubeconfig_data(data)
+        except (yaml.YAMLError, AttributeError, KeyError, StopIteration, TypeError) as e:
+            raise ValueError(f"invalid kubeconfig {kubeconfig}: {e!r}") from e
+        except ValueError as e:
+            raise ValueError(f"invalid kubeconfig {kubeconfig}: {e}") from e
+
+    @classmethod
+    def _from_kubeconfig_data(cls, data: str) -> "Client":
+        config = yaml.safe_load(data)
+
+        contexts = {c["name"]: c["context"] for c in config.get("contexts") or []}
+        clusters = {c["name"]: c["cluster"] for c in config.get("clusters") or []}
+        users = {u["name"]: u["user"] for u in config.get("users") or []}
+
+        context = contexts.get(config.get("current-context")) or next(iter(contexts.values()))
+        cluster = clusters[context["cluster"]]
+        user = users.get(context.get("user")) or {}
+
+        ssl_context = ssl.create_default_context()
+        if cluster.get("insecure-skip-tls-verify"):
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        elif "certificate-authority-data" in cluster:
+            ca = base64.b64decode(cluster["certificate-authority-data"]).decode()
+            ssl_context.load_verify_locations(cadata=ca)
+        elif "certificate-authority" in cluster:
+            ssl_context.load_verify_locations(cafile=cluster["certificate-authority"])
+
+        if "client-certificate-data" in user and "client-key-data" in user:
+            # ssl can only load client certificates from files
+            with tempfile.TemporaryDirectory() as tmpdir:
+                crt_path = Path(tmpdir) / "client.crt"
+                key_path = Path(tmpdir) / "client.key"
+                crt_path.write_bytes(base64.b64decode(user["client-certificate-data"]))
+                key_path.write_bytes(base64.b64decode(user["client-key-data"]))
+                os.chmod(key_path, 0o600)
+                ssl_context.load_cert_chain(crt_path, key_path)
+        elif "client-certificate" in user and "client-key" in user:
+            ssl_context.load_cert_chain(user["client-certificate"], user["client-key"])
+
+        return cls(cluster["server"], ssl_context=ssl_context, token=user.get("token"))
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self._conn is None:
+            if self.scheme == "https":
+                self._conn = http.client.HTTPSConnection(
+                    self.host, self.port, timeout=self.timeout, context=self.ssl_context
+                )
+            else:
+                self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+        return self._conn
+
+    def close(self):
+        """close the connection to the API server, if open"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: Optional[dict] = None,
+        params: Optional[dict] = None,
+        content_type: str = "application/json",
+    ) -> dict:
+        """send a request to the API server and return the decoded JSON response. Raises
+        ApiError for error responses, OSError if the server is not reachable and ValueError if
+        the response is not a JSON object"""
+        headers = {"Accept": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = content_type
+
+        if params:
+            path = f"{path}?{urllib.parse.urlencode(params)}"
+
+        LOG.debug("Kubernetes API request %s %s", method, path)
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+                payload = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError) as e:
+                # the server may have closed the idle connection, reconnect once
+                self.close()
+                if attempt > 0:
+                    raise ConnectionError(f"request {method} {path} failed: {e}") from e
+
+        if response.status >= 400:
+            raise ApiError(response.status, response.reason, payload.decode(errors="replace"))
+
+        if not payload:
+            return {}
+
+        try:
+            result = json.loads(payload)
+        except ValueError as e:
+            raise ValueError(f"invalid response to {method} {path}: {e}") from e
+        if not isinstance(result, dict):
+            raise ValueError(f"invalid response to {method} {path}: not a JSON object")
+        return result
+
+    def get(self, api_version: str, kind: str, name: str, namespace: Optional[str] = None) -> dict:
+        """retrieve a single resource"""
+        return self.request("GET", resource_path(api_version, kind, name, namespace))
+
+    def list(
+        self,
+        api_version: str,
+        kind: str,
+        namespace: Optional[str] = None,
+        label_selector: Optional[str] = None,
+    ) -> List[dict]:
+        """list resources of a kind, return the list of items"""
+        params = {"labelSelector": label_selector} if label_selector else None
+        path = resource_path(api_version, kind, namespace=namespace)
+        return self.request("GET", path, params=params).get("items") or []
+
+    def apply(self, obj: dict) -> dict:
+        """server-side apply of a resource manifest"""
+        metadata = obj["metadata"]
+        path = resource_path(
+            obj["apiVersion"], obj["kind"], metadata["name"], metadata.get("namespace")
+        )
+        return self.request(
+            "PATCH",
+            path,
+            body=obj,
+            params={"fieldManager": FIELD_MANAGER, "force": "true"},
+            content_type="application/apply-patch+yaml",
+        )
+
+    def create_secret(
+        self, name: str, namespace: str, data: Dict[str, str], secret_type: str = "Opaque"
+    ) -> dict:
+        """create a secret. data values are plain strings, they are base64 encoded by the client"""
+        secret = {
+            "apiVersion": "v1",
+            "kind": "Secret",
+            "metadata": {"name": name, "namespace": namespace},
+            "type": secret_type,
+            "data": {k: base64.b64encode(v.encode()).decode() for k, v in data.items()},
+        }
+        return self.request("POST", resource_path("v1", "Secret", namespace=namespace), body=secret)
+
+
+_clients: Dict[Path, Client] = {}
+
+
+def get_client(kubeconfig: Path) -> Client:
+    """return a client for the kubeconfig file. Clients are cached, so that all requests
+    in the same hook reuse a single connection"""
+    if kubeconfig not in _clients:
+        _clients[kubeconfig] = Client.from_kubeconfig(kubeconfig)
+
+    return _clients[kubeconfig]
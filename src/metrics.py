@@ -3,44 +3,50 @@
 #
 
 
-import json
 import logging
-import subprocess
 from base64 import b64decode
 from typing import Dict, List, Tuple
 
+import yaml
+
+import k8s_api
 import microk8s
 import util
 
 LOG = logging.getLogger(__name__)
 
+# openssl commands only fail for local reasons, retrying does not help much
+OPENSSL_RETRY_POLICY = util.RetryPolicy(max_attempts=2, backoff=1)
+
+# the API server may be restarting, e.g. after configuration changes
+APPLY_RETRY_POLICY = util.RetryPolicy(max_attempts=10, backoff=1, max_backoff=10, jitter=0.2)
+
 
 def apply_required_resources():
-    """kubectl apply manifests that create the required roles and RBAC rules for observability"""
+    """apply manifests that create the required roles and RBAC rules for observability"""
+    client = k8s_api.get_client(microk8s.admin_kubeconfig())
     for file in ["metrics.yaml", "kube-state-metrics.yaml"]:
         path = util.charm_dir() / "src" / "deploy" / file
-        util.ensure_call(["microk8s", "kubectl", "apply", "-f", path.as_posix()])
+        for obj in yaml.safe_load_all(path.read_text()):
+            if obj:
+                util.ensure_func(
+                    client.apply,
+                    obj,
+                    retry_on=(k8s_api.ApiError, OSError),
+                    policy=APPLY_RETRY_POLICY,
+                    name="kubernetes apply",
+                )
 
 
 def get_tls_auth() -> Tuple[str, str]:
     """return (cert, key) to use for TLS client auth on the metrics endpoints"""
+    client = k8s_api.get_client(microk8s.admin_kubeconfig())
     try:
-        p = util.run(
-            [
-                "microk8s",
-                "kubectl",
-                "get",
-                "secret",
-                "--namespace=kube-system",
-                "microk8s-observability-tls",
-                "-o=json",
-            ],
-            capture_output=True,
-        )
-        output = json.loads(p.stdout)["data"]
+        secret = client.get("v1", "Secret", "microk8s-observability-tls", "kube-system")
+        output = secret["data"]
         return (b64decode(output["tls.crt"]).decode(), b64decode(output["tls.key"]).decode())
 
-    except (json.JSONDecodeError, KeyError, TypeError, ValueError, subprocess.CalledProcessError):
+    except (k8s_api.ApiError, KeyError, TypeError, ValueError):
         # could not retrieve secret, or it contains invalid data. create it
 
         LOG.info("Creating TLS auth for ServiceAccount microk8s-observability")
@@ -49,7 +55,9 @@ def get_tls_auth() -> Tuple[str, str]:
         crt_path = util.charm_dir() / "metrics.crt"
 
         # private key
-        util.ensure_call(["openssl", "genrsa", "-out", key_path.as_posix(), "2048"])
+        util.ensure_call(
+            ["openssl", "genrsa", "-out", key_path.as_posix(), "2048"], policy=OPENSSL_RETRY_POLICY
+        )
 
         # csr
         p = util.ensure_call(
@@ -63,6 +71,7 @@ def get_tls_auth() -> Tuple[str, str]:
                 key_path.as_posix(),
             ],
             capture_output=True,
+            policy=OPENSSL_RETRY_POLICY,
         )
         csr = p.stdout
 
@@ -84,23 +93,15 @@ def get_tls_auth() -> Tuple[str, str]:
                 crt_path.as_posix(),
             ],
             input=csr,
+            policy=OPENSSL_RETRY_POLICY,
         )
 
         # create Kubernetes secret
-        util.ensure_call(
-            [
-                "microk8s",
-                "kubectl",
-                "create",
-                "secret",
-                "tls",
-                "microk8s-observability-tls",
-                "--namespace=kube-system",
-                "--cert",
-                crt_path.as_posix(),
-                "--key",
-                key_path.as_posix(),
-            ]
+        client.create_secret(
+            "microk8s-observability-tls",
+            "kube-system",
+            {"tls.crt": crt_path.read_text(), "tls.key": key_path.read_text()},
+            secret_type="kubernetes.io/tls",
         )
 
         return get_tls_auth()
@@ -1,22 +1,118 @@
 #
 # Copyright 2023 Canonical, Ltd.
 #
+import concurrent.futures
+import hashlib
 import ipaddress
 import json
 import logging
 import os
+import re
 import shlex
+import socket
 import subprocess
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
 
+import yaml
 from ops.model import ActiveStatus, MaintenanceStatus, WaitingStatus
 
 import charm_config
+import k8s_api
 import ops_helpers
 import util
 
 LOG = logging.getLogger(__name__)
 
+# snap operations may conflict with an in-progress auto-refresh, so be patient. other
+# failures, e.g. an unknown channel or an invalid snap file, are not retried
+SNAP_RETRY_POLICY = util.RetryPolicy(
+    max_attempts=10,
+    backoff=2,
+    max_backoff=30,
+    jitter=0.2,
+    deadline=600,
+    retry_output=(
+        r"change in progress",
+        r"too early for operation",
+        r"cannot communicate with server",
+        r"(?i)timeout|timed out",
+        r"(?i)connection (refused|reset)",
+        r"(?i)temporary failure|network is unreachable",
+    ),
+)
+
+# restarting a service either works or fails quickly
+RESTART_RETRY_POLICY = util.RetryPolicy(max_attempts=3, backoff=1, max_backoff=4)
+
+# joins may fail while many nodes join the cluster at the same time
+JOIN_RETRY_POLICY = util.RetryPolicy(
+    max_attempts=15,
+    backoff=2,
+    max_backoff=60,
+    jitter=0.5,
+    deadline=900,
+    # an invalid or expired token does not become valid by retrying
+    fatal_output=(r"(?i)invalid token", r"already known to dqlite"),
+)
+
+# removing a node should not hold the leader for long, it is retried on the next hook
+REMOVE_NODE_RETRY_POLICY = util.RetryPolicy(max_attempts=5, backoff=2, max_backoff=8, jitter=0.2)
+
+# containerd may still be starting right after the snap is installed
+IMAGE_IMPORT_RETRY_POLICY = util.RetryPolicy(max_attempts=5, backoff=2, max_backoff=10)
+
+# services scheduled for restart, with the number of times a restart was requested. restarts
+# are coalesced and each service is restarted once, see restart_pending_services()
+_pending_restarts: Dict[str, int] = {}
+
+# launch configuration fragments scheduled in this hook. fragments are merged and applied
+# once, see apply_pending_launch_configuration()
+_pending_launch_configuration: dict = {}
+
+# seconds for which a `microk8s status` snapshot is reused
+STATUS_TTL = 30
+
+
+@dataclass(frozen=True)
+class Status:
+    """parsed output of `microk8s status --format yaml`"""
+
+    running: bool = False
+    ha_enabled: bool = False
+    ha_nodes: Tuple[str, ...] = ()
+    addons: Dict[str, bool] = field(default_factory=dict)
+
+    @classmethod
+    def parse(cls, output: str) -> "Status":
+        try:
+            data = yaml.safe_load(output)
+        except yaml.YAMLError:
+            data = None
+
+        # "microk8s is not running" is printed as plain text
+        if not isinstance(data, dict):
+            return cls()
+
+        ha = data.get("high-availability") or {}
+        return cls(
+            running=bool((data.get("microk8s") or {}).get("running")),
+            ha_enabled=bool(ha.get("enabled")),
+            ha_nodes=tuple(node.get("address", "") for node in ha.get("nodes") or []),
+            addons={
+                addon["name"]: addon.get("status") == "enabled"
+                for addon in data.get("addons") or []
+                if "name" in addon
+            },
+        )
+
+
+# last `microk8s status` snapshot and the time it was taken. reused by all helpers until it
+# expires or is invalidated by a command that changes the state of the node
+_status_snapshot: Optional[Tuple[float, Status]] = None
+
 
 def snap_dir() -> Path:
     return Path("/snap/microk8s/current")
@@ -26,40 +122,249 @@ def snap_data_dir() -> Path:
     return Path("/var/snap/microk8s/current")
 
 
-def install():
-    """`snap install microk8s`"""
-    LOG.info("Installing MicroK8s (channel %s)", charm_config.SNAP_CHANNEL)
-    cmd = ["snap", "install", "microk8s", "--classic", "--channel", charm_config.SNAP_CHANNEL]
+def _install_snap_file(snap_file: Path, assert_file: Optional[Path]):
+    """install (or refresh to) a local snap file"""
+    cmd = ["snap", "install", snap_file.as_posix(), "--classic"]
+    if assert_file:
+        util.ensure_call(["snap", "ack", assert_file.as_posix()], policy=SNAP_RETRY_POLICY)
+    else:
+        LOG.warning("No assertion for %s, installing with --dangerous", snap_file)
+        cmd.append("--dangerous")
+
+    util.ensure_call(cmd, policy=SNAP_RETRY_POLICY)
+
+
+def install(snap_file: Optional[Path] = None, assert_file: Optional[Path] = None):
+    """`snap install microk8s`. If snap_file is set, install from the local file instead of
+    the snap store"""
+    if snap_file:
+        LOG.info("Installing MicroK8s (from %s)", snap_file)
+        _install_snap_file(snap_file, assert_file)
+    else:
+        LOG.info("Installing MicroK8s (channel %s)", charm_config.SNAP_CHANNEL)
+        cmd = ["snap", "install", "microk8s", "--classic", "--channel", charm_config.SNAP_CHANNEL]
+        util.ensure_call(cmd, policy=SNAP_RETRY_POLICY)
+
+    invalidate_status()
+
+
+def upgrade(snap_file: Optional[Path] = None, assert_file: Optional[Path] = None):
+    """upgrade microk8s to charm version. If snap_file is set, refresh to the local file
+    instead of the snap store channel"""
+    if snap_file:
+        LOG.info("Upgrade MicroK8s (from %s)", snap_file)
+        _install_snap_file(snap_file, assert_file)
+    else:
+        LOG.info("Upgrade MicroK8s (channel %s)", charm_config.SNAP_CHANNEL or "default")
+        cmd = ["snap", "refresh", "microk8s", "--channel", charm_config.SNAP_CHANNEL]
+        util.ensure_call(cmd, policy=SNAP_RETRY_POLICY)
 
-    util.ensure_call(cmd)
+    invalidate_status()
 
 
-def upgrade():
-    """upgrade microk8s to charm version"""
-    LOG.info("Upgrade MicroK8s (channel %s)", charm_config.SNAP_CHANNEL or "default")
-    cmd = ["snap", "refresh", "microk8s", "--channel", charm_config.SNAP_CHANNEL]
+def _normalize_channel(channel: str) -> str:
+    """return a snap channel as track/risk, e.g. "edge" -> "latest/edge", "1.28" -> "1.28/stable" """
+    risks = ("stable", "candidate", "beta", "edge")
+    track, _, risk = (channel or "latest/stable").partition("/")
+    if not risk:
+        track, risk = ("latest", track) if track in risks else (track, "stable")
+    return f"{track}/{risk.split('/')[0]}"
 
-    util.ensure_call(cmd)
+
+def snap_channel_changed() -> bool:
+    """return True if the installed microk8s snap does not track the charm channel, e.g. it was
+    installed from a different channel or from a local snap file"""
+    try:
+        p = util.run(["snap", "list", "microk8s"], capture_output=True)
+        header, row = p.stdout.decode().splitlines()[:2]
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        LOG.exception("failed to retrieve the tracked channel of the microk8s snap")
+        return True
+
+    tracking = dict(zip(header.split(), row.split())).get("Tracking", "-")
+    if tracking == "-":
+        return True
+    return _normalize_channel(tracking) != _normalize_channel(charm_config.SNAP_CHANNEL)
+
+
+def snap_file_digest(snap_file: Path) -> str:
+    """return the sha256 digest of a snap file"""
+    digest = hashlib.sha256()
+    with open(snap_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def schedule_restart(service: str):
+    """schedule a restart of a snap service, e.g. "microk8s.daemon-containerd". The service
+    is restarted by restart_pending_services() at the end of the hook"""
+    LOG.info("Schedule restart of %s", service)
+    _pending_restarts[service] = _pending_restarts.get(service, 0) + 1
+
+
+def restart_pending_services():
+    """restart each service that was scheduled for restart exactly once"""
+    restarted = []
+    for service, requests in list(_pending_restarts.items()):
+        LOG.info("Restart %s (requested %d times)", service, requests)
+        util.ensure_call(["snap", "restart", service], policy=RESTART_RETRY_POLICY)
+        invalidate_status()
+        _pending_restarts.pop(service)
+        restarted.append(service)
+
+    if restarted:
+        LOG.info("Restarted %d services in this hook: %s", len(restarted), restarted)
+
+
+def invalidate_status():
+    """discard the `microk8s status` snapshot. Must be called after commands that change
+    the state of the node"""
+    global _status_snapshot
+    _status_snapshot = None
+
+
+def get_status(wait_ready: bool = False, timeout: int = 30) -> Status:
+    """return a `microk8s status` snapshot. The snapshot is reused for STATUS_TTL seconds.
+    If wait_ready is set, wait up to timeout seconds for MicroK8s to be running"""
+    global _status_snapshot
+    if _status_snapshot is not None:
+        timestamp, status = _status_snapshot
+        if time.monotonic() - timestamp < STATUS_TTL and (status.running or not wait_ready):
+            return status
+
+    cmd = ["microk8s", "status", "--format", "yaml"]
+    if wait_ready:
+        cmd.extend(["--wait-ready", f"--timeout={timeout}"])
+
+    p = util.ensure_call(cmd, capture_output=True)
+    status = Status.parse(p.stdout.decode())
+    _status_snapshot = (time.monotonic(), status)
+    return status
+
+
+def import_images(bundle: Path):
+    """`microk8s ctr image import` all images from an image archive"""
+    LOG.info("Import container images from %s", bundle)
+    util.ensure_call(
+        ["microk8s", "ctr", "image", "import", bundle.as_posix()],
+        capture_output=True,
+        policy=IMAGE_IMPORT_RETRY_POLICY,
+    )
 
 
 def wait_ready(timeout: int = 30):
     """`microk8s status --wait-ready`"""
     LOG.info("Wait for MicroK8s to become ready")
-    util.ensure_call(
-        ["microk8s", "status", "--wait-ready", f"--timeout={timeout}"], capture_output=True
-    )
+    get_status(wait_ready=True, timeout=timeout)
 
 
 def uninstall():
     """`snap remove microk8s --purge`"""
     LOG.info("Uninstall MicroK8s")
-    util.ensure_call(["snap", "remove", "microk8s", "--purge"])
+    util.ensure_call(["snap", "remove", "microk8s", "--purge"], policy=SNAP_RETRY_POLICY)
 
 
 def remove_node(hostname: str):
     """`microk8s remove-node --force`"""
     LOG.info("Removing node %s from cluster", hostname)
-    util.ensure_call(["microk8s", "remove-node", hostname, "--force"])
+    util.ensure_call(
+        ["microk8s", "remove-node", hostname, "--force"], policy=REMOVE_NODE_RETRY_POLICY
+    )
+    invalidate_status()
+
+
+def remove_nodes(hostnames: List[str], max_workers: int = 4) -> List[str]:
+    """remove nodes from the cluster, running up to max_workers removals concurrently.
+    Returns the hostnames of the nodes that could not be removed"""
+    if not hostnames:
+        return []
+
+    failed = []
+    workers = max(1, min(max_workers, len(hostnames)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(remove_node, hostname): hostname for hostname in hostnames}
+        for future in concurrent.futures.as_completed(futures):
+            hostname = futures[future]
+            try:
+                future.result()
+            except subprocess.CalledProcessError:
+                LOG.exception("failed to remove departing node %s", hostname)
+                failed.append(hostname)
+
+    LOG.info("Removed %d of %d departed nodes", len(hostnames) - len(failed), len(hostnames))
+    return sorted(failed)
+
+
+def drain_dir() -> Path:
+    return util.charm_dir() / ".drain"
+
+
+def start_drain_node(hostname: str, timeout: int = 300):
+    """start `microk8s kubectl drain` in a background process, so that evicting pods does not
+    block the hook. The node is cordoned and its pods are evicted. See get_drain_node_status()"""
+    path = drain_dir()
+    path.mkdir(mode=0o700, exist_ok=True)
+    clear_drain_node(hostname)
+
+    cmd = [
+        "microk8s",
+        "kubectl",
+        "drain",
+        hostname,
+        "--ignore-daemonsets",
+        "--delete-emptydir-data",
+        f"--timeout={timeout}s",
+    ]
+    rc_file = path / f"{hostname}.rc"
+    script = f"{shlex.join(cmd)}; echo $? > {rc_file}.tmp && mv {rc_file}.tmp {rc_file}"
+
+    LOG.info("Start draining node %s", hostname)
+    with open(path / f"{hostname}.log", "ab") as log:
+        p = subprocess.Popen(
+            ["/bin/sh", "-c", script],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    (path / f"{hostname}.pid").write_text(str(p.pid))
+
+
+def get_drain_node_status(hostname: str) -> Optional[str]:
+    """return the status of the last drain of a node started with start_drain_node(). This is
+    one of "running", "done" or "failed", or None if the node is not being drained"""
+    path = drain_dir()
+    try:
+        return "done" if (path / f"{hostname}.rc").read_text().strip() == "0" else "failed"
+    except OSError:
+        pass
+
+    try:
+        pid = int((path / f"{hostname}.pid").read_text())
+    except (OSError, ValueError):
+        return None
+
+    try:
+        os.kill(pid, 0)
+        return "running"
+    except ProcessLookupError:
+        # the drain was interrupted, e.g. the machine rebooted
+        return "failed"
+    except PermissionError:
+        return "running"
+
+
+def clear_drain_node(hostname: str):
+    """forget the status of the last drain of a node"""
+    for suffix in ("rc", "pid"):
+        (drain_dir() / f"{hostname}.{suffix}").unlink(missing_ok=True)
+
+
+def uncordon_node(hostname: str):
+    """`microk8s kubectl uncordon`"""
+    LOG.info("Uncordon node %s", hostname)
+    util.ensure_call(["microk8s", "kubectl", "uncordon", hostname])
 
 
 def join(join_url: str, worker: bool):
@@ -69,45 +374,73 @@ def join(join_url: str, worker: bool):
     if worker:
         cmd.append("--worker")
 
-    util.ensure_call(cmd)
+    util.ensure_call(cmd, policy=JOIN_RETRY_POLICY)
+    invalidate_status()
 
 
-def add_node() -> str:
-    """`microk8s add-node` and return join token"""
-    LOG.info("Generating token for new node")
+def add_node(token_ttl: int = 7200) -> str:
+    """`microk8s add-node` and return join token. The token can be used by any number of
+    nodes until it expires after token_ttl seconds"""
+    LOG.info("Generating token for new nodes (valid for %d seconds)", token_ttl)
     token = os.urandom(16).hex()
-    util.ensure_call(["microk8s", "add-node", "--token", token, "--token-ttl", "7200"])
+    util.ensure_call(["microk8s", "add-node", "--token", token, "--token-ttl", str(token_ttl)])
     return token
 
 
+def kubelet_kubeconfig() -> Path:
+    return snap_data_dir() / "credentials" / "kubelet.config"
+
+
+def admin_kubeconfig() -> Path:
+    return snap_data_dir() / "credentials" / "client.config"
+
+
 def get_unit_status(hostname: str):
     """Retrieve node Ready condition from Kubernetes and convert to Juju unit status."""
     try:
-        # use the kubectl binary with the kubelet config directly
-        output = util.run(
-            [
-                f"{snap_dir()}/kubectl",
-                f"--kubeconfig={snap_data_dir()}/credentials/kubelet.config",
-                "get",
-                "node",
-                hostname,
-                "-o",
-                "jsonpath={.status.conditions[?(@.type=='Ready')]}",
-            ],
-            capture_output=True,
-        ).stdout
-        node_ready_condition = json.loads(output)
+        # use the kubelet credentials, which are available on all nodes
+        node = k8s_api.get_client(kubelet_kubeconfig()).get("v1", "Node", hostname)
+        node_ready_condition = next(
+            c for c in node["status"]["conditions"] if c.get("type") == "Ready"
+        )
         if node_ready_condition["status"] == "False":
             LOG.warning("node %s is not ready: %s", hostname, node_ready_condition)
             return WaitingStatus(f"node is not ready: {node_ready_condition['reason']}")
 
         return ActiveStatus("node is ready")
 
-    except (subprocess.CalledProcessError, json.JSONDecodeError, KeyError) as e:
+    except (
+        k8s_api.ApiError,
+        OSError,
+        ValueError,
+        AttributeError,
+        KeyError,
+        TypeError,
+        StopIteration,
+    ) as e:
         LOG.warning("could not retrieve status of node %s: %s", hostname, e)
         return MaintenanceStatus("waiting for node")
 
 
+def get_node_statuses() -> Dict[str, dict]:
+    """Retrieve the Ready condition of all cluster nodes with a single API call. Returns a
+    mapping of node names to {"ready": bool, "reason": str}. Raises k8s_api.ApiError, OSError
+    or ValueError if the nodes could not be listed"""
+    result = {}
+    for node in k8s_api.get_client(admin_kubeconfig()).list("v1", "Node"):
+        try:
+            conditions = (node.get("status") or {}).get("conditions") or []
+            ready = next((c for c in conditions if c.get("type") == "Ready"), {})
+            result[node["metadata"]["name"]] = {
+                "ready": ready.get("status") == "True",
+                "reason": ready.get("reason", ""),
+            }
+        except (AttributeError, KeyError, TypeError) as e:
+            raise ValueError(f"invalid node object: {e!r}") from e
+
+    return result
+
+
 def set_containerd_proxy_options(http_proxy: str, https_proxy: str, no_proxy: str):
     """update containerd http proxy configuration and restart containerd if changed"""
 
@@ -133,7 +466,7 @@ def set_containerd_proxy_options(http_proxy: str, https_proxy: str, no_proxy: st
 
     if util.ensure_file(path, new_containerd_env, 0o600, 0, 0):
         LOG.info("Restart containerd to apply environment configuration")
-        util.ensure_call(["snap", "restart", "microk8s.daemon-containerd"])
+        schedule_restart("microk8s.daemon-containerd")
 
 
 def disable_cert_reissue():
@@ -159,6 +492,48 @@ def apply_launch_configuration(config: dict):
         ],
         input=json.dumps({"version": "0.1.0", **config}).encode(),
     )
+    invalidate_status()
+
+
+def _merge_launch_configuration(base: Mapping, fragment: Mapping) -> dict:
+    """deep merge a launch configuration fragment into base, return the merged document"""
+    merged = {}
+    for source in (base, fragment):
+        for key, value in source.items():
+            if isinstance(value, Mapping):
+                current = merged.get(key)
+                current = current if isinstance(current, dict) else {}
+                merged[key] = _merge_launch_configuration(current, value)
+            else:
+                merged[key] = value
+
+    return merged
+
+
+def schedule_launch_configuration(config: dict):
+    """schedule a launch configuration fragment. Fragments are merged and applied by
+    apply_pending_launch_configuration() at the end of the hook"""
+    global _pending_launch_configuration
+    _pending_launch_configuration = _merge_launch_configuration(
+        _pending_launch_configuration, config
+    )
+
+
+def apply_pending_launch_configuration(last_applied: Mapping) -> dict:
+    """merge the scheduled fragments into the last applied launch configuration. The merged
+    document is applied once, only if it differs from `last_applied`. Returns the merged
+    document, to be passed as `last_applied` on the next call"""
+    global _pending_launch_configuration
+    merged = _merge_launch_configuration(last_applied, _pending_launch_configuration)
+
+    if merged == _merge_launch_configuration({}, last_applied):
+        LOG.debug("Launch configuration is up to date")
+    else:
+        LOG.info("Apply launch configuration %s", merged)
+        apply_launch_configuration(merged)
+
+    _pending_launch_configuration = {}
+    return merged
 
 
 def configure_extra_sans(extra_sans_str: str):
@@ -194,31 +569,62 @@ def configure_extra_sans(extra_sans_str: str):
     if util.ensure_file(path, new_csr_conf, 0o600, 0, 0):
         LOG.info("Update kube-apiserver certificate with extra SANs %s", extra_sans)
         util.ensure_call(["microk8s", "refresh-certs", "-e", "server.crt"])
+        invalidate_status()
 
 
-def configure_hostpath_storage(enable: bool):
-    """configure hostpath-storage on the cluster"""
-    p = util.ensure_call(["microk8s", "status", "-a", "hostpath-storage"], capture_output=True)
-    stdout = p.stdout.decode().strip()
+def parse_addons(value: str) -> Dict[str, str]:
+    """parse a list of addons, separated by whitespace or commas. Each addon may include
+    arguments, e.g. "metallb:10.0.0.100-10.0.0.120". Returns a mapping of addon names to the
+    full addon specification. Raises ValueError for invalid addon names"""
+    addons = {}
+    for spec in re.split(r"[\s,]+", value.strip()):
+        if not spec:
+            continue
 
-    storage_enabled = stdout == "enabled"
+        name = spec.split(":", 1)[0]
+        if not re.fullmatch(r"[a-z0-9][a-z0-9-]*(/[a-z0-9][a-z0-9-]*)?", name):
+            raise ValueError(f"invalid addon name '{name}'")
 
-    if enable == storage_enabled:
-        LOG.debug("Hostpath storage is already %s", stdout)
-        return
+        addons[name] = spec
+
+    return addons
 
-    if enable:
-        LOG.info("Enable hostpath-storage")
-        util.ensure_call(["microk8s", "enable", "hostpath-storage"])
-    else:
-        LOG.info("Disable hostpath storage")
-        util.ensure_call(["microk8s", "disable", "hostpath-storage"], input=b"n")
+
+def configure_addons(enable: List[str], disable: List[str]) -> List[str]:
+    """enable and disable addons on the cluster. Addons are compared against a single status
+    snapshot, and changed with at most one `microk8s enable` and one `microk8s disable` call.
+    Addons that are already enabled are not re-enabled, even if their arguments differ.
+    Returns the names of the addons that were enabled"""
+    status = get_status()
+
+    def is_enabled(spec: str) -> bool:
+        # addons may be prefixed with their repository, e.g. "core/dns"
+        return status.addons.get(spec.split(":", 1)[0].split("/")[-1], False)
+
+    to_enable = [spec for spec in enable if not is_enabled(spec)]
+    to_disable = [name for name in disable if is_enabled(name)]
+
+    if not to_enable and not to_disable:
+        LOG.debug("Addons are up to date")
+        return []
+
+    if to_disable:
+        LOG.info("Disable addons %s", to_disable)
+        # do not delete hostpath-storage volumes
+        util.ensure_call(["microk8s", "disable", *to_disable], input=b"n")
+
+    if to_enable:
+        LOG.info("Enable addons %s", to_enable)
+        util.ensure_call(["microk8s", "enable", *to_enable])
+
+    invalidate_status()
+    return [spec.split(":", 1)[0] for spec in to_enable]
 
 
 def configure_rbac(enable: bool):
     """enable or disable rbac"""
     LOG.info("Ensure RBAC is %s", enable)
-    apply_launch_configuration(
+    schedule_launch_configuration(
         {
             "extraKubeAPIServerArgs": {
                 "--authorization-mode": "Node,RBAC" if enable else "AlwaysAllow"
@@ -227,16 +633,55 @@ def configure_rbac(enable: bool):
     )
 
 
-def write_local_kubeconfig():
-    """write kubeconfig file for the cluster"""
+def local_kubeconfig() -> Path:
+    return Path("/root/.kube/config")
+
+
+def _default_ip() -> str:
+    """return the source address for the default route, as `microk8s config` uses"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            # connecting a UDP socket does not send any packets
+            s.connect(("10.255.255.255", 1))
+            return s.getsockname()[0]
+    except OSError:
+        return ""
+
+
+def kubeconfig_fingerprint() -> str:
+    """return a fingerprint of the inputs of `microk8s config`: the cluster CA, the apiserver
+    certificate and arguments, the admin credentials and the node address"""
+    h = hashlib.sha256()
+    for path in (
+        snap_data_dir() / "certs" / "ca.crt",
+        snap_data_dir() / "certs" / "server.crt",
+        snap_data_dir() / "credentials" / "client.config",
+        snap_data_dir() / "args" / "kube-apiserver",
+    ):
+        h.update(path.as_posix().encode())
+        h.update(path.read_bytes() if path.exists() else b"")
+
+    h.update(_default_ip().encode())
+    return h.hexdigest()
+
+
+def write_local_kubeconfig(last_fingerprint: Optional[str] = None) -> str:
+    """write kubeconfig file for the cluster. The export is skipped if the kubeconfig inputs
+    still match `last_fingerprint`. Returns the fingerprint of the exported kubeconfig"""
+    fingerprint = kubeconfig_fingerprint()
+    if fingerprint == last_fingerprint and local_kubeconfig().exists():
+        LOG.debug("Local kubeconfig is up to date")
+        return fingerprint
+
     p = util.ensure_call(["microk8s", "config"], capture_output=True)
-    util.ensure_file(Path("/root/.kube/config"), p.stdout.decode(), 0o600, 0, 0)
+    util.ensure_file(local_kubeconfig(), p.stdout.decode(), 0o600, 0, 0)
+    return fingerprint
 
 
 def configure_dns(ip: str, domain: str):
     """update kubelet dns configuration"""
     LOG.info("Use DNS %s (domain %s)", ip, domain)
-    apply_launch_configuration(
+    schedule_launch_configuration(
         {
             "extraKubeletArgs": {
                 "--cluster-dns": ip,
@@ -246,15 +691,87 @@ def configure_dns(ip: str, domain: str):
     )
 
 
+# kubelet arguments that may be set with configure_kubelet_args(), and their value types
+KUBELET_ARGS = {
+    "--max-pods": int,
+    "--serialize-image-pulls": bool,
+    "--registry-qps": int,
+    "--registry-burst": int,
+    "--kube-api-qps": int,
+    "--kube-api-burst": int,
+    "--image-gc-high-threshold": int,
+    "--image-gc-low-threshold": int,
+}
+
+
+def parse_kubelet_args(value: str) -> Dict[str, str]:
+    """parse a YAML or JSON map of kubelet arguments, e.g. '{"max-pods": 250}'. Argument names
+    may omit the leading dashes. Returns a mapping of arguments to their string values. Raises
+    ValueError for unknown arguments or invalid values"""
+    try:
+        parsed = yaml.safe_load(value) if value.strip() else {}
+    except yaml.YAMLError as e:
+        raise ValueError(f"not valid YAML: {e}") from e
+
+    if not isinstance(parsed, dict):
+        raise ValueError("kubelet arguments must be a map")
+
+    args = {}
+    for key, arg_value in parsed.items():
+        name = f"--{str(key).lstrip('-')}"
+        arg_type = KUBELET_ARGS.get(name)
+        if arg_type is None:
+            raise ValueError(f"unsupported kubelet argument '{key}'")
+
+        # bool is a subclass of int
+        if not isinstance(arg_value, arg_type) or (arg_type is int and isinstance(arg_value, bool)):
+            raise ValueError(f"invalid value {arg_value!r} for kubelet argument '{key}'")
+        if arg_type is int and arg_value < 0:
+            raise ValueError(f"invalid value {arg_value!r} for kubelet argument '{key}'")
+
+        args[name] = str(arg_value).lower() if arg_type is bool else str(arg_value)
+
+    high = int(args.get("--image-gc-high-threshold", 85))
+    low = int(args.get("--image-gc-low-threshold", 80))
+    if high > 100 or low >= high:
+        raise ValueError("image GC thresholds must satisfy low < high <= 100")
+
+    return args
+
+
+def configure_kubelet_args(args: Mapping[str, str], applied: Iterable[str] = ()):
+    """set kubelet arguments through the launch configuration. arguments in `applied` (e.g. the
+    keys of the last applied extraKubeletArgs) that are no longer configured are removed"""
+    LOG.info("Configure kubelet arguments %s", dict(args))
+    extra_kubelet_args = {name: None for name in applied if name in KUBELET_ARGS}
+    extra_kubelet_args.update(args)
+    schedule_launch_configuration({"extraKubeletArgs": extra_kubelet_args})
+
+
+def get_snap_revision() -> Optional[str]:
+    """return the revision of the installed microk8s snap, or None if not installed"""
+    try:
+        return os.readlink(snap_dir())
+    except OSError:
+        return None
+
+
 def get_kubernetes_version() -> str:
     """retrieve version of kubernetes running on the unit"""
     try:
-        p = util.run(["microk8s", "version"], capture_output=True)
-        version = p.stdout.decode().split(" ")[1]
-        if version.startswith("v"):
-            version = version[1:]
-
-        return version
-    except (subprocess.CalledProcessError, ValueError, IndexError, TypeError) as e:
-        LOG.warning("could not retrieve microk8s version: %s", e)
-        return None
+        # the snap version matches the kubernetes version, no need to run any commands
+        version = yaml.safe_load((snap_dir() / "meta" / "snap.yaml").read_text())["version"]
+    except (OSError, yaml.YAMLError, KeyError, TypeError) as e:
+        LOG.debug("could not read version from snap metadata: %s", e)
+        try:
+            p = util.run(["microk8s", "version"], capture_output=True)
+            version = p.stdout.decode().split(" ")[1]
+        except (subprocess.CalledProcessError, ValueError, IndexError, TypeError) as e:
+            LOG.warning("could not retrieve microk8s version: %s", e)
+            return None
+
+    version = str(version)
+    if version.startswith("v"):
+        version = version[1:]
+
+    return version
@@ -3,10 +3,15 @@
 #
 import logging
 import os
+import random
+import re
 import shlex
 import subprocess
+import threading
 import time
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Dict, Optional, Tuple
 
 LOG = logging.getLogger(__name__)
 
@@ -19,25 +24,71 @@ def run(*args, **kwargs) -> subprocess.CompletedProcess:
     return subprocess.run(*args, **kwargs)
 
 
+def _installed_packages(dpkg_status: Path = Path("/var/lib/dpkg/status")) -> set:
+    """return the names of installed packages, as recorded in the dpkg status database"""
+    installed = set()
+    try:
+        for stanza in dpkg_status.read_text().split("\n\n"):
+            fields = dict(
+                line.split(":", 1)
+                for line in stanza.splitlines()
+                if ":" in line and not line.startswith(" ")
+            )
+            if fields.get("Status", "").strip() == "install ok installed":
+                installed.add(fields.get("Package", "").strip())
+    except OSError:
+        LOG.warning("failed to read dpkg status, assuming no packages are installed", exc_info=1)
+
+    return installed
+
+
+def _apt_install(packages: list) -> bool:
+    """install packages in a single apt transaction. failures are logged, not raised.
+    returns True if the packages were installed"""
+    try:
+        LOG.info("Installing packages %s", packages)
+        run(["apt-get", "install", "--yes", *packages])
+        return True
+    except subprocess.CalledProcessError:
+        LOG.warning("failed to install packages %s, charm may misbehave", packages, exc_info=1)
+        return False
+
+
 def install_required_packages():
     """install useful apt packages for microk8s"""
 
     # FIXME(neoaggelos): these are only really required for OpenEBS. Perhaps we can skip them
     packages = ["nfs-common", "open-iscsi"]
 
+    # the extra kernel modules are not available for every kernel, so they are installed
+    # separately and a failure does not affect the required packages
+    optional_packages = []
     try:
-        packages.append(f"linux-modules-extra-{os.uname().release}")
+        optional_packages.append(f"linux-modules-extra-{os.uname().release}")
     except OSError:
         LOG.warning("unknown kernel version, will not install extra modules", exc_info=1)
 
-    LOG.info("Installing required packages %s", packages)
+    start = time.monotonic()
+    installed = _installed_packages()
+    LOG.info("Checked dpkg status in %.2f seconds", time.monotonic() - start)
 
-    for package in packages:
-        try:
-            LOG.info("Installing package %s", package)
-            run(["apt-get", "install", "--yes", package])
-        except subprocess.CalledProcessError:
-            LOG.warning("failed to install package %s, charm may misbehave", package, exc_info=1)
+    start = time.monotonic()
+    done, failed = [], []
+    for group in (packages, optional_packages):
+        group_missing = [package for package in group if package not in installed]
+        if group_missing:
+            (done if _apt_install(group_missing) else failed).extend(group_missing)
+
+    if not done and not failed:
+        LOG.info("Required packages %s are already installed", packages + optional_packages)
+        return
+
+    LOG.info(
+        "Installed packages %s, failed to install %s in %.2f seconds",
+        done,
+        failed,
+        time.monotonic() - start,
+    )
 
 
 def ensure_file(
@@ -83,24 +134,194 @@ def ensure_block(data: str, block: str, block_marker: str) -> str:
     return f"{data[:begin_index]}{marker_begin}{block}{data[end_index:]}"
 
 
+@dataclass(frozen=True)
+class RetryPolicy:
+    """RetryPolicy controls how failing commands are retried. Delays grow exponentially from
+    `backoff` up to `max_backoff` seconds, with a random `jitter` (fraction of the delay).
+    Retries stop after `max_attempts` tries or when `deadline` seconds have passed.
+
+    `retry_exit_codes` and `retry_output` (regular expressions) restrict which failed commands
+    are retried, `fatal_output` (regular expressions) marks failures that are never retried.
+    Patterns are matched against the captured stderr and stdout of the command, e.g. `microk8s
+    join` reports errors on stdout. Commands without captured output are always considered
+    retryable, ensure_call() captures the output of commands whose policy has output patterns."""
+
+    max_attempts: int = 10
+    backoff: float = 2
+    max_backoff: Optional[float] = None
+    jitter: float = 0
+    deadline: Optional[float] = None
+    retry_exit_codes: Optional[Tuple[int, ...]] = None
+    retry_output: Optional[Tuple[str, ...]] = None
+    fatal_output: Optional[Tuple[str, ...]] = None
+
+    def delay(self, attempt: int) -> float:
+        """return seconds to wait after the failed attempt (starting from 1)"""
+        delay = self.backoff * 2 ** (attempt - 1)
+        if self.max_backoff is not None:
+            delay = min(delay, self.max_backoff)
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        return max(delay, 0)
+
+    def is_retryable(self, e: Exception) -> bool:
+        """return True if the failure should be retried"""
+        if not isinstance(e, subprocess.CalledProcessError):
+            return True
+
+        if self.retry_exit_codes is not None and e.returncode not in self.retry_exit_codes:
+            return False
+
+        output = _process_output(e)
+        if output is None:
+            return True
+
+        if self.fatal_output and any(re.search(p, output) for p in self.fatal_output):
+            return False
+
+        if self.retry_output:
+            return any(re.search(pattern, output) for pattern in self.retry_output)
+
+        return True
+
+
+def _process_output(e: subprocess.CalledProcessError) -> Optional[str]:
+    """return the captured stderr and stdout of a failed command, or None if not captured"""
+    if e.stderr is None and e.stdout is None:
+        return None
+
+    output = []
+    for stream in (e.stderr, e.stdout):
+        if stream:
+            output.append(stream.decode(errors="replace") if isinstance(stream, bytes) else stream)
+
+    return "\n".join(output)
+
+
+# fixed 2 second backoff
+DEFAULT_RETRY_POLICY = RetryPolicy(max_attempts=10, backoff=2, max_backoff=2)
+
+# number of calls, retries and total seconds spent, for each retried action in this hook
+RETRY_STATS: Dict[str, Dict[str, float]] = {}
+
+# RETRY_STATS is updated by actions running in worker threads
+_retry_stats_lock = threading.Lock()
+
+
 def _ensure_func(
-    f: callable, args: list, kwargs: dict, retry_on, max_retries: int = 10, backoff: int = 2
+    f: callable,
+    args: list,
+    kwargs: dict,
+    retry_on,
+    max_retries: int = 10,
+    backoff: int = 2,
+    policy: Optional[RetryPolicy] = None,
+    name: Optional[str] = None,
 ):
-    """run a function until it does not raise one of the exceptions from retry_on"""
-    for idx in range(max_retries - 1):
+    """run a function until it does not raise one of the exceptions from retry_on.
+    if policy is not set, retry up to max_retries times with a fixed backoff"""
+    if policy is None:
+        policy = RetryPolicy(max_attempts=max_retries, backoff=backoff, max_backoff=backoff)
+
+    with _retry_stats_lock:
+        stats = RETRY_STATS.setdefault(
+            name or getattr(f, "__name__", repr(f)), {"calls": 0, "retries": 0, "seconds": 0.0}
+        )
+        stats["calls"] += 1
+
+    start = time.monotonic()
+    try:
+        for idx in range(policy.max_attempts - 1):
+            try:
+                return f(*args, **kwargs)
+            except retry_on as e:
+                if not policy.is_retryable(e):
+                    LOG.warning("action failed with a non-retryable error: %s", e)
+                    _log_process_output(e)
+                    raise
+
+                delay = policy.delay(idx + 1)
+                if policy.deadline is not None:
+                    if time.monotonic() - start + delay > policy.deadline:
+                        LOG.warning(
+                            "action not successful, deadline of %ss reached", policy.deadline
+                        )
+                        raise
+
+                LOG.warning(
+                    "action not successful (try %d of %d)", idx + 1, policy.max_attempts, exc_info=1
+                )
+                _log_process_output(e)
+                with _retry_stats_lock:
+                    stats["retries"] += 1
+                time.sleep(delay)
+
+        # last time run unprotected and raise any exception
         try:
             return f(*args, **kwargs)
-        except retry_on:
-            LOG.warning("action not successful (try %d of %d)", idx + 1, max_retries, exc_info=1)
-            time.sleep(backoff)
+        except subprocess.CalledProcessError as e:
+            _log_process_output(e)
+            raise
+    finally:
+        with _retry_stats_lock:
+            stats["seconds"] += time.monotonic() - start
+
+
+def _log_process_output(e: Exception):
+    """log the captured output of a failed command, if any"""
+    if isinstance(e, subprocess.CalledProcessError):
+        output = _process_output(e)
+        if output:
+            LOG.warning("command output: %s", output)
+
+
+def log_retry_stats():
+    """log the number of retries and time spent for all actions that were retried"""
+    for name, stats in RETRY_STATS.items():
+        if stats["retries"]:
+            LOG.info(
+                "%s: %d calls, %d retries, %.2f seconds",
+                name,
+                stats["calls"],
+                stats["retries"],
+                stats["seconds"],
+            )
+
+
+def ensure_func(
+    f: callable,
+    *args,
+    retry_on,
+    policy: Optional[RetryPolicy] = None,
+    name: Optional[str] = None,
+    **kwargs,
+):
+    """repeatedly call f(*args, **kwargs) until it does not raise one of the exceptions from
+    retry_on, according to the retry policy (by default, 10 tries with 2 seconds backoff)"""
+    return _ensure_func(f, args, kwargs, retry_on, policy=policy or DEFAULT_RETRY_POLICY, name=name)
+
 
-    # last time run unprotected and raise any exception
-    return f(*args, **kwargs)
+def ensure_call(
+    *args, policy: Optional[RetryPolicy] = None, **kwargs
+) -> subprocess.CompletedProcess:
+    """repeatedly run a command until it succeeds, according to the retry policy (by default,
+    10 tries with 2 seconds backoff). any args are passed to subprocess.run"""
+    policy = policy or DEFAULT_RETRY_POLICY
 
+    # failures are classified by their output, which must be captured
+    if policy.retry_output or policy.fatal_output:
+        if not any(k in kwargs for k in ("capture_output", "stdout", "stderr")):
+            kwargs["capture_output"] = True
 
-def ensure_call(*args, **kwargs) -> subprocess.CompletedProcess:
-    """repeatedly run a command until it succeeds. any args are passed to subprocess.run"""
-    return _ensure_func(run, args, kwargs, subprocess.CalledProcessError)
+    return _ensure_func(
+        run,
+        args,
+        kwargs,
+        subprocess.CalledProcessError,
+        policy=policy,
+        name=shlex.join(args[0][:2]),
+    )
 
 
 def charm_dir() -> Path:
@@ -24,6 +24,7 @@ class Environment:
     # project mocks
     containerd: mock.MagicMock
     COSAgentProvider: mock.MagicMock
+    images: mock.MagicMock
     metrics: mock.MagicMock
     microk8s: mock.MagicMock
     util: mock.MagicMock
@@ -39,6 +40,7 @@ def e():
         # project mocks
         "containerd": mock.patch("charm.containerd", autospec=True),
         "COSAgentProvider": mock.patch("charm.COSAgentProvider", autospec=True),
+        "images": mock.patch("charm.images", autospec=True),
         "metrics": mock.patch("charm.metrics", autospec=True),
         "microk8s": mock.patch("charm.microk8s", autospec=True),
         "util": mock.patch("charm.util", autospec=True),
@@ -52,7 +54,21 @@ def e():
 
     # default mocks
     e.microk8s.get_kubernetes_version.return_value = "fakeversion"
+    e.microk8s.get_snap_revision.return_value = "1234"
+    e.microk8s.apply_pending_launch_configuration.return_value = {}
+    e.microk8s.parse_kubelet_args.return_value = {}
+    e.microk8s.get_drain_node_status.return_value = None
+    e.microk8s.snap_channel_changed.return_value = True
+    e.microk8s.snap_file_digest.return_value = "fakedigest"
+    e.microk8s.configure_addons.return_value = []
+    e.microk8s.parse_addons.side_effect = lambda v: {a.split(":")[0]: a for a in v.split()}
     e.microk8s.get_unit_status.return_value = ActiveStatus("fakestatus")
+    e.microk8s.get_node_statuses.return_value = {}
+    e.microk8s.remove_nodes.return_value = []
+    e.microk8s.add_node.return_value = "faketoken"
+    e.microk8s.write_local_kubeconfig.return_value = "fakefingerprint"
+    e.images.get_prepull_progress.return_value = None
+    e.images.parse_images.side_effect = lambda v: v.split()
     e.gethostname.return_value = "fakehostname"
 
     yield e
@@ -25,7 +25,7 @@ def test_install(role, e: Environment):
     e.harness.begin_with_initial_hooks()
 
     e.util.install_required_packages.assert_called_once_with()
-    e.microk8s.install.assert_called_once_with()
+    e.microk8s.install.assert_called_once_with(None, None)
     e.microk8s.set_containerd_proxy_options.assert_called_with(
         "fakehttpproxy", "fakehttpsproxy", "fakenoproxy"
     )
@@ -111,6 +111,70 @@ def test_update_status(e: Environment):
     assert e.harness.charm.unit._backend._workload_version == "fakeversion"
 
 
+def test_update_status_kubernetes_version_cache(e: Environment):
+    e.harness.begin_with_initial_hooks()
+    e.harness.charm._state.joined = True
+
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.get_kubernetes_version.assert_called_once_with()
+    assert e.harness.charm.unit._backend._workload_version == "fakeversion"
+
+    # same snap revision, version is not retrieved again
+    e.microk8s.get_kubernetes_version.reset_mock()
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.get_kubernetes_version.assert_not_called()
+
+    # snap revision changed
+    e.microk8s.get_snap_revision.return_value = "1235"
+    e.microk8s.get_kubernetes_version.return_value = "fakeversion2"
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.get_kubernetes_version.assert_called_once_with()
+    assert e.harness.charm.unit._backend._workload_version == "fakeversion2"
+
+
+@mock.patch("time.monotonic")
+def test_update_status_node_ready_timeout(monotonic: mock.MagicMock, e: Environment):
+    e.harness.update_config({"node_ready_timeout": 10})
+    e.harness.begin_with_initial_hooks()
+    e.harness.charm._state.joined = True
+
+    # node never becomes ready, wait with backoff until deadline
+    monotonic.side_effect = [0, 0, 2, 6, 10, 10]
+    e.microk8s.get_unit_status.return_value = ops.model.MaintenanceStatus("waiting for node")
+    e.microk8s.get_unit_status.reset_mock()
+    e.microk8s.write_local_kubeconfig.reset_mock()
+    e.sleep.reset_mock()
+
+    e.harness.charm.on.update_status.emit()
+    assert e.sleep.mock_calls == [mock.call(2), mock.call(4), mock.call(4)]
+    assert e.microk8s.get_unit_status.call_count == 4
+    assert e.harness.charm.unit.status == ops.model.WaitingStatus(
+        "waiting for node to become ready"
+    )
+    e.microk8s.write_local_kubeconfig.assert_not_called()
+    assert e.harness.charm._state.node_ready_wait == {"seconds": 10, "ready": False}
+
+    # waiting status from the node is preserved
+    monotonic.side_effect = None
+    monotonic.return_value = 0
+    e.harness.update_config({"node_ready_timeout": 0})
+    e.microk8s.get_unit_status.return_value = ops.model.WaitingStatus("node is not ready: X")
+    e.sleep.reset_mock()
+
+    e.harness.charm.on.update_status.emit()
+    e.sleep.assert_not_called()
+    assert e.harness.charm.unit.status == ops.model.WaitingStatus("node is not ready: X")
+
+    # duration of the last wait is recorded
+    monotonic.side_effect = [0, 0, 3.5]
+    e.microk8s.get_unit_status.side_effect = [
+        ops.model.WaitingStatus("node is not ready: X"),
+        ops.model.ActiveStatus("node is ready"),
+    ]
+    e.harness.update_config({"node_ready_timeout": 10})
+    assert e.harness.charm._state.node_ready_wait == {"seconds": 3.5, "ready": True}
+
+
 @pytest.mark.parametrize("role", ["", "control-plane"])
 @pytest.mark.parametrize("has_joined", [False, True])
 def test_config_disable_cert_reissue(e: Environment, role: str, has_joined: bool):
@@ -147,6 +211,64 @@ def test_config_extra_sans(e: Environment, role: str, has_joined: bool):
         e.microk8s.configure_extra_sans.assert_not_called()
 
 
+@pytest.mark.parametrize("role", ["", "control-plane", "worker"])
+@pytest.mark.parametrize("with_assert", [True, False])
+def test_install_snap_resource(e: Environment, role: str, with_assert: bool):
+    e.harness.update_config({"role": role})
+    e.harness.add_resource("microk8s-snap", "fakesnap")
+    e.harness.add_resource("microk8s-assert", "fakeassert" if with_assert else "")
+    e.harness.begin_with_initial_hooks()
+
+    snap_file, assert_file = e.microk8s.install.mock_calls[0].args
+    assert snap_file.read_text() == "fakesnap"
+    if with_assert:
+        assert assert_file.read_text() == "fakeassert"
+    else:
+        assert assert_file is None
+
+    e.harness.charm.on.upgrade_charm.emit()
+    e.microk8s.upgrade.assert_called_once_with(snap_file, assert_file)
+
+
+def test_install_empty_snap_resource(e: Environment):
+    e.harness.add_resource("microk8s-snap", "")
+    e.harness.add_resource("microk8s-assert", "fakeassert")
+    e.harness.begin_with_initial_hooks()
+
+    e.microk8s.install.assert_called_once_with(None, None)
+
+
+@pytest.mark.parametrize("role", ["", "control-plane", "worker"])
+def test_install_image_bundle(e: Environment, role: str):
+    e.harness.update_config({"role": role})
+    e.harness.add_resource("image-bundle", "fakeimages")
+
+    manager = mock.Mock()
+    manager.attach_mock(e.microk8s.import_images, "import_images")
+    manager.attach_mock(e.microk8s.wait_ready, "wait_ready")
+    e.harness.begin_with_initial_hooks()
+
+    # images are imported before waiting for the node
+    assert [c[0] for c in manager.mock_calls[:2]] == ["import_images", "wait_ready"]
+    assert manager.mock_calls[0].args[0].read_text() == "fakeimages"
+
+
+@pytest.mark.parametrize("role", ["", "control-plane", "worker"])
+def test_install_image_bundle_failed(e: Environment, role: str):
+    e.harness.update_config({"role": role})
+    e.harness.add_resource("image-bundle", "fakeimages")
+    e.microk8s.import_images.side_effect = subprocess.CalledProcessError(1, "ctr image import")
+    e.harness.begin_with_initial_hooks()
+
+    e.microk8s.wait_ready.assert_called()
+    assert e.harness.charm._state.installed
+
+
+def test_install_no_image_bundle(e: Environment):
+    e.harness.begin_with_initial_hooks()
+    e.microk8s.import_images.assert_not_called()
+
+
 @pytest.mark.parametrize("role", ["", "control-plane", "worker"])
 def test_charm_upgrade(e: Environment, role: str):
     e.harness.update_config({"role": role, "automatic_certificate_reissue": True})
@@ -154,7 +276,7 @@ def test_charm_upgrade(e: Environment, role: str):
 
     e.harness.charm.on.upgrade_charm.emit()
 
-    e.microk8s.upgrade.assert_called_once_with()
+    e.microk8s.upgrade.assert_called_once_with(None, None)
 
 
 @pytest.mark.parametrize("role", ["", "control-plane"])
@@ -184,9 +306,10 @@ def test_config_containerd_custom_registries(e: Environment, role: str, has_join
     e.containerd.ensure_registry_configs.reset_mock()
     e.containerd.parse_registries.return_value = []
 
+    # configuration of removed registries is cleaned up
     e.harness.update_config({"containerd_custom_registries": "fakeval2"})
     e.containerd.parse_registries.assert_called_once_with("fakeval2")
-    e.containerd.ensure_registry_configs.assert_not_called()
+    e.containerd.ensure_registry_configs.assert_called_once_with([])
 
     # exception
     e.containerd.parse_registries.reset_mock()
@@ -200,6 +323,32 @@ def test_config_containerd_custom_registries(e: Environment, role: str, has_join
     assert e.harness.charm.unit.status.__class__ == BlockedStatus
 
 
+@pytest.mark.parametrize("role", ["", "control-plane", "worker"])
+def test_config_containerd_performance(e: Environment, role: str):
+    e.harness.update_config({"role": role})
+    e.harness.begin_with_initial_hooks()
+
+    e.containerd.ensure_performance_config.assert_called_once_with(0, "", False, 0)
+
+    e.containerd.ensure_performance_config.reset_mock()
+    e.harness.update_config(
+        {
+            "containerd_max_concurrent_downloads": 10,
+            "containerd_snapshotter": "native",
+            "containerd_discard_unpacked_layers": True,
+            "containerd_max_container_log_line_size": -1,
+        }
+    )
+    e.containerd.ensure_performance_config.assert_called_once_with(10, "native", True, -1)
+
+    # invalid configuration
+    e.containerd.ensure_performance_config.reset_mock()
+    e.containerd.ensure_performance_config.side_effect = ValueError("fake error")
+    e.harness.update_config({"containerd_snapshotter": "fake"})
+    e.containerd.ensure_performance_config.assert_called_once_with(10, "fake", True, -1)
+    assert isinstance(e.harness.charm.unit.status, BlockedStatus)
+
+
 @pytest.mark.parametrize("role", ["", "control-plane", "worker"])
 @pytest.mark.parametrize("is_leader", [False, True])
 @pytest.mark.parametrize("has_joined", [False, True])
@@ -209,22 +358,92 @@ def test_config_hostpath_storage(e: Environment, role: str, is_leader: bool, has
     e.harness.begin_with_initial_hooks()
 
     e.harness.charm._state.joined = has_joined
-    e.microk8s.configure_hostpath_storage.reset_mock()
+    e.microk8s.configure_addons.reset_mock()
 
     # only the leader control plane unit enables
     e.harness.update_config({"hostpath_storage": True})
     if has_joined and is_leader and role != "worker":
-        e.microk8s.configure_hostpath_storage.assert_called_once_with(True)
+        e.microk8s.configure_addons.assert_called_once_with(["hostpath-storage"], [])
     else:
-        e.microk8s.configure_hostpath_storage.assert_not_called()
+        e.microk8s.configure_addons.assert_not_called()
 
     # only the leader control plane unit disables
-    e.microk8s.configure_hostpath_storage.reset_mock()
+    e.microk8s.configure_addons.reset_mock()
     e.harness.update_config({"hostpath_storage": False})
     if has_joined and is_leader and role != "worker":
-        e.microk8s.configure_hostpath_storage.assert_called_once_with(False)
+        e.microk8s.configure_addons.assert_called_once_with([], ["hostpath-storage"])
+    else:
+        e.microk8s.configure_addons.assert_not_called()
+
+
+@pytest.mark.parametrize("role", ["", "control-plane"])
+def test_config_addons(e: Environment, role: str):
+    e.harness.update_config({"role": role})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+    e.harness.charm._state.joined = True
+    e.microk8s.configure_addons.reset_mock()
+
+    # all addons are configured with a single call. dns was already enabled
+    e.microk8s.configure_addons.return_value = ["ingress", "registry"]
+    e.harness.update_config({"addons": "dns ingress registry:size=40Gi"})
+    e.microk8s.configure_addons.assert_called_once_with(
+        ["dns", "ingress", "registry:size=40Gi"], ["hostpath-storage"]
+    )
+    assert e.harness.charm._get_peer_data("managed_addons", []) == ["ingress", "registry"]
+
+    # addons removed from the list are disabled, if the charm enabled them
+    e.microk8s.configure_addons.reset_mock()
+    e.microk8s.configure_addons.return_value = ["hostpath-storage"]
+    e.harness.update_config({"addons": "ingress", "hostpath_storage": True})
+    e.microk8s.configure_addons.assert_called_once_with(
+        ["ingress", "hostpath-storage"], ["registry"]
+    )
+    assert e.harness.charm._get_peer_data("managed_addons", []) == [
+        "hostpath-storage",
+        "ingress",
+    ]
+
+    # invalid addons block the unit
+    e.microk8s.configure_addons.reset_mock()
+    e.microk8s.parse_addons.side_effect = ValueError("invalid addon name")
+    e.harness.update_config({"addons": "INVALID"})
+    e.microk8s.configure_addons.assert_not_called()
+    assert isinstance(e.harness.charm.unit.status, BlockedStatus)
+
+
+@pytest.mark.parametrize("role", ["", "control-plane", "worker"])
+@pytest.mark.parametrize("has_joined", [False, True])
+def test_config_kubelet_args(e: Environment, role: str, has_joined: bool):
+    e.harness.update_config({"role": role})
+    e.harness.begin_with_initial_hooks()
+
+    e.harness.charm._state.joined = has_joined
+    e.harness.charm._state.launch_configuration = {
+        "extraKubeletArgs": {"--cluster-dns": "fakeip", "--max-pods": "100"}
+    }
+    e.microk8s.parse_kubelet_args.return_value = {"--max-pods": "250"}
+
+    e.harness.update_config({"kubelet_args": '{"max-pods": 250}'})
+    if has_joined:
+        e.microk8s.parse_kubelet_args.assert_called_once_with('{"max-pods": 250}')
+        e.microk8s.configure_kubelet_args.assert_called_once_with(
+            {"--max-pods": "250"}, ["--cluster-dns", "--max-pods"]
+        )
     else:
-        e.microk8s.configure_hostpath_storage.assert_not_called()
+        e.microk8s.configure_kubelet_args.assert_not_called()
+
+    # unchanged, not applied again
+    e.microk8s.configure_kubelet_args.reset_mock()
+    e.harness.update_config({"kubelet_args": '{"max-pods": 250}'})
+    e.microk8s.configure_kubelet_args.assert_not_called()
+
+    # invalid configuration
+    e.microk8s.parse_kubelet_args.side_effect = ValueError("fake error")
+    e.harness.update_config({"kubelet_args": "invalid"})
+    e.microk8s.configure_kubelet_args.assert_not_called()
+    if has_joined:
+        assert isinstance(e.harness.charm.unit.status, BlockedStatus)
 
 
 @pytest.mark.parametrize("role", ["", "control-plane", "worker"])
@@ -254,6 +473,28 @@ def test_config_rbac(e: Environment, role: str, is_leader: bool, has_joined: boo
         e.microk8s.configure_rbac.assert_not_called()
 
 
+@pytest.mark.parametrize("role", ["", "control-plane", "worker"])
+def test_reconcile_dns(e: Environment, role: str):
+    e.harness.update_config({"role": role})
+    e.harness.begin_with_initial_hooks()
+    e.harness.charm._state.joined = True
+
+    rel_id = e.harness.add_relation("dns", "coredns")
+    e.harness.add_relation_unit(rel_id, "coredns/0")
+    e.harness.update_relation_data(
+        rel_id, "coredns/0", {"sdn-ip": "fakeip", "domain": "fakedomain"}
+    )
+
+    # the DNS fragment is scheduled again after the launch configuration is reset
+    e.microk8s.configure_dns.reset_mock()
+    e.harness.charm.on_reconcile_action(mock.MagicMock())
+    e.microk8s.configure_dns.assert_called_once_with("fakeip", "fakedomain")
+
+    e.microk8s.configure_dns.reset_mock()
+    e.harness.charm._upgrade_unit()
+    e.microk8s.configure_dns.assert_called_once_with("fakeip", "fakedomain")
+
+
 @pytest.mark.parametrize("role", ["", "control-plane", "worker"])
 @pytest.mark.parametrize("is_leader", [False, True])
 @pytest.mark.parametrize("has_joined", [False, True])
@@ -307,3 +548,131 @@ def test_relation_kubernetes_info(e: Environment, role: str, is_leader: bool, ha
         assert rel_data["cni-bin-dir"] == "/var/snap/microk8s/current/opt/cni/bin"
     else:
         assert not rel_data
+
+
+@pytest.mark.parametrize("role", ["", "control-plane"])
+def test_config_changed_only_runs_changed_handlers(e: Environment, role: str):
+    e.harness.update_config({"role": role})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+
+    e.microk8s.set_containerd_proxy_options.reset_mock()
+    e.microk8s.configure_addons.reset_mock()
+    e.microk8s.configure_extra_sans.reset_mock()
+    e.microk8s.configure_rbac.reset_mock()
+    e.containerd.parse_registries.reset_mock()
+
+    # only the rbac handler runs
+    e.harness.update_config({"rbac": True})
+    e.microk8s.configure_rbac.assert_called_once_with(True)
+    e.microk8s.set_containerd_proxy_options.assert_not_called()
+    e.microk8s.configure_addons.assert_not_called()
+    e.microk8s.configure_extra_sans.assert_not_called()
+    e.containerd.parse_registries.assert_not_called()
+
+    # nothing changed, nothing runs
+    e.microk8s.configure_rbac.reset_mock()
+    e.harness.update_config({"rbac": True})
+    e.microk8s.configure_rbac.assert_not_called()
+
+    # any option of the handler triggers it
+    e.harness.update_config({"containerd_no_proxy": "10.0.0.0/8"})
+    e.microk8s.set_containerd_proxy_options.assert_called_once_with("", "", "10.0.0.0/8")
+    e.microk8s.configure_rbac.assert_not_called()
+
+
+@pytest.mark.parametrize("role", ["", "control-plane", "worker"])
+def test_reconcile_action(e: Environment, role: str):
+    e.harness.update_config({"role": role})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+    e.harness.charm._state.joined = True
+
+    e.microk8s.set_containerd_proxy_options.reset_mock()
+    e.containerd.parse_registries.reset_mock()
+    e.microk8s.configure_rbac.reset_mock()
+
+    event = mock.MagicMock()
+    e.harness.charm.on_reconcile_action(event)
+
+    e.microk8s.set_containerd_proxy_options.assert_called_once_with("", "", "")
+    e.containerd.parse_registries.assert_called_once_with("[]")
+    if role != "worker":
+        e.microk8s.configure_rbac.assert_called_once_with(False)
+    event.set_results.assert_called_once_with({"status": "fakestatus"})
+
+
+@pytest.mark.parametrize("role", ["", "control-plane", "worker"])
+def test_restart_pending_services(e: Environment, role: str):
+    e.harness.update_config({"role": role})
+    e.harness.begin_with_initial_hooks()
+
+    # restarts are applied before waiting for the node on install
+    e.microk8s.restart_pending_services.assert_called_once_with()
+    e.microk8s.restart_pending_services.reset_mock()
+
+    # restarts are applied once at the end of each hook
+    e.harness.update_config({"containerd_http_proxy": "fakeproxy"})
+    e.microk8s.restart_pending_services.assert_not_called()
+    e.harness.framework.commit()
+    e.microk8s.restart_pending_services.assert_called_once_with()
+
+
+@pytest.mark.parametrize("role", ["", "control-plane", "worker"])
+def test_log_retry_stats_on_commit(e: Environment, role: str):
+    e.harness.update_config({"role": role})
+    e.harness.begin_with_initial_hooks()
+
+    e.util.log_retry_stats.reset_mock()
+    e.harness.framework.commit()
+    e.util.log_retry_stats.assert_called_once_with()
+
+
+@pytest.mark.parametrize("role", ["", "control-plane", "worker"])
+def test_apply_pending_launch_configuration(e: Environment, role: str):
+    e.harness.update_config({"role": role})
+    e.harness.begin_with_initial_hooks()
+
+    launch_configuration = {"extraKubeletArgs": {"--cluster-domain": "local"}}
+    e.microk8s.apply_pending_launch_configuration.return_value = launch_configuration
+    e.harness.framework.commit()
+    e.microk8s.apply_pending_launch_configuration.assert_called_once_with({})
+
+    # the last applied document is passed on the next hook
+    e.microk8s.apply_pending_launch_configuration.reset_mock()
+    e.harness.framework.commit()
+    e.microk8s.apply_pending_launch_configuration.assert_called_once_with(launch_configuration)
+
+    # reconcile re-applies the launch configuration
+    e.microk8s.apply_pending_launch_configuration.reset_mock()
+    e.harness.charm.on_reconcile_action(mock.MagicMock())
+    e.harness.framework.commit()
+    e.microk8s.apply_pending_launch_configuration.assert_called_once_with({})
+
+
+@pytest.mark.parametrize("role", ["", "control-plane", "worker"])
+def test_config_prepull_images(e: Environment, role: str):
+    e.harness.update_config({"role": role})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+    e.harness.charm._state.joined = True
+    e.images.start_prepull.reset_mock()
+
+    e.harness.update_config({"prepull_images": "nginx redis"})
+    e.images.start_prepull.assert_called_once_with(
+        ["nginx", "redis"], e.containerd.parse_registries.return_value
+    )
+
+    # progress is reported in the unit status
+    e.images.get_prepull_progress.return_value = {"total": 2, "pulled": 1, "done": False}
+    e.harness.charm.on.update_status.emit()
+    assert e.harness.charm.unit.status == ops.model.ActiveStatus("pre-pulling images (1/2)")
+
+    e.images.get_prepull_progress.return_value = {"total": 2, "pulled": 2, "done": True}
+    e.harness.charm.on.update_status.emit()
+    assert e.harness.charm.unit.status == ops.model.ActiveStatus("fakestatus")
+
+    # no change, no new job
+    e.images.start_prepull.reset_mock()
+    e.harness.update_config({"prepull_images": "nginx redis"})
+    e.images.start_prepull.assert_not_called()
@@ -1,7 +1,9 @@
 #
 # Copyright 2023 Canonical, Ltd.
 #
+import json
 import subprocess
+import time
 from unittest import mock
 
 import ops
@@ -9,6 +11,8 @@ import ops.testing
 import pytest
 from conftest import Environment
 
+import charm
+
 
 @pytest.mark.parametrize("is_leader", [True, False])
 def test_install(e: Environment, is_leader: bool):
@@ -17,16 +21,16 @@ def test_install(e: Environment, is_leader: bool):
     e.harness.begin_with_initial_hooks()
 
     e.util.install_required_packages.assert_called_once_with()
-    e.microk8s.install.assert_called_once_with()
+    e.microk8s.install.assert_called_once_with(None, None)
     e.microk8s.wait_ready.assert_called()
     e.microk8s.disable_cert_reissue.assert_not_called()
 
     if not is_leader:
         assert isinstance(e.harness.charm.unit.status, ops.model.WaitingStatus)
-        e.microk8s.configure_hostpath_storage.assert_not_called()
+        e.microk8s.configure_addons.assert_not_called()
         e.microk8s.write_local_kubeconfig.assert_not_called()
     else:
-        e.microk8s.configure_hostpath_storage.assert_called_once_with(False)
+        e.microk8s.configure_addons.assert_called_once_with([], ["hostpath-storage"])
         e.microk8s.write_local_kubeconfig.assert_called()
         assert e.harness.charm.unit.status == ops.model.ActiveStatus("fakestatus")
         assert e.harness.charm._state.joined
@@ -48,13 +52,13 @@ def test_leader_peer_relation(e: Environment):
     e.harness.add_relation_unit(rel_id, f"{e.harness.charm.app.name}/1")
     e.harness.update_relation_data(rel_id, f"{e.harness.charm.app.name}/1", {"hostname": "f-1"})
 
-    e.microk8s.add_node.assert_called_once_with()
+    e.microk8s.add_node.assert_called_once_with(charm.JOIN_TOKEN_TTL)
     relation_data = e.harness.get_relation_data(rel_id, e.harness.charm.app)
     assert relation_data["join_url"] == "10.10.10.10:25000/01010101010101010101010101010101"
     assert e.harness.charm._state.hostnames[f"{e.harness.charm.app.name}/1"] == "f-1"
 
     e.harness.remove_relation_unit(rel_id, f"{e.harness.charm.app.name}/1")
-    e.microk8s.remove_node.assert_called_once_with("f-1")
+    e.microk8s.remove_nodes.assert_called_once_with(["f-1"], 4)
 
 
 def test_leader_peer_relation_leave(e: Environment):
@@ -94,14 +98,14 @@ def test_leader_control_plane_relation(e: Environment):
     e.harness.add_relation_unit(rel_id, "microk8s-worker/0")
     e.harness.update_relation_data(rel_id, "microk8s-worker/0", {"hostname": "f-1"})
 
-    e.microk8s.add_node.assert_called_once_with()
+    e.microk8s.add_node.assert_called_once_with(charm.JOIN_TOKEN_TTL)
     relation_data = e.harness.get_relation_data(rel_id, e.harness.charm.app)
     relation_data = e.harness.get_relation_data(rel_id, e.harness.charm.app)
     assert relation_data["join_url"] == "10.10.10.10:25000/01010101010101010101010101010101"
     assert e.harness.charm._state.hostnames["microk8s-worker/0"] == "f-1"
 
     e.harness.remove_relation_unit(rel_id, "microk8s-worker/0")
-    e.microk8s.remove_node.assert_called_once_with("f-1")
+    e.microk8s.remove_nodes.assert_called_once_with(["f-1"], 4)
     assert e.harness.charm.unit.status == ops.model.ActiveStatus("fakestatus")
 
 
@@ -121,7 +125,7 @@ def test_follower_peer_relation(e: Environment):
     assert e.harness.charm._state.hostnames[f"{e.harness.charm.app.name}/1"] == "f-1"
 
     e.harness.remove_relation_unit(rel_id, f"{e.harness.charm.app.name}/1")
-    e.microk8s.remove_node.assert_not_called()
+    e.microk8s.remove_nodes.assert_not_called()
 
 
 def test_follower_control_plane_relation(e: Environment):
@@ -140,7 +144,7 @@ def test_follower_control_plane_relation(e: Environment):
     assert e.harness.charm._state.hostnames["microk8s-worker/0"] == "f-1"
 
     e.harness.remove_relation_unit(rel_id, "microk8s-worker/0")
-    e.microk8s.remove_node.assert_not_called()
+    e.microk8s.remove_nodes.assert_not_called()
 
 
 def test_follower_retrieve_join_url(e: Environment):
@@ -193,9 +197,10 @@ def test_follower_become_leader_remove_departing_nodes(e: Environment, become_le
     e.harness.remove_relation_unit(prel_id, f"{e.harness.charm.app.name}/2")
 
     if become_leader:
-        assert sorted(e.microk8s.remove_node.mock_calls) == [mock.call("f-1"), mock.call("f-2")]
+        removed = [h for c in e.microk8s.remove_nodes.mock_calls for h in c.args[0]]
+        assert sorted(removed) == ["f-1", "f-2"]
     else:
-        e.microk8s.remove_node.assert_not_called()
+        e.microk8s.remove_nodes.assert_not_called()
 
     assert e.harness.charm.unit.status == ops.model.ActiveStatus("fakestatus")
 
@@ -219,9 +224,10 @@ def test_follower_become_leader_remove_already_departed_nodes(e: Environment, be
 
     e.harness.set_leader(become_leader)
     if become_leader:
-        assert sorted(e.microk8s.remove_node.mock_calls) == [mock.call("f-1"), mock.call("f-2")]
+        removed = [h for c in e.microk8s.remove_nodes.mock_calls for h in c.args[0]]
+        assert sorted(removed) == ["f-1", "f-2"]
     else:
-        e.microk8s.remove_node.assert_not_called()
+        e.microk8s.remove_nodes.assert_not_called()
 
     assert e.harness.charm.unit.status == ops.model.ActiveStatus("fakestatus")
 
@@ -349,3 +355,398 @@ def test_cos_agent_relation(e: Environment, is_leader: bool):
             assert data["metrics_key"] == "fakekey2"
     else:
         e.metrics.get_tls_auth.assert_not_called()
+
+
+@pytest.mark.parametrize("is_leader", (True, False))
+def test_publish_node_status(e: Environment, is_leader: bool):
+    e.microk8s.get_node_statuses.return_value = {
+        "fakehostname": {"ready": True, "reason": "KubeletReady"},
+        "f-1": {"ready": False, "reason": "KubeletNotReady"},
+    }
+
+    e.harness.add_network("10.10.10.10")
+    e.harness.update_config({"role": "control-plane"})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+    e.harness.set_leader(is_leader)
+
+    worker_rel_id = e.harness.add_relation("workers", "microk8s-worker")
+    e.harness.add_relation_unit(worker_rel_id, "microk8s-worker/0")
+    peer_rel_id = e.harness.model.get_relation("peer").id
+
+    e.microk8s.get_unit_status.reset_mock()
+    e.microk8s.get_node_statuses.reset_mock()
+    e.harness.charm.on.update_status.emit()
+
+    peer_data = e.harness.get_relation_data(peer_rel_id, e.harness.charm.app.name)
+    workers_data = e.harness.get_relation_data(worker_rel_id, e.harness.charm.app.name)
+    if not is_leader:
+        e.microk8s.get_node_statuses.assert_not_called()
+        assert "node_status" not in workers_data
+        return
+
+    e.microk8s.get_node_statuses.assert_called_once_with()
+    for data in (peer_data, workers_data):
+        digest = json.loads(data["node_status"])
+        assert digest["nodes"] == e.microk8s.get_node_statuses.return_value
+        assert digest["max_age"] == 3600
+        assert time.time() - digest["timestamp"] < 60
+
+    # leader reads its own status from the digest
+    e.microk8s.get_unit_status.assert_not_called()
+    assert e.harness.charm.unit.status == ops.model.ActiveStatus("node is ready")
+
+    # digest is not republished if nothing changed
+    old_node_status = peer_data["node_status"]
+    e.harness.charm.on.update_status.emit()
+    assert peer_data["node_status"] == old_node_status
+
+    # failure to list nodes keeps the previous digest
+    for err in [OSError("connection refused"), ValueError("invalid kubeconfig")]:
+        e.microk8s.get_node_statuses.side_effect = err
+        e.harness.charm.on.update_status.emit()
+        assert peer_data["node_status"] == old_node_status
+    e.microk8s.get_node_statuses.side_effect = None
+
+    # digest is republished when a node changes
+    e.microk8s.get_node_statuses.return_value = {
+        "fakehostname": {"ready": True, "reason": "KubeletReady"},
+        "f-1": {"ready": True, "reason": "KubeletReady"},
+    }
+    e.harness.charm.on.update_status.emit()
+    assert json.loads(peer_data["node_status"])["nodes"]["f-1"]["ready"]
+    assert workers_data["node_status"] == peer_data["node_status"]
+
+    # unchanged digest is refreshed after half of its max age
+    old_node_status = peer_data["node_status"]
+    with mock.patch("time.time", return_value=time.time() + 1700):
+        e.harness.charm.on.update_status.emit()
+    assert peer_data["node_status"] == old_node_status
+    with mock.patch("time.time", return_value=time.time() + 1900):
+        e.harness.charm.on.update_status.emit()
+    assert peer_data["node_status"] != old_node_status
+
+    # digest is removed when disabled
+    e.harness.update_config({"node_status_max_age": 0})
+    e.harness.charm.on.update_status.emit()
+    assert "node_status" not in peer_data
+    assert "node_status" not in workers_data
+
+
+@pytest.mark.parametrize(
+    "digest, expect_query",
+    [
+        ({"nodes": {"fakehostname": {"ready": True, "reason": ""}}}, False),
+        ({"nodes": {"fakehostname": {"ready": False, "reason": "KubeletNotReady"}}}, True),
+        ({"nodes": {"f-1": {"ready": True, "reason": ""}}}, True),
+        ({"nodes": {"fakehostname": {"ready": True, "reason": ""}}, "timestamp": 0}, True),
+    ],
+)
+def test_follower_node_status_digest(e: Environment, digest: dict, expect_query: bool):
+    e.harness.update_config({"role": "control-plane"})
+    e.harness.set_leader(False)
+    e.harness.begin_with_initial_hooks()
+    e.harness.charm._state.joined = True
+
+    rel_id = e.harness.model.get_relation("peer").id
+    digest = {"timestamp": time.time(), **digest}
+    e.harness.update_relation_data(
+        rel_id, e.harness.charm.app.name, {"node_status": json.dumps(digest)}
+    )
+
+    e.microk8s.get_unit_status.reset_mock()
+    e.harness.charm.on.update_status.emit()
+
+    e.microk8s.get_node_statuses.assert_not_called()
+    if expect_query:
+        e.microk8s.get_unit_status.assert_called_once_with("fakehostname")
+        assert e.harness.charm.unit.status == ops.model.ActiveStatus("fakestatus")
+    else:
+        e.microk8s.get_unit_status.assert_not_called()
+        assert e.harness.charm.unit.status == ops.model.ActiveStatus("node is ready")
+
+
+def test_write_local_kubeconfig_fingerprint(e: Environment):
+    e.harness.update_config({"role": "control-plane"})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+
+    assert e.microk8s.write_local_kubeconfig.mock_calls[0] == mock.call(None)
+
+    e.microk8s.write_local_kubeconfig.return_value = "fakefingerprint2"
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.write_local_kubeconfig.assert_called_with("fakefingerprint")
+    assert e.harness.charm._state.kubeconfig_fingerprint == "fakefingerprint2"
+
+
+def test_leader_remove_departed_nodes_failed(e: Environment):
+    e.harness.add_network("10.10.10.10")
+    e.harness.update_config({"role": "control-plane", "node_removal_concurrency": 8})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+
+    prel_id = e.harness.charm.model.get_relation("peer").id
+    e.harness.add_relation_unit(prel_id, f"{e.harness.charm.app.name}/1")
+
+    # all departed nodes are removed at once, failed nodes are kept for the next hook
+    e.microk8s.remove_nodes.return_value = ["f-2"]
+    e.harness.update_relation_data(
+        prel_id, e.harness.charm.app.name, {"remove_nodes": '["f-3", "f-1", "f-2", "fakehostname"]'}
+    )
+    e.harness.remove_relation_unit(prel_id, f"{e.harness.charm.app.name}/1")
+
+    e.microk8s.remove_nodes.assert_called_once_with(["f-1", "f-2", "f-3"], 8)
+    relation_data = e.harness.get_relation_data(prel_id, e.harness.charm.app.name)
+    assert relation_data["remove_nodes"] == '["fakehostname", "f-2"]'
+
+
+@mock.patch("time.time")
+def test_leader_join_token_pool(now: mock.MagicMock, e: Environment):
+    now.return_value = 1000
+    e.harness.add_network("10.10.10.10")
+    e.harness.update_config({"role": "control-plane"})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+
+    # no token is created until nodes join
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.add_node.assert_not_called()
+
+    # a single token is shared by joining nodes
+    prel_id = e.harness.charm.model.get_relation("peer").id
+    wrel_id = e.harness.add_relation("workers", "microk8s-worker")
+    e.harness.add_relation_unit(prel_id, f"{e.harness.charm.app.name}/1")
+    for i in range(5):
+        e.harness.add_relation_unit(wrel_id, f"microk8s-worker/{i}")
+
+    e.microk8s.add_node.assert_called_once_with(charm.JOIN_TOKEN_TTL)
+    for rel_id in [prel_id, wrel_id]:
+        relation_data = e.harness.get_relation_data(rel_id, e.harness.charm.app)
+        assert relation_data["join_url"] == "10.10.10.10:25000/faketoken"
+
+    # token is not rotated while it is valid for long enough
+    now.return_value = 1000 + charm.JOIN_TOKEN_TTL - charm.JOIN_TOKEN_MIN_TTL - 1
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.add_node.assert_called_once()
+
+    # token is rotated before it expires and published to all relations
+    e.microk8s.add_node.return_value = "newtoken"
+    now.return_value = 1000 + charm.JOIN_TOKEN_TTL - charm.JOIN_TOKEN_MIN_TTL + 1
+    e.harness.charm.on.update_status.emit()
+    assert len(e.microk8s.add_node.mock_calls) == 2
+    for rel_id in [prel_id, wrel_id]:
+        relation_data = e.harness.get_relation_data(rel_id, e.harness.charm.app)
+        assert relation_data["join_url"] == "10.10.10.10:25000/newtoken"
+
+
+@mock.patch("time.time")
+def test_leader_join_token_leader_change(now: mock.MagicMock, e: Environment):
+    now.return_value = 1000
+    e.harness.add_network("10.10.10.10")
+    e.harness.update_config({"role": "control-plane"})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+    app = e.harness.charm.app.name
+
+    # a token created by the previous leader, which is still valid for long enough
+    prel_id = e.harness.charm.model.get_relation("peer").id
+    wrel_id = e.harness.add_relation("workers", "microk8s-worker")
+    e.harness.add_relation_unit(prel_id, f"{app}/1")
+    e.harness.set_leader(False)
+    old_token = {"token": "oldtoken", "expires": 1000 + charm.JOIN_TOKEN_TTL, "unit": f"{app}/1"}
+    e.harness.update_relation_data(prel_id, app, {"join_token": json.dumps(old_token)})
+    e.microk8s.add_node.reset_mock()
+
+    # the token is only known to the previous leader, the new leader creates its own
+    e.microk8s.add_node.return_value = "newtoken"
+    e.harness.set_leader(True)
+    e.microk8s.add_node.assert_called_once_with(charm.JOIN_TOKEN_TTL)
+    for rel_id in [prel_id, wrel_id]:
+        relation_data = e.harness.get_relation_data(rel_id, app)
+        assert relation_data["join_url"] == "10.10.10.10:25000/newtoken"
+    join_token = json.loads(e.harness.get_relation_data(prel_id, app)["join_token"])
+    assert join_token["unit"] == e.harness.charm.unit.name
+
+    # the new token is kept
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.add_node.assert_called_once()
+
+
+@mock.patch("time.time")
+def test_leader_schedule_joins(now: mock.MagicMock, e: Environment):
+    now.return_value = 1000
+    e.harness.add_network("10.10.10.10")
+    e.harness.update_config({"role": "control-plane", "join_concurrency": 2})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+
+    rel_id = e.harness.add_relation("workers", "microk8s-worker")
+    for i in range(5):
+        e.harness.add_relation_unit(rel_id, f"microk8s-worker/{i}")
+
+    def admitted():
+        join_slots = e.harness.get_relation_data(rel_id, e.harness.charm.app)["join_slots"]
+        return json.loads(join_slots)["admitted"]
+
+    # only join_concurrency workers are admitted
+    assert admitted() == {"microk8s-worker/0": 1000, "microk8s-worker/1": 1000}
+
+    # workers that joined free their slot
+    now.return_value = 1010
+    e.harness.update_relation_data(rel_id, "microk8s-worker/0", {"joined": "true"})
+    assert admitted() == {"microk8s-worker/1": 1000, "microk8s-worker/2": 1010}
+
+    # workers that do not join within the window do not hold their slot
+    now.return_value = 1000 + charm.JOIN_SLOT_WINDOW
+    e.harness.charm.on.update_status.emit()
+    assert admitted() == {
+        "microk8s-worker/1": 1000,
+        "microk8s-worker/2": 1010,
+        "microk8s-worker/3": 1000 + charm.JOIN_SLOT_WINDOW,
+    }
+
+    # no limit
+    e.harness.update_config({"join_concurrency": 0})
+    e.harness.charm.on.update_status.emit()
+    assert sorted(admitted()) == [f"microk8s-worker/{i}" for i in range(1, 5)]
+
+    # negative values are rejected
+    e.harness.update_config({"join_concurrency": -1})
+    assert e.harness.charm.unit.status == ops.model.BlockedStatus(
+        "join_concurrency must not be negative"
+    )
+    assert sorted(admitted()) == [f"microk8s-worker/{i}" for i in range(1, 5)]
+
+
+def fake_drain(e: Environment, status: str = "done") -> dict:
+    """fake background drains, started drains report status. returns the drain statuses"""
+    drains = {}
+    e.microk8s.start_drain_node.side_effect = lambda h: drains.__setitem__(h, status)
+    e.microk8s.get_drain_node_status.side_effect = drains.get
+    e.microk8s.clear_drain_node.side_effect = lambda h: drains.pop(h, None)
+    return drains
+
+
+def test_leader_rolling_upgrade(e: Environment):
+    e.harness.add_network("10.10.10.10")
+    e.harness.update_config({"role": "control-plane", "upgrade_batch_size": 2})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+    app = e.harness.charm.app.name
+
+    prel_id = e.harness.charm.model.get_relation("peer").id
+    for i in [1, 2]:
+        e.harness.add_relation_unit(prel_id, f"{app}/{i}")
+        e.harness.update_relation_data(prel_id, f"{app}/{i}", {"hostname": f"f-{i}"})
+    wrel_id = e.harness.add_relation("workers", "microk8s-worker")
+    for i in [0, 1, 2]:
+        e.harness.add_relation_unit(wrel_id, f"microk8s-worker/{i}")
+        e.harness.update_relation_data(wrel_id, f"microk8s-worker/{i}", {"hostname": f"w-{i}"})
+
+    def set_upgrade(rel_id: int, units: list, state: str):
+        for unit in units:
+            e.harness.update_relation_data(rel_id, unit, {"upgrade": state})
+
+    def admitted(rel_id: int) -> list:
+        data = e.harness.get_relation_data(rel_id, app)
+        return sorted(json.loads(data.get("upgrade_admitted", "{}")))
+
+    # nodes are drained in the background before they are admitted
+    drains = fake_drain(e, "running")
+    set_upgrade(prel_id, [f"{app}/1", f"{app}/2"], "pending")
+    set_upgrade(wrel_id, [f"microk8s-worker/{i}" for i in [0, 1, 2]], "pending")
+    e.microk8s.start_drain_node.assert_called_once_with("f-1")
+    assert admitted(prel_id) == []
+
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.start_drain_node.assert_called_once_with("f-1")
+    assert admitted(prel_id) == []
+
+    drains["f-1"] = "done"
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.clear_drain_node.assert_called_once_with("f-1")
+    assert admitted(prel_id) == [f"{app}/1"]
+    assert admitted(wrel_id) == []
+
+    fake_drain(e)
+    e.microk8s.start_drain_node.reset_mock()
+
+    # the leader waits for the control plane node in flight
+    e.harness.charm.on.upgrade_charm.emit()
+    e.microk8s.upgrade.assert_not_called()
+    e.microk8s.start_drain_node.assert_not_called()
+
+    # control plane nodes are upgraded one at a time, the leader in its own hook
+    set_upgrade(prel_id, [f"{app}/1"], "done")
+    e.microk8s.start_drain_node.assert_called_once_with("fakehostname")
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.upgrade.assert_called_once_with(None, None)
+    assert e.harness.get_relation_data(prel_id, e.harness.charm.unit)["upgrade"] == "done"
+    assert e.microk8s.uncordon_node.mock_calls == [mock.call("f-1"), mock.call("fakehostname")]
+    e.harness.charm.on.update_status.emit()
+    assert admitted(prel_id) == [f"{app}/2"]
+    assert admitted(wrel_id) == []
+
+    set_upgrade(prel_id, [f"{app}/2"], "done")
+    e.microk8s.uncordon_node.assert_called_with("f-2")
+    assert admitted(prel_id) == []
+
+    # workers are upgraded in batches after all control plane nodes
+    e.harness.charm.on.update_status.emit()
+    assert admitted(wrel_id) == ["microk8s-worker/0", "microk8s-worker/1"]
+    assert e.microk8s.start_drain_node.mock_calls == [
+        mock.call("fakehostname"),
+        mock.call("f-2"),
+        mock.call("w-0"),
+        mock.call("w-1"),
+    ]
+
+    set_upgrade(wrel_id, ["microk8s-worker/1"], "done")
+    e.microk8s.uncordon_node.assert_called_with("w-1")
+    e.harness.charm.on.update_status.emit()
+    assert admitted(wrel_id) == ["microk8s-worker/0", "microk8s-worker/2"]
+
+    set_upgrade(wrel_id, ["microk8s-worker/0", "microk8s-worker/2"], "done")
+    assert admitted(wrel_id) == []
+    assert len(e.microk8s.uncordon_node.mock_calls) == 6
+
+
+def test_leader_upgrade_charm_only(e: Environment):
+    e.harness.add_network("10.10.10.10")
+    e.harness.update_config({"role": "control-plane"})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+    app = e.harness.charm.app.name
+
+    prel_id = e.harness.charm.model.get_relation("peer").id
+    e.harness.add_relation_unit(prel_id, f"{app}/1")
+    e.harness.update_relation_data(prel_id, f"{app}/1", {"hostname": "f-1"})
+
+    # the snap does not change, nodes are not drained
+    e.microk8s.snap_channel_changed.return_value = False
+    e.harness.charm.on.upgrade_charm.emit()
+    e.microk8s.upgrade.assert_called_once_with(None, None)
+    e.microk8s.start_drain_node.assert_not_called()
+    assert "upgrade" not in e.harness.get_relation_data(prel_id, e.harness.charm.unit)
+
+
+def test_leader_rolling_upgrade_drain_failed(e: Environment):
+    e.harness.add_network("10.10.10.10")
+    e.harness.update_config({"role": "control-plane"})
+    e.harness.set_leader(True)
+    e.harness.begin_with_initial_hooks()
+    app = e.harness.charm.app.name
+
+    prel_id = e.harness.charm.model.get_relation("peer").id
+    e.harness.add_relation_unit(prel_id, f"{app}/1")
+    e.harness.update_relation_data(prel_id, f"{app}/1", {"hostname": "f-1"})
+
+    # node is not admitted until it is drained, failed drains are started again
+    e.microk8s.get_drain_node_status.return_value = "failed"
+    e.harness.update_relation_data(prel_id, f"{app}/1", {"upgrade": "pending"})
+    assert e.harness.get_relation_data(prel_id, app)["upgrade_admitted"] == "{}"
+    e.microk8s.start_drain_node.assert_called_once_with("f-1")
+
+    e.microk8s.get_drain_node_status.return_value = "done"
+    e.harness.charm.on.update_status.emit()
+    assert f"{app}/1" in json.loads(e.harness.get_relation_data(prel_id, app)["upgrade_admitted"])
@@ -2,6 +2,9 @@
 # Copyright 2023 Canonical, Ltd.
 #
 
+import json
+import time
+
 import ops
 import ops.testing
 import pytest
@@ -13,7 +16,7 @@ def test_install(e: Environment):
     e.harness.begin_with_initial_hooks()
 
     e.util.install_required_packages.assert_called_once_with()
-    e.microk8s.install.assert_called_once_with()
+    e.microk8s.install.assert_called_once_with(None, None)
     e.microk8s.wait_ready.assert_called_once_with()
     e.microk8s.write_local_kubeconfig.assert_not_called()
 
@@ -51,7 +54,7 @@ def test_control_plane_relation(e: Environment, is_leader: bool):
     e.microk8s.install.reset_mock()
     rel_id = e.harness.add_relation("control-plane", "microk8s-cp")
     e.harness.add_relation_unit(rel_id, "microk8s-cp/0")
-    e.microk8s.install.assert_called_once_with()
+    e.microk8s.install.assert_called_once_with(None, None)
     e.microk8s.write_local_kubeconfig.assert_not_called()
 
 
@@ -138,3 +141,167 @@ def test_build_scrape_configs(e: Environment, role: str, is_leader: bool, has_jo
             "fakecrt", "fakekey", False, "fakehostname"
         )
         assert result == e.metrics.build_scrape_jobs.return_value
+
+
+def test_node_status_digest(e: Environment):
+    e.harness.update_config({"role": "worker"})
+    e.harness.begin_with_initial_hooks()
+
+    rel_id = e.harness.add_relation("control-plane", "microk8s-cp")
+    e.harness.add_relation_unit(rel_id, "microk8s-cp/0")
+    e.harness.update_relation_data(rel_id, "microk8s-cp", {"join_url": "fakejoinurl"})
+
+    digest = {"timestamp": time.time(), "nodes": {"fakehostname": {"ready": True, "reason": ""}}}
+    e.harness.update_relation_data(rel_id, "microk8s-cp", {"node_status": json.dumps(digest)})
+
+    e.microk8s.get_unit_status.reset_mock()
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.get_unit_status.assert_not_called()
+    assert e.harness.charm.unit.status == ops.model.ActiveStatus("node is ready")
+
+    # digest is recent according to its own max age
+    digest["timestamp"], digest["max_age"] = time.time() - 1200, 3600
+    e.harness.update_relation_data(rel_id, "microk8s-cp", {"node_status": json.dumps(digest)})
+    e.microk8s.get_unit_status.reset_mock()
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.get_unit_status.assert_not_called()
+
+    # stale digest, query node status directly
+    digest["timestamp"] = time.time() - 3601
+    e.harness.update_relation_data(rel_id, "microk8s-cp", {"node_status": json.dumps(digest)})
+    e.microk8s.get_unit_status.reset_mock()
+    e.harness.charm.on.update_status.emit()
+    e.microk8s.get_unit_status.assert_called_once_with("fakehostname")
+    assert e.harness.charm.unit.status == ops.model.ActiveStatus("fakestatus")
+
+
+def test_join_slot(e: Environment):
+    e.harness.update_config({"role": "worker"})
+    e.harness.begin_with_initial_hooks()
+
+    rel_id = e.harness.add_relation("control-plane", "microk8s-cp")
+    e.harness.add_relation_unit(rel_id, "microk8s-cp/0")
+
+    # wait until the control plane admits the unit
+    join_slots = {"limit": 1, "window": 300, "admitted": {"microk8s/1": 1000}}
+    e.harness.update_relation_data(
+        rel_id, "microk8s-cp", {"join_url": "fakejoinurl", "join_slots": json.dumps(join_slots)}
+    )
+    e.microk8s.join.assert_not_called()
+    assert e.harness.charm.unit.status == ops.model.WaitingStatus("waiting for join slot")
+
+    join_slots["admitted"][e.harness.charm.unit.name] = 1000
+    e.harness.update_relation_data(rel_id, "microk8s-cp", {"join_slots": json.dumps(join_slots)})
+    e.microk8s.join.assert_called_once_with("fakejoinurl", True)
+    assert e.harness.get_relation_data(rel_id, e.harness.charm.unit)["joined"] == "true"
+
+
+def test_joined_before_upgrade(e: Environment):
+    e.harness.update_config({"role": "worker"})
+    e.harness.begin_with_initial_hooks()
+
+    # unit joined with a charm revision that did not publish "joined"
+    rel_id = e.harness.add_relation("control-plane", "microk8s-cp")
+    e.harness.add_relation_unit(rel_id, "microk8s-cp/0")
+    e.harness.charm._state.joined = True
+    assert "joined" not in e.harness.get_relation_data(rel_id, e.harness.charm.unit)
+
+    e.harness.charm.on.upgrade_charm.emit()
+    assert e.harness.get_relation_data(rel_id, e.harness.charm.unit)["joined"] == "true"
+    e.microk8s.join.assert_not_called()
+
+
+@pytest.mark.parametrize("scheduled", [True, False])
+def test_rolling_upgrade(e: Environment, scheduled: bool):
+    e.harness.update_config({"role": "worker"})
+    e.harness.begin_with_initial_hooks()
+
+    rel_id = e.harness.add_relation("control-plane", "microk8s-cp")
+    e.harness.add_relation_unit(rel_id, "microk8s-cp/0")
+    cp_data = {"join_url": "fakejoinurl"}
+    if scheduled:
+        cp_data["upgrade_admitted"] = "{}"
+    e.harness.update_relation_data(rel_id, "microk8s-cp", cp_data)
+    assert e.harness.charm._state.joined
+
+    e.microk8s.set_containerd_proxy_options.reset_mock()
+    e.harness.charm.on.upgrade_charm.emit()
+    unit_data = e.harness.get_relation_data(rel_id, e.harness.charm.unit)
+    if scheduled:
+        # wait for the control plane to admit the upgrade
+        e.microk8s.upgrade.assert_not_called()
+        assert unit_data["upgrade"] == "pending"
+        assert e.harness.charm.unit.status == ops.model.WaitingStatus("waiting for upgrade slot")
+
+        admitted = {e.harness.charm.unit.name: 1000}
+        e.harness.update_relation_data(
+            rel_id, "microk8s-cp", {"upgrade_admitted": json.dumps(admitted)}
+        )
+
+    e.microk8s.upgrade.assert_called_once_with(None, None)
+    assert unit_data["upgrade"] == "done"
+
+    # configuration is re-applied after the upgrade, also when it ran in a later hook
+    e.microk8s.set_containerd_proxy_options.assert_called_once_with("", "", "")
+
+
+def test_upgrade_charm_only(e: Environment):
+    e.harness.update_config({"role": "worker"})
+    e.harness.begin_with_initial_hooks()
+
+    rel_id = e.harness.add_relation("control-plane", "microk8s-cp")
+    e.harness.add_relation_unit(rel_id, "microk8s-cp/0")
+    e.harness.update_relation_data(
+        rel_id, "microk8s-cp", {"join_url": "fakejoinurl", "upgrade_admitted": "{}"}
+    )
+
+    # the snap does not change, no need to wait for the control plane to drain the node
+    e.microk8s.snap_channel_changed.return_value = False
+    e.harness.charm.on.upgrade_charm.emit()
+    e.microk8s.upgrade.assert_called_once_with(None, None)
+    assert "upgrade" not in e.harness.get_relation_data(rel_id, e.harness.charm.unit)
+
+
+def test_upgrade_snap_resource(e: Environment):
+    e.harness.update_config({"role": "worker"})
+    e.harness.add_resource("microk8s-snap", "fakesnap")
+    e.harness.begin_with_initial_hooks()
+    assert e.harness.charm._state.snap_file_digest == "fakedigest"
+
+    rel_id = e.harness.add_relation("control-plane", "microk8s-cp")
+    e.harness.add_relation_unit(rel_id, "microk8s-cp/0")
+    e.harness.update_relation_data(
+        rel_id, "microk8s-cp", {"join_url": "fakejoinurl", "upgrade_admitted": "{}"}
+    )
+
+    # same snap file
+    e.harness.charm.on.upgrade_charm.emit()
+    e.microk8s.upgrade.assert_called_once()
+    assert "upgrade" not in e.harness.get_relation_data(rel_id, e.harness.charm.unit)
+
+    # a new snap file is rolled out by the control plane
+    e.microk8s.upgrade.reset_mock()
+    e.microk8s.snap_file_digest.return_value = "newdigest"
+    e.harness.charm.on.upgrade_charm.emit()
+    e.microk8s.upgrade.assert_not_called()
+    assert e.harness.get_relation_data(rel_id, e.harness.charm.unit)["upgrade"] == "pending"
+
+
+def test_rolling_upgrade_wait_node_ready(e: Environment):
+    e.harness.update_config({"role": "worker", "node_ready_timeout": 0})
+    e.harness.begin_with_initial_hooks()
+
+    rel_id = e.harness.add_relation("control-plane", "microk8s-cp")
+    e.harness.add_relation_unit(rel_id, "microk8s-cp/0")
+    e.harness.update_relation_data(rel_id, "microk8s-cp", {"join_url": "fakejoinurl"})
+
+    # the upgrade is not done until the node is ready again
+    e.microk8s.get_unit_status.return_value = ops.model.WaitingStatus("node is not ready")
+    e.harness.charm.on.upgrade_charm.emit()
+    e.microk8s.upgrade.assert_called_once_with(None, None)
+    unit_data = e.harness.get_relation_data(rel_id, e.harness.charm.unit)
+    assert unit_data["upgrade"] == "upgraded"
+
+    e.microk8s.get_unit_status.return_value = ops.model.ActiveStatus("node is ready")
+    e.harness.charm.on.update_status.emit()
+    assert unit_data["upgrade"] == "done"
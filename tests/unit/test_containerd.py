@@ -1,6 +1,7 @@
 #
 # Copyright 2023 Canonical, Ltd.
 #
+import json
 from pathlib import Path
 from unittest import mock
 
@@ -33,46 +34,79 @@ def test_registry_host(snap_data_dir: mock.MagicMock, config: dict, expected_hos
 
 
 @mock.patch("microk8s.snap_data_dir")
-@mock.patch("os.chown")
-@mock.patch("os.chmod")
-def test_registry_certificates(
-    chmod: mock.MagicMock, chown: mock.MagicMock, snap_data_dir: mock.MagicMock, tmp_path: Path
-):
-    snap_data_dir.return_value = tmp_path
+def test_registry_get_config_files(snap_data_dir: mock.MagicMock):
+    snap_data_dir.return_value = Path("snap_data")
     r = containerd.Registry(
         url="https://fakeurl",
         ca_file="dGVzdDA=",
         cert_file="dGVzdDE=",
         key_file="dGVzdDI==",
+        mirrors=[
+            {"url": "http://10.0.0.10:5000"},
+            {"url": "https://mirror.lan", "ca_file": "dGVzdDM=", "cert_file": "dGVzdDQ="},
+        ],
     )
-    assert r.ca_file == "test0"
-    assert r.cert_file == "test1"
-    assert r.key_file == "test2"
 
-    r.ensure_certificates()
+    assert r.get_config_files() == {
+        Path("snap_data/args/certs.d/fakeurl/ca.crt"): "test0",
+        Path("snap_data/args/certs.d/fakeurl/client.crt"): "test1",
+        Path("snap_data/args/certs.d/fakeurl/client.key"): "test2",
+        Path("snap_data/args/certs.d/fakeurl/mirror-1/ca.crt"): "test3",
+        Path("snap_data/args/certs.d/fakeurl/mirror-1/client.crt"): "test4",
+        Path("snap_data/args/certs.d/fakeurl/hosts.toml"): mock.ANY,
+    }
 
-    assert chmod.mock_calls == [
-        mock.call(r.get_ca_file_path(), 0o600),
-        mock.call(r.get_cert_file_path(), 0o600),
-        mock.call(r.get_key_file_path(), 0o600),
-    ]
-    assert chown.mock_calls == [
-        mock.call(r.get_ca_file_path(), 0, 0),
-        mock.call(r.get_cert_file_path(), 0, 0),
-        mock.call(r.get_key_file_path(), 0, 0),
-    ]
-    assert r.get_ca_file_path().read_text() == "test0"
-    assert r.get_cert_file_path().read_text() == "test1"
-    assert r.get_key_file_path().read_text() == "test2"
+    r = containerd.Registry(url="https://fakeurl")
+    assert list(r.get_config_files()) == [Path("snap_data/args/certs.d/fakeurl/hosts.toml")]
 
-    r.ca_file = None
-    r.cert_file = None
-    r.key_file = None
 
-    r.ensure_certificates()
-    assert not r.get_ca_file_path().exists()
-    assert not r.get_cert_file_path().exists()
-    assert not r.get_key_file_path().exists()
+@mock.patch("microk8s.snap_data_dir")
+@mock.patch("os.chown")
+@mock.patch("os.chmod")
+def test_sync_config_files(
+    chmod: mock.MagicMock, chown: mock.MagicMock, snap_data_dir: mock.MagicMock, tmp_path: Path
+):
+    snap_data_dir.return_value = tmp_path
+    certs_dir = tmp_path / "args" / "certs.d"
+
+    # not managed by the charm
+    (certs_dir / "localhost:32000").mkdir(parents=True)
+    (certs_dir / "localhost:32000" / "hosts.toml").write_text("local")
+
+    files = {
+        certs_dir / "one" / "hosts.toml": "one",
+        certs_dir / "one" / "mirror-0" / "ca.crt": "ca",
+        certs_dir / "two" / "hosts.toml": "two",
+    }
+    assert containerd.sync_config_files(files) == list(files)
+    for path, data in files.items():
+        assert path.read_text() == data
+    assert json.loads(containerd.get_manifest_path().read_text()) == {
+        "files": ["one/hosts.toml", "one/mirror-0/ca.crt", "two/hosts.toml"]
+    }
+
+    # unchanged files are not written
+    chmod.reset_mock()
+    assert containerd.sync_config_files(files) == []
+    chmod.assert_not_called()
+
+    # stale files and directories are removed
+    files = {certs_dir / "one" / "hosts.toml": "one-updated"}
+    assert containerd.sync_config_files(files) == [
+        certs_dir / "one" / "hosts.toml",
+        certs_dir / "two" / "hosts.toml",
+        certs_dir / "one" / "mirror-0" / "ca.crt",
+    ]
+    assert (certs_dir / "one" / "hosts.toml").read_text() == "one-updated"
+    assert not (certs_dir / "one" / "mirror-0").exists()
+    assert not (certs_dir / "two").exists()
+    assert (certs_dir / "localhost:32000" / "hosts.toml").read_text() == "local"
+    assert json.loads(containerd.get_manifest_path().read_text()) == {"files": ["one/hosts.toml"]}
+
+    # all registries removed
+    assert containerd.sync_config_files({}) == [certs_dir / "one" / "hosts.toml"]
+    assert not (certs_dir / "one").exists()
+    assert (certs_dir / "localhost:32000").exists()
 
 
 def test_registry_get_auth_config():
@@ -152,6 +186,35 @@ def test_registry_get_auth_config():
                 },
             },
         ),
+        (
+            containerd.Registry(
+                url="https://fakeurl",
+                mirrors=[
+                    {"url": "http://10.0.0.10:5000", "skip_verify": True},
+                    {
+                        "url": "https://mirror.lan",
+                        "capabilities": ["pull"],
+                        "ca_file": "dGVzdA==",
+                        "override_path": True,
+                    },
+                ],
+            ),
+            {
+                "server": "https://fakeurl",
+                "host": {
+                    "http://10.0.0.10:5000": {
+                        "capabilities": ["pull", "resolve"],
+                        "skip_verify": True,
+                    },
+                    "https://mirror.lan": {
+                        "capabilities": ["pull"],
+                        "ca": "snap_data/args/certs.d/fakeurl/mirror-1/ca.crt",
+                        "override_path": True,
+                    },
+                    "https://fakeurl": {"capabilities": ["pull", "resolve"]},
+                },
+            },
+        ),
     ],
 )
 def test_registry_get_hosts_toml(
@@ -160,6 +223,9 @@ def test_registry_get_hosts_toml(
     snap_data_dir.return_value = Path("snap_data")
     assert registry.get_hosts_toml() == hosts_toml
 
+    # containerd tries hosts in the order they appear in hosts.toml
+    assert list(registry.get_hosts_toml()["host"]) == list(hosts_toml["host"])
+
 
 @pytest.mark.parametrize(
     "config",
@@ -168,6 +234,9 @@ def test_registry_get_hosts_toml(
         '{"url": "https://fakeurl"}',
         '[{"url": "not a url"}]',
         '[{"url": "https://fakeurl", "unknown field": "fake value"}]',
+        '[{"url": "https://fakeurl", "mirrors": [{"url": "not a url"}]}]',
+        '[{"url": "https://fakeurl", "mirrors": [{"url": "http://m", "capabilities": ["x"]}]}]',
+        '[{"url": "https://fakeurl", "mirrors": [{"url": "http://m", "unknown": "value"}]}]',
     ],
 )
 def test_parse_registries_exception(config: str):
@@ -187,18 +256,15 @@ def test_parse_registries():
 
 
 @mock.patch("microk8s.snap_data_dir")
-@mock.patch("util.ensure_call")
+@mock.patch("microk8s.schedule_restart")
 @mock.patch("util.ensure_file")
-@pytest.mark.parametrize("changed", [True, False])
 def test_ensure_registry_configs_auth_config(
     ensure_file: mock.MagicMock,
-    ensure_call: mock.MagicMock,
+    schedule_restart: mock.MagicMock,
     snap_data_dir: mock.MagicMock,
     tmp_path: Path,
-    changed: bool,
 ):
     snap_data_dir.return_value = tmp_path
-    ensure_file.return_value = changed
 
     registries = [
         containerd.Registry(
@@ -223,12 +289,13 @@ def test_ensure_registry_configs_auth_config(
         ),
     ]
 
-    containerd.ensure_registry_configs([])
+    assert containerd.ensure_registry_configs([]) == containerd.APPLY_NONE
     ensure_file.assert_not_called()
-    ensure_call.assert_not_called()
+    schedule_restart.assert_not_called()
 
-    containerd.ensure_registry_configs(registries)
+    result = containerd.ensure_registry_configs(registries)
 
+    # the template is written before the manifest that records its owned keys
     assert ensure_file.mock_calls == [
         mock.call(registries[0].get_hosts_toml_path(), mock.ANY, 0o600, 0, 0),
         mock.call(registries[1].get_ca_file_path(), mock.ANY, 0o600, 0, 0),
@@ -236,10 +303,12 @@ def test_ensure_registry_configs_auth_config(
         mock.call(registries[1].get_key_file_path(), mock.ANY, 0o600, 0, 0),
         mock.call(registries[1].get_hosts_toml_path(), mock.ANY, 0o600, 0, 0),
         mock.call(registries[2].get_hosts_toml_path(), mock.ANY, 0o600, 0, 0),
+        mock.call(containerd.get_manifest_path(), mock.ANY, 0o600, 0, 0),
         mock.call(tmp_path / "args" / "containerd-template.toml", mock.ANY, 0o600, 0, 0),
+        mock.call(containerd.get_template_manifest_path(), mock.ANY, 0o600, 0, 0),
     ]
 
-    containerd_toml = tomli.loads(ensure_file.mock_calls[6].args[1])
+    containerd_toml = tomli.loads(ensure_file.mock_calls[-2].args[1])
     assert containerd_toml["plugins"]["io.containerd.grpc.v1.cri"]["registry"]["configs"] == {
         "registry-1.docker.io": {
             "auth": {
@@ -249,7 +318,201 @@ def test_ensure_registry_configs_auth_config(
         },
     }
 
-    if changed:
-        ensure_call.assert_called_once_with(["snap", "restart", "microk8s.daemon-containerd"])
-    else:
-        ensure_call.assert_not_called()
+    schedule_restart.assert_called_once_with("microk8s.daemon-containerd")
+    assert result == containerd.APPLY_RESTART
+
+
+@mock.patch("microk8s.snap_data_dir")
+@mock.patch("microk8s.schedule_restart")
+@mock.patch("os.chown")
+@mock.patch("os.chmod")
+def test_ensure_registry_configs_live(
+    chmod: mock.MagicMock,
+    chown: mock.MagicMock,
+    schedule_restart: mock.MagicMock,
+    snap_data_dir: mock.MagicMock,
+    tmp_path: Path,
+):
+    snap_data_dir.return_value = tmp_path
+    containerd_toml_path = tmp_path / "args" / "containerd-template.toml"
+    containerd_toml_path.parent.mkdir(parents=True)
+    containerd_toml_path.write_text("[plugins]\n")
+
+    # hosts.toml and certificates are reloaded by containerd
+    registry = containerd.Registry(url="https://fakeurl", mirrors=[{"url": "http://mirror"}])
+    assert containerd.ensure_registry_configs([registry]) == containerd.APPLY_LIVE
+    registry.mirrors[0].skip_verify = True
+    assert containerd.ensure_registry_configs([registry]) == containerd.APPLY_LIVE
+    assert containerd.ensure_registry_configs([registry]) == containerd.APPLY_NONE
+    assert containerd_toml_path.read_text() == "[plugins]\n"
+    schedule_restart.assert_not_called()
+
+    # credentials require a restart
+    registry.username, registry.password = "user", "pass"
+    assert containerd.ensure_registry_configs([registry]) == containerd.APPLY_RESTART
+    schedule_restart.assert_called_once_with("microk8s.daemon-containerd")
+    assert "fakeurl" in containerd_toml_path.read_text()
+
+    # credentials are removed along with the registry
+    schedule_restart.reset_mock()
+    assert containerd.ensure_registry_configs([]) == containerd.APPLY_RESTART
+    schedule_restart.assert_called_once_with("microk8s.daemon-containerd")
+    assert "fakeurl" not in containerd_toml_path.read_text()
+    assert not registry.get_hosts_toml_path().exists()
+
+    schedule_restart.reset_mock()
+    assert containerd.ensure_registry_configs([]) == containerd.APPLY_NONE
+    schedule_restart.assert_not_called()
+
+
+@mock.patch("microk8s.snap_data_dir")
+@mock.patch("microk8s.schedule_restart")
+@mock.patch("os.chown")
+@mock.patch("os.chmod")
+def test_ensure_registry_configs_other_hosts(
+    chmod: mock.MagicMock,
+    chown: mock.MagicMock,
+    schedule_restart: mock.MagicMock,
+    snap_data_dir: mock.MagicMock,
+    tmp_path: Path,
+):
+    snap_data_dir.return_value = tmp_path
+    containerd_toml_path = tmp_path / "args" / "containerd-template.toml"
+    containerd_toml_path.parent.mkdir(parents=True)
+    containerd_toml_path.write_text(
+        """
+[plugins."io.containerd.grpc.v1.cri".registry.configs."other".auth]
+username = "other"
+"""
+    )
+
+    def configs() -> dict:
+        cri = tomli.loads(containerd_toml_path.read_text())["plugins"]["io.containerd.grpc.v1.cri"]
+        return cri["registry"]["configs"]
+
+    # credentials of hosts that are not configured by the charm are kept
+    registry = containerd.Registry(url="https://fakeurl", username="user", password="pass")
+    assert containerd.ensure_registry_configs([registry]) == containerd.APPLY_RESTART
+    assert configs() == {
+        "other": {"auth": {"username": "other"}},
+        "fakeurl": {"auth": {"username": "user", "password": "pass"}},
+    }
+
+    assert containerd.ensure_registry_configs([]) == containerd.APPLY_RESTART
+    assert configs() == {"other": {"auth": {"username": "other"}}}
+
+
+@mock.patch("microk8s.snap_data_dir")
+@mock.patch("os.chown")
+@mock.patch("os.chmod")
+def test_ensure_template_config(
+    chmod: mock.MagicMock, chown: mock.MagicMock, snap_data_dir: mock.MagicMock, tmp_path: Path
+):
+    snap_data_dir.return_value = tmp_path
+    path = containerd.get_template_path()
+    path.parent.mkdir(parents=True)
+    path.write_text(
+        """
+[plugins."io.containerd.grpc.v1.cri"]
+  sandbox_image = "registry.k8s.io/pause:3.7"
+
+[plugins."io.containerd.grpc.v1.cri".registry]
+  config_path = "${SNAP_DATA}/args/certs.d"
+
+# begin managed by microk8s charm
+[plugins."io.containerd.grpc.v1.cri".registry.configs."old".auth]
+username = "old"
+# end managed by microk8s charm
+"""
+    )
+
+    configs_key = (*containerd.CRI_PLUGIN, "registry", "configs")
+    configs = {"fakeurl": {"auth": {"username": "user", "password": "pass"}}}
+
+    # legacy text block is replaced, existing tables are merged
+    assert containerd.ensure_template_config("registries", {configs_key: configs})
+    cri = tomli.loads(path.read_text())["plugins"]["io.containerd.grpc.v1.cri"]
+    assert cri == {
+        "sandbox_image": "registry.k8s.io/pause:3.7",
+        "registry": {"config_path": "${SNAP_DATA}/args/certs.d", "configs": configs},
+    }
+
+    # formatting and key order do not matter
+    path.write_text("# comment\n" + path.read_text().replace(" = ", "="))
+    assert not containerd.ensure_template_config("registries", {configs_key: configs})
+
+    # keys of other sections are kept
+    assert containerd.ensure_template_config("other", {(*containerd.CRI_PLUGIN, "key"): 1})
+    assert not containerd.ensure_template_config("other", {(*containerd.CRI_PLUGIN, "key"): 1})
+
+    # keys no longer owned are removed
+    assert containerd.ensure_template_config("registries", {})
+    cri = tomli.loads(path.read_text())["plugins"]["io.containerd.grpc.v1.cri"]
+    assert cri == {
+        "sandbox_image": "registry.k8s.io/pause:3.7",
+        "registry": {"config_path": "${SNAP_DATA}/args/certs.d"},
+        "key": 1,
+    }
+
+    # invalid template
+    path.write_text("not = valid = toml")
+    with pytest.raises(ValueError):
+        containerd.ensure_template_config("registries", {configs_key: configs})
+
+
+@mock.patch("microk8s.snap_data_dir")
+@mock.patch("microk8s.schedule_restart")
+@mock.patch("os.chown")
+@mock.patch("os.chmod")
+def test_ensure_performance_config(
+    chmod: mock.MagicMock,
+    chown: mock.MagicMock,
+    schedule_restart: mock.MagicMock,
+    snap_data_dir: mock.MagicMock,
+    tmp_path: Path,
+):
+    snap_data_dir.return_value = tmp_path
+    path = containerd.get_template_path()
+    path.parent.mkdir(parents=True)
+    path.write_text(
+        """
+[plugins."io.containerd.grpc.v1.cri".containerd]
+  snapshotter = "${SNAPSHOTTER}"
+"""
+    )
+
+    # defaults do not change the template
+    assert not containerd.ensure_performance_config()
+    schedule_restart.assert_not_called()
+
+    assert containerd.ensure_performance_config(10, "native", True, -1)
+    schedule_restart.assert_called_once_with("microk8s.daemon-containerd")
+    assert tomli.loads(path.read_text())["plugins"]["io.containerd.grpc.v1.cri"] == {
+        "max_concurrent_downloads": 10,
+        "max_container_log_line_size": -1,
+        "containerd": {"snapshotter": "native", "discard_unpacked_layers": True},
+    }
+
+    schedule_restart.reset_mock()
+    assert not containerd.ensure_performance_config(10, "native", True, -1)
+    schedule_restart.assert_not_called()
+
+    # unset values are removed, the MicroK8s default is restored
+    assert containerd.ensure_performance_config(10)
+    assert tomli.loads(path.read_text())["plugins"]["io.containerd.grpc.v1.cri"] == {
+        "max_concurrent_downloads": 10,
+        "containerd": {"snapshotter": "${SNAPSHOTTER}"},
+    }
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"max_concurrent_downloads": -1},
+        {"snapshotter": "btrfs"},
+        {"max_container_log_line_size": -2},
+    ],
+)
+def test_ensure_performance_config_invalid(kwargs: dict):
+    with pytest.raises(ValueError):
+        containerd.ensure_performance_config(**kwargs)
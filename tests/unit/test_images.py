@@ -0,0 +1,198 @@
+#
+# Copyright 2023 Canonical, Ltd.
+#
+import json
+import os
+import signal
+import subprocess
+import sys
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+import containerd
+import images
+
+
+@pytest.fixture(autouse=True)
+def prepull_dir(tmp_path: Path):
+    with mock.patch("images.prepull_dir", return_value=tmp_path):
+        yield tmp_path
+
+
+@pytest.mark.parametrize(
+    "image, expected",
+    [
+        ("nginx", "docker.io/library/nginx:latest"),
+        ("nginx:1.25", "docker.io/library/nginx:1.25"),
+        ("bitnami/redis", "docker.io/bitnami/redis:latest"),
+        ("docker.io/nginx", "docker.io/library/nginx:latest"),
+        ("registry.k8s.io/pause:3.7", "registry.k8s.io/pause:3.7"),
+        ("localhost:32000/app", "localhost:32000/app:latest"),
+        ("localhost/app:v1", "localhost/app:v1"),
+        ("ghcr.io/org/app@sha256:abcd", "ghcr.io/org/app@sha256:abcd"),
+    ],
+)
+def test_normalize_image(image: str, expected: str):
+    assert images.normalize_image(image) == expected
+
+
+def test_parse_images():
+    assert images.parse_images("") == []
+    assert images.parse_images(" nginx,redis\n  registry.k8s.io/pause:3.7 ") == [
+        "nginx",
+        "redis",
+        "registry.k8s.io/pause:3.7",
+    ]
+
+
+@mock.patch("util.ensure_func")
+@mock.patch("util.ensure_call")
+def test_pull_image(ensure_call: mock.MagicMock, ensure_func: mock.MagicMock):
+    cmd = [
+        "microk8s",
+        "ctr",
+        "--namespace",
+        "k8s.io",
+        "image",
+        "pull",
+        "--hosts-dir",
+        "/var/snap/microk8s/current/args/certs.d",
+    ]
+
+    images.pull_image("docker.io/library/nginx:latest")
+    ensure_call.assert_called_once_with(
+        [*cmd, "docker.io/library/nginx:latest"],
+        capture_output=True,
+        policy=images.PULL_RETRY_POLICY,
+    )
+    ensure_func.assert_not_called()
+    ensure_call.reset_mock()
+
+    # the password is not passed on the command line
+    images.pull_image("registry.example.com/app:latest", "user:pa:ss")
+    ensure_call.assert_not_called()
+    ensure_func.assert_called_once_with(
+        images._run_with_password,
+        [*cmd, "--user", "user", "registry.example.com/app:latest"],
+        "pa:ss",
+        retry_on=subprocess.CalledProcessError,
+        policy=images.PULL_RETRY_POLICY,
+        name="microk8s ctr",
+    )
+
+
+def test_run_with_password():
+    # the password is read from the terminal
+    script = "import sys; print(sys.stdin.isatty() and sys.stdin.readline() == 'secret\\n')"
+    p = images._run_with_password([sys.executable, "-c", script], "secret")
+    assert p.stdout.decode().strip().endswith("True")
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        images._run_with_password([sys.executable, "-c", "raise SystemExit(1)"], "secret")
+    assert "secret" not in str(e.value)
+
+
+@mock.patch("images.pull_image")
+@mock.patch("images.list_images")
+def test_run_prepull(list_images: mock.MagicMock, pull_image: mock.MagicMock):
+    list_images.return_value = {"docker.io/library/nginx:latest"}
+
+    def fake_pull_image(image: str, credentials: str):
+        if image == "docker.io/library/broken:latest":
+            raise subprocess.CalledProcessError(1, "ctr image pull")
+
+    pull_image.side_effect = fake_pull_image
+
+    images.run_prepull(
+        ["nginx", "redis", "registry.example.com/app", "broken", "docker.io/org/app"],
+        {"registry.example.com": "user:pass", "docker.io": "hub:token"},
+    )
+
+    # present images are skipped, normalized references are pulled with the credentials of
+    # their registry
+    assert sorted(pull_image.mock_calls) == [
+        mock.call("docker.io/library/broken:latest", "hub:token"),
+        mock.call("docker.io/library/redis:latest", "hub:token"),
+        mock.call("docker.io/org/app:latest", "hub:token"),
+        mock.call("registry.example.com/app:latest", "user:pass"),
+    ]
+    assert images.get_prepull_progress() == {
+        "pid": os.getpid(),
+        "total": 5,
+        "pulled": 4,
+        "failed": ["broken"],
+        "done": True,
+    }
+
+
+def test_get_prepull_progress(prepull_dir: Path):
+    assert images.get_prepull_progress() is None
+
+    progress = {"pid": os.getpid(), "total": 2, "pulled": 1, "failed": [], "done": False}
+    (prepull_dir / "progress.json").write_text(json.dumps(progress))
+    assert images.get_prepull_progress() == progress
+
+    # job is no longer running
+    with mock.patch("os.kill", side_effect=ProcessLookupError):
+        assert images.get_prepull_progress()["done"]
+
+
+@mock.patch("os.killpg")
+@mock.patch("os.kill")
+@mock.patch("subprocess.Popen")
+@mock.patch("util.ensure_file")
+def test_start_prepull(
+    ensure_file: mock.MagicMock,
+    popen: mock.MagicMock,
+    kill: mock.MagicMock,
+    killpg: mock.MagicMock,
+    prepull_dir: Path,
+):
+    # running job is stopped, including the pulls it started
+    progress = {"pid": 1234, "total": 2, "pulled": 1, "failed": [], "done": False}
+    (prepull_dir / "progress.json").write_text(json.dumps(progress))
+    (prepull_dir / "job.json").write_text("{}")
+
+    registries = containerd.parse_registries(
+        json.dumps(
+            [
+                {"url": "https://registry.example.com", "username": "user", "password": "pass"},
+                {"url": "https://mirror.example.com"},
+            ]
+        )
+    )
+    images.start_prepull(["nginx"], registries)
+
+    killpg.assert_called_once_with(1234, signal.SIGTERM)
+    assert not (prepull_dir / "progress.json").exists()
+    assert not (prepull_dir / "job.json").exists()
+    ensure_file.assert_called_once_with(
+        prepull_dir / "job.json",
+        json.dumps({"images": ["nginx"], "credentials": {"registry.example.com": "user:pass"}}),
+        0o600,
+        0,
+        0,
+    )
+    assert popen.mock_calls[0].args[0] == [
+        sys.executable,
+        images.__file__,
+        (prepull_dir / "job.json").as_posix(),
+    ]
+    assert popen.mock_calls[0].kwargs["start_new_session"]
+
+    # no images, no job
+    popen.reset_mock()
+    images.start_prepull([], [])
+    popen.assert_not_called()
+
+
+@mock.patch("images.run_prepull")
+def test_run_prepull_job(run_prepull: mock.MagicMock, prepull_dir: Path):
+    job = {"images": ["nginx"], "credentials": {"docker.io": "user:pass"}}
+    (prepull_dir / "job.json").write_text(json.dumps(job))
+
+    images.run_prepull_job(prepull_dir / "job.json")
+    run_prepull.assert_called_once_with(["nginx"], {"docker.io": "user:pass"})
+    assert not (prepull_dir / "job.json").exists()
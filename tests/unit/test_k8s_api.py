@@ -0,0 +1,221 @@
+#
+# Copyright 2023 Canonical, Ltd.
+#
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+import k8s_api
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    """stand-in for the Kubernetes API server. replies with canned responses"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeApiHandler)
+        self.responses = {}
+        self.requests = []
+        self.connections = 0
+        self.close_connections = False
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        self.server.requests.append((self.command, self.path, dict(self.headers), body))
+
+        status, response = self.server.responses.get((self.command, self.path), (404, {}))
+        data = response if isinstance(response, bytes) else json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.close_connection = self.server.close_connections
+
+    do_GET = do_POST = do_PATCH = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    s = FakeApiServer()
+    thread = threading.Thread(target=s.serve_forever, daemon=True)
+    thread.start()
+
+    yield s
+
+    s.shutdown()
+    s.server_close()
+
+
+@pytest.fixture
+def kubeconfig(server: FakeApiServer, tmp_path: Path) -> Path:
+    path = tmp_path / "kubelet.config"
+    path.write_text(
+        f"""
+apiVersion: v1
+clusters:
+- cluster:
+    server: {server.url}
+  name: microk8s-cluster
+contexts:
+- context:
+    cluster: microk8s-cluster
+    user: kubelet
+  name: microk8s
+current-context: microk8s
+kind: Config
+users:
+- name: kubelet
+  user:
+    token: faketoken
+"""
+    )
+    return path
+
+
+@pytest.mark.parametrize(
+    "args, expected",
+    [
+        (("v1", "Node", "node-1"), "/api/v1/nodes/node-1"),
+        (("v1", "Node", None, "default"), "/api/v1/nodes"),
+        (("v1", "Secret", "s", "kube-system"), "/api/v1/namespaces/kube-system/secrets/s"),
+        (("v1", "Secret", None, "kube-system"), "/api/v1/namespaces/kube-system/secrets"),
+        (("apps/v1", "Deployment", "d", "ns"), "/apis/apps/v1/namespaces/ns/deployments/d"),
+        (
+            ("rbac.authorization.k8s.io/v1", "ClusterRole", "r", "ns"),
+            "/apis/rbac.authorization.k8s.io/v1/clusterroles/r",
+        ),
+    ],
+)
+def test_resource_path(args: tuple, expected: str):
+    assert k8s_api.resource_path(*args) == expected
+
+
+def test_client_requests(server: FakeApiServer, kubeconfig: Path):
+    node = {"metadata": {"name": "node-1"}, "status": {"conditions": []}}
+    server.responses = {
+        ("GET", "/api/v1/nodes/node-1"): (200, node),
+        ("GET", "/api/v1/nodes?labelSelector=role%3Dworker"): (200, {"items": [node]}),
+        (
+            "PATCH",
+            "/api/v1/namespaces/ns/serviceaccounts/sa?fieldManager=microk8s-charm&force=true",
+        ): (200, {"kind": "ServiceAccount"}),
+        ("POST", "/api/v1/namespaces/ns/secrets"): (201, {"kind": "Secret"}),
+    }
+
+    client = k8s_api.Client.from_kubeconfig(kubeconfig)
+
+    assert client.get("v1", "Node", "node-1") == node
+    assert client.list("v1", "Node", label_selector="role=worker") == [node]
+    assert client.apply(
+        {
+            "apiVersion": "v1",
+            "kind": "ServiceAccount",
+            "metadata": {"name": "sa", "namespace": "ns"},
+        }
+    ) == {"kind": "ServiceAccount"}
+    assert client.create_secret("s", "ns", {"key": "value"}) == {"kind": "Secret"}
+
+    # all requests are authenticated and share a single connection
+    assert server.connections == 1
+    for _, _, headers, _ in server.requests:
+        assert headers["Authorization"] == "Bearer faketoken"
+
+    _, _, headers, body = server.requests[2]
+    assert headers["Content-Type"] == "application/apply-patch+yaml"
+    assert body["metadata"] == {"name": "sa", "namespace": "ns"}
+
+    _, _, headers, body = server.requests[3]
+    assert headers["Content-Type"] == "application/json"
+    assert body == {
+        "apiVersion": "v1",
+        "kind": "Secret",
+        "metadata": {"name": "s", "namespace": "ns"},
+        "type": "Opaque",
+        "data": {"key": "dmFsdWU="},
+    }
+
+
+def test_client_api_error(server: FakeApiServer, kubeconfig: Path):
+    client = k8s_api.Client.from_kubeconfig(kubeconfig)
+
+    with pytest.raises(k8s_api.ApiError) as e:
+        client.get("v1", "Node", "missing")
+
+    assert e.value.status == 404
+
+
+@pytest.mark.parametrize("response", [b"<html>not json</html>", []])
+def test_client_invalid_response(server: FakeApiServer, kubeconfig: Path, response):
+    server.responses = {("GET", "/api/v1/nodes/node-1"): (200, response)}
+    client = k8s_api.Client.from_kubeconfig(kubeconfig)
+
+    with pytest.raises(ValueError, match="invalid response to GET /api/v1/nodes/node-1"):
+        client.get("v1", "Node", "node-1")
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        "",
+        "not: [valid",
+        "contexts: []\nclusters: []\n",
+        "contexts: [{name: c, context: {cluster: missing}}]\nclusters: []\n",
+        "contexts: [{name: c, context: {cluster: k}}]\nclusters: [{name: k, cluster: {}}]\n",
+        "contexts: [{name: c, context: {cluster: k}}]\n"
+        "clusters: [{name: k, cluster: {server: x, certificate-authority-data: '!'}}]\n",
+    ],
+)
+def test_client_invalid_kubeconfig(tmp_path: Path, data: str):
+    path = tmp_path / "kubeconfig"
+    path.write_text(data)
+
+    with pytest.raises(ValueError, match="invalid kubeconfig"):
+        k8s_api.Client.from_kubeconfig(path)
+
+
+def test_client_reconnect(server: FakeApiServer, kubeconfig: Path):
+    server.responses = {("GET", "/api/v1/nodes/node-1"): (200, {})}
+    client = k8s_api.Client.from_kubeconfig(kubeconfig)
+
+    # server closes connection after responding, client reconnects on next request
+    server.close_connections = True
+    client.get("v1", "Node", "node-1")
+    client.get("v1", "Node", "node-1")
+    assert server.connections == 2
+    assert len(server.requests) == 2
+
+
+def test_client_unreachable(server: FakeApiServer, kubeconfig: Path):
+    client = k8s_api.Client.from_kubeconfig(kubeconfig)
+    server.shutdown()
+    server.server_close()
+
+    with pytest.raises(OSError):
+        client.get("v1", "Node", "node-1")
+
+
+@mock.patch.dict("k8s_api._clients", clear=True)
+@mock.patch("k8s_api.Client.from_kubeconfig")
+def test_get_client_cached(from_kubeconfig: mock.MagicMock):
+    assert k8s_api.get_client(Path("a")) == k8s_api.get_client(Path("a"))
+    from_kubeconfig.assert_called_once_with(Path("a"))
@@ -7,69 +7,69 @@ from unittest import mock
 
 import pytest
 
+import k8s_api
 import metrics
 
 
-@mock.patch("util.ensure_call")
-@mock.patch("util.charm_dir")
-def test_apply_required_resources(charm_dir: mock.MagicMock, ensure_call: mock.MagicMock):
-    charm_dir.return_value = Path("dir")
+@mock.patch("k8s_api.get_client")
+def test_apply_required_resources(get_client: mock.MagicMock):
     metrics.apply_required_resources()
 
-    assert ensure_call.mock_calls == [
-        mock.call(["microk8s", "kubectl", "apply", "-f", "dir/src/deploy/metrics.yaml"]),
-        mock.call(["microk8s", "kubectl", "apply", "-f", "dir/src/deploy/kube-state-metrics.yaml"]),
-    ]
+    get_client.assert_called_once_with(Path("/var/snap/microk8s/current/credentials/client.config"))
+    applied = [c.args[0] for c in get_client.return_value.apply.mock_calls]
+    assert {(obj["kind"], obj["metadata"]["name"]) for obj in applied} == {
+        ("ServiceAccount", "microk8s-observability"),
+        ("ClusterRole", "microk8s-observability"),
+        ("ClusterRoleBinding", "microk8s-observability"),
+        ("ClusterRole", "kube-state-metrics"),
+        ("ClusterRoleBinding", "kube-state-metrics"),
+        ("Deployment", "kube-state-metrics"),
+        ("Role", "microk8s-observability"),
+        ("RoleBinding", "microk8s-observability"),
+        ("Service", "kube-state-metrics"),
+        ("ServiceAccount", "kube-state-metrics"),
+    }
 
 
-@mock.patch("util.run")
-def test_get_tls_auth_existing_secret(run: mock.MagicMock):
-    run.return_value.stdout = b'{"data": {"tls.crt": "ZmFrZWNydA==", "tls.key": "ZmFrZWtleQ=="}}'
+@mock.patch("k8s_api.get_client")
+def test_get_tls_auth_existing_secret(get_client: mock.MagicMock):
+    client = get_client.return_value
+    client.get.return_value = {"data": {"tls.crt": "ZmFrZWNydA==", "tls.key": "ZmFrZWtleQ=="}}
 
     crt, key = metrics.get_tls_auth()
     assert crt == "fakecrt"
     assert key == "fakekey"
 
-    run.assert_called_once_with(
-        [
-            "microk8s",
-            "kubectl",
-            "get",
-            "secret",
-            "--namespace=kube-system",
-            "microk8s-observability-tls",
-            "-o=json",
-        ],
-        capture_output=True,
-    )
+    client.get.assert_called_once_with("v1", "Secret", "microk8s-observability-tls", "kube-system")
+    client.create_secret.assert_not_called()
 
 
 @mock.patch("util.ensure_call")
-@mock.patch("util.run")
+@mock.patch("k8s_api.get_client")
 @mock.patch("util.charm_dir")
 @mock.patch("microk8s.snap_data_dir")
 def test_get_tls_auth_create_secret(
     snap_data_dir: mock.MagicMock,
     charm_dir: mock.MagicMock,
-    run: mock.MagicMock,
+    get_client: mock.MagicMock,
     ensure_call: mock.MagicMock,
+    tmp_path: Path,
 ):
     snap_data_dir.return_value = Path("snapdatadir")
-    charm_dir.return_value = Path("charmdir")
-    run.side_effect = [
-        subprocess.CalledProcessError(1, "fakeerr"),
-        subprocess.CompletedProcess(
-            args=[],
-            returncode=0,
-            stdout=b'{"data": {"tls.crt": "ZmFrZWNydA==", "tls.key": "ZmFrZWtleQ=="}}',
-        ),
+    charm_dir.return_value = tmp_path
+    client = get_client.return_value
+    client.get.side_effect = [
+        k8s_api.ApiError(404, "Not Found"),
+        {"data": {"tls.crt": "ZmFrZWNydA==", "tls.key": "ZmFrZWtleQ=="}},
     ]
 
+    (tmp_path / "metrics.crt").write_text("newcrt")
+    (tmp_path / "metrics.key").write_text("newkey")
+
     ensure_call.side_effect = [
         None,
         subprocess.CompletedProcess(args=[], returncode=0, stdout=b"fakecsr"),
         None,
-        None,
     ]
 
     crt, key = metrics.get_tls_auth()
@@ -77,7 +77,10 @@ def test_get_tls_auth_create_secret(
     assert key == "fakekey"
 
     assert ensure_call.mock_calls == [
-        mock.call(["openssl", "genrsa", "-out", "charmdir/metrics.key", "2048"]),
+        mock.call(
+            ["openssl", "genrsa", "-out", f"{tmp_path}/metrics.key", "2048"],
+            policy=metrics.OPENSSL_RETRY_POLICY,
+        ),
         mock.call(
             [
                 "openssl",
@@ -86,9 +89,10 @@ def test_get_tls_auth_create_secret(
                 "-subj",
                 "/CN=system:serviceaccount:kube-system:microk8s-observability",
                 "-key",
-                "charmdir/metrics.key",
+                f"{tmp_path}/metrics.key",
             ],
             capture_output=True,
+            policy=metrics.OPENSSL_RETRY_POLICY,
         ),
         mock.call(
             [
@@ -104,26 +108,18 @@ def test_get_tls_auth_create_secret(
                 "-days",
                 "3650",
                 "-out",
-                "charmdir/metrics.crt",
+                f"{tmp_path}/metrics.crt",
             ],
             input=b"fakecsr",
-        ),
-        mock.call(
-            [
-                "microk8s",
-                "kubectl",
-                "create",
-                "secret",
-                "tls",
-                "microk8s-observability-tls",
-                "--namespace=kube-system",
-                "--cert",
-                "charmdir/metrics.crt",
-                "--key",
-                "charmdir/metrics.key",
-            ]
+            policy=metrics.OPENSSL_RETRY_POLICY,
         ),
     ]
+    client.create_secret.assert_called_once_with(
+        "microk8s-observability-tls",
+        "kube-system",
+        {"tls.crt": "newcrt", "tls.key": "newkey"},
+        secret_type="kubernetes.io/tls",
+    )
 
 
 @pytest.mark.parametrize(
@@ -1,6 +1,7 @@
 #
 # Copyright 2023 Canonical, Ltd.
 #
+import json
 import subprocess
 from pathlib import Path
 from unittest import mock
@@ -9,14 +10,42 @@ import pytest
 from ops.model import ActiveStatus, MaintenanceStatus, WaitingStatus
 
 import charm_config
+import k8s_api
 import microk8s
 
+STATUS_OUTPUT = """
+microk8s:
+  running: True
+high-availability:
+  enabled: True
+  nodes:
+    - address: 10.0.0.10:19001
+      role: voter
+    - address: 10.0.0.11:19001
+      role: voter
+addons:
+  - name: dns
+    repository: core
+    status: enabled
+  - name: hostpath-storage
+    repository: core
+    status: disabled
+"""
+
+
+@pytest.fixture(autouse=True)
+def status_snapshot():
+    microk8s.invalidate_status()
+    yield
+    microk8s.invalidate_status()
+
 
 @mock.patch("util.ensure_call")
 def test_microk8s_install(ensure_call: mock.MagicMock):
     microk8s.install()
     ensure_call.assert_called_once_with(
-        ["snap", "install", "microk8s", "--classic", "--channel", charm_config.SNAP_CHANNEL]
+        ["snap", "install", "microk8s", "--classic", "--channel", charm_config.SNAP_CHANNEL],
+        policy=microk8s.SNAP_RETRY_POLICY,
     )
 
 
@@ -24,28 +53,256 @@ def test_microk8s_install(ensure_call: mock.MagicMock):
 def test_microk8s_upgrade(ensure_call: mock.MagicMock):
     microk8s.upgrade()
     ensure_call.assert_called_once_with(
-        ["snap", "refresh", "microk8s", "--channel", charm_config.SNAP_CHANNEL]
+        ["snap", "refresh", "microk8s", "--channel", charm_config.SNAP_CHANNEL],
+        policy=microk8s.SNAP_RETRY_POLICY,
+    )
+
+
+@pytest.mark.parametrize("method", ["install", "upgrade"])
+@mock.patch("util.ensure_call")
+def test_microk8s_install_snap_file(ensure_call: mock.MagicMock, method: str):
+    getattr(microk8s, method)(Path("/r/microk8s.snap"), Path("/r/microk8s.assert"))
+    assert ensure_call.mock_calls == [
+        mock.call(["snap", "ack", "/r/microk8s.assert"], policy=microk8s.SNAP_RETRY_POLICY),
+        mock.call(
+            ["snap", "install", "/r/microk8s.snap", "--classic"],
+            policy=microk8s.SNAP_RETRY_POLICY,
+        ),
+    ]
+
+    ensure_call.reset_mock()
+    getattr(microk8s, method)(Path("/r/microk8s.snap"))
+    ensure_call.assert_called_once_with(
+        ["snap", "install", "/r/microk8s.snap", "--classic", "--dangerous"],
+        policy=microk8s.SNAP_RETRY_POLICY,
+    )
+
+
+@mock.patch("util.ensure_call")
+def test_microk8s_import_images(ensure_call: mock.MagicMock):
+    microk8s.import_images(Path("/r/images.tar"))
+    ensure_call.assert_called_once_with(
+        ["microk8s", "ctr", "image", "import", "/r/images.tar"],
+        capture_output=True,
+        policy=microk8s.IMAGE_IMPORT_RETRY_POLICY,
     )
 
 
 @mock.patch("util.ensure_call")
 def test_microk8s_uninstall(ensure_call: mock.MagicMock):
     microk8s.uninstall()
-    ensure_call.assert_called_once_with(["snap", "remove", "microk8s", "--purge"])
+    ensure_call.assert_called_once_with(
+        ["snap", "remove", "microk8s", "--purge"], policy=microk8s.SNAP_RETRY_POLICY
+    )
+
+
+@mock.patch.dict("microk8s._pending_restarts", clear=True)
+@mock.patch("util.ensure_call")
+def test_microk8s_restart_pending_services(ensure_call: mock.MagicMock):
+    microk8s.restart_pending_services()
+    ensure_call.assert_not_called()
+
+    microk8s.schedule_restart("microk8s.daemon-containerd")
+    microk8s.schedule_restart("microk8s.daemon-kubelite")
+    microk8s.schedule_restart("microk8s.daemon-containerd")
+    microk8s.restart_pending_services()
+
+    assert ensure_call.mock_calls == [
+        mock.call(
+            ["snap", "restart", "microk8s.daemon-containerd"],
+            policy=microk8s.RESTART_RETRY_POLICY,
+        ),
+        mock.call(
+            ["snap", "restart", "microk8s.daemon-kubelite"], policy=microk8s.RESTART_RETRY_POLICY
+        ),
+    ]
+
+    # nothing pending after restart
+    ensure_call.reset_mock()
+    microk8s.restart_pending_services()
+    ensure_call.assert_not_called()
+
+    # failed restarts remain pending
+    microk8s.schedule_restart("microk8s.daemon-containerd")
+    ensure_call.side_effect = subprocess.CalledProcessError(1, "snap restart")
+    with pytest.raises(subprocess.CalledProcessError):
+        microk8s.restart_pending_services()
+    assert microk8s._pending_restarts == {"microk8s.daemon-containerd": 1}
 
 
 @mock.patch("util.ensure_call")
 def test_microk8s_wait_ready(ensure_call: mock.MagicMock):
+    ensure_call.return_value.stdout = STATUS_OUTPUT.encode()
+
     microk8s.wait_ready(timeout=5)
     ensure_call.assert_called_once_with(
-        ["microk8s", "status", "--wait-ready", "--timeout=5"], capture_output=True
+        ["microk8s", "status", "--format", "yaml", "--wait-ready", "--timeout=5"],
+        capture_output=True,
     )
 
+    # node is already known to be running
+    microk8s.wait_ready()
+    ensure_call.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "output, expected",
+    [
+        (
+            STATUS_OUTPUT,
+            microk8s.Status(
+                running=True,
+                ha_enabled=True,
+                ha_nodes=("10.0.0.10:19001", "10.0.0.11:19001"),
+                addons={"dns": True, "hostpath-storage": False},
+            ),
+        ),
+        (
+            "microk8s is not running. Use microk8s inspect for a deeper inspection.",
+            microk8s.Status(),
+        ),
+        ("microk8s:\n  running: False\n", microk8s.Status()),
+        ("", microk8s.Status()),
+    ],
+)
+def test_microk8s_status_parse(output: str, expected: microk8s.Status):
+    assert microk8s.Status.parse(output) == expected
+
+
+@mock.patch("time.monotonic")
+@mock.patch("util.ensure_call")
+def test_microk8s_get_status_cache(ensure_call: mock.MagicMock, monotonic: mock.MagicMock):
+    ensure_call.return_value.stdout = STATUS_OUTPUT.encode()
+    monotonic.return_value = 100
+
+    # snapshot is reused
+    assert microk8s.get_status().running
+    assert microk8s.get_status().addons["dns"]
+    ensure_call.assert_called_once_with(
+        ["microk8s", "status", "--format", "yaml"], capture_output=True
+    )
+
+    # snapshot expires
+    ensure_call.reset_mock()
+    monotonic.return_value = 100 + microk8s.STATUS_TTL
+    microk8s.get_status()
+    ensure_call.assert_called_once()
+
+    # snapshot is invalidated by commands that change the node
+    ensure_call.reset_mock()
+    microk8s.remove_node("node-1")
+    microk8s.get_status()
+    assert ensure_call.call_count == 2
+
+    # wait_ready does not trust a snapshot of a stopped node
+    ensure_call.reset_mock()
+    ensure_call.return_value.stdout = b"microk8s is not running"
+    microk8s.invalidate_status()
+    assert not microk8s.get_status().running
+    microk8s.wait_ready()
+    assert ensure_call.call_count == 2
+
 
 @mock.patch("util.ensure_call")
 def test_microk8s_remove_node(ensure_call: mock.MagicMock):
     microk8s.remove_node("node-1")
-    ensure_call.assert_called_once_with(["microk8s", "remove-node", "node-1", "--force"])
+    ensure_call.assert_called_once_with(
+        ["microk8s", "remove-node", "node-1", "--force"], policy=microk8s.REMOVE_NODE_RETRY_POLICY
+    )
+
+
+@mock.patch("microk8s.remove_node")
+def test_microk8s_remove_nodes(remove_node: mock.MagicMock):
+    assert microk8s.remove_nodes([]) == []
+    remove_node.assert_not_called()
+
+    def fake_remove_node(hostname: str):
+        if hostname in ["node-2", "node-4"]:
+            raise subprocess.CalledProcessError(1, "microk8s remove-node")
+
+    remove_node.side_effect = fake_remove_node
+
+    hostnames = [f"node-{i}" for i in range(1, 6)]
+    assert microk8s.remove_nodes(hostnames, max_workers=3) == ["node-2", "node-4"]
+    assert sorted(remove_node.mock_calls) == [mock.call(h) for h in hostnames]
+
+
+@pytest.mark.parametrize(
+    "tracking, channel, changed",
+    [
+        ("latest/edge", "latest/edge", False),
+        ("edge", "latest/edge", False),
+        ("1.28/stable", "1.28", False),
+        ("1.28/stable", "1.29/stable", True),
+        ("latest/edge", "1.28/stable", True),
+        ("-", "latest/edge", True),
+    ],
+)
+@mock.patch("util.run")
+def test_microk8s_snap_channel_changed(
+    run: mock.MagicMock, tracking: str, channel: str, changed: bool
+):
+    run.return_value.stdout = (
+        "Name      Version  Rev   Tracking       Publisher   Notes\n"
+        f"microk8s  v1.28.3  6089  {tracking}    canonical✓  classic\n"
+    ).encode()
+    with mock.patch("charm_config.SNAP_CHANNEL", channel):
+        assert microk8s.snap_channel_changed() == changed
+    run.assert_called_once_with(["snap", "list", "microk8s"], capture_output=True)
+
+    run.side_effect = subprocess.CalledProcessError(1, "snap list")
+    assert microk8s.snap_channel_changed()
+
+
+def test_microk8s_snap_file_digest(tmp_path: Path):
+    (tmp_path / "microk8s.snap").write_bytes(b"fakesnap")
+    assert microk8s.snap_file_digest(tmp_path / "microk8s.snap") == (
+        "e88bc08ef0abb6209fbad189ba564fbbeca300070a6c0b0af5345ec6d6fd27fe"
+    )
+
+
+@mock.patch("os.kill")
+@mock.patch("subprocess.Popen")
+def test_microk8s_drain_node(popen: mock.MagicMock, kill: mock.MagicMock, tmp_path: Path):
+    popen.return_value.pid = 1234
+    with mock.patch("microk8s.drain_dir", return_value=tmp_path / "drain"):
+        assert microk8s.get_drain_node_status("node-1") is None
+
+        microk8s.start_drain_node("node-1", timeout=60)
+        popen.assert_called_once()
+        script = popen.call_args.args[0][2]
+        assert script.startswith(
+            "microk8s kubectl drain node-1 --ignore-daemonsets --delete-emptydir-data"
+            " --timeout=60s; "
+        )
+        assert popen.call_args.kwargs["start_new_session"] is True
+        assert (tmp_path / "drain" / "node-1.pid").read_text() == "1234"
+
+        assert microk8s.get_drain_node_status("node-1") == "running"
+        kill.assert_called_once_with(1234, 0)
+
+        # process went away without recording an exit code
+        kill.side_effect = ProcessLookupError
+        assert microk8s.get_drain_node_status("node-1") == "failed"
+
+        (tmp_path / "drain" / "node-1.rc").write_text("1\n")
+        assert microk8s.get_drain_node_status("node-1") == "failed"
+        (tmp_path / "drain" / "node-1.rc").write_text("0\n")
+        assert microk8s.get_drain_node_status("node-1") == "done"
+
+        # starting a new drain forgets the previous result
+        microk8s.start_drain_node("node-1")
+        kill.side_effect = None
+        assert microk8s.get_drain_node_status("node-1") == "running"
+
+        microk8s.clear_drain_node("node-1")
+        assert microk8s.get_drain_node_status("node-1") is None
+
+
+@mock.patch("util.ensure_call")
+def test_microk8s_uncordon_node(ensure_call: mock.MagicMock):
+    microk8s.uncordon_node("node-1")
+    ensure_call.assert_called_once_with(["microk8s", "kubectl", "uncordon", "node-1"])
 
 
 @mock.patch("util.ensure_call")
@@ -53,11 +310,15 @@ def test_microk8s_join(ensure_call: mock.MagicMock):
     join_url = "10.10.10.10:25000/01010101010101010101010101010101"
 
     microk8s.join(join_url, False)
-    ensure_call.assert_called_once_with(["microk8s", "join", join_url])
+    ensure_call.assert_called_once_with(
+        ["microk8s", "join", join_url], policy=microk8s.JOIN_RETRY_POLICY
+    )
     ensure_call.reset_mock()
 
     microk8s.join(join_url, True)
-    ensure_call.assert_called_once_with(["microk8s", "join", join_url, "--worker"])
+    ensure_call.assert_called_once_with(
+        ["microk8s", "join", join_url, "--worker"], policy=microk8s.JOIN_RETRY_POLICY
+    )
 
 
 @mock.patch("util.ensure_call")
@@ -65,11 +326,11 @@ def test_microk8s_join(ensure_call: mock.MagicMock):
 def test_microk8s_add_node(urandom: mock.MagicMock, ensure_call: mock.MagicMock):
     urandom.return_value = b"\x01" * 16
 
-    token = microk8s.add_node()
+    token = microk8s.add_node(3600)
     assert token == "01010101010101010101010101010101"
     urandom.assert_called_once_with(16)
     ensure_call.assert_called_once_with(
-        ["microk8s", "add-node", "--token", token, "--token-ttl", "7200"]
+        ["microk8s", "add-node", "--token", token, "--token-ttl", "3600"]
     )
 
 
@@ -98,7 +359,7 @@ STATUS_MESSAGES = {
 }
 
 
-@mock.patch("util.run")
+@mock.patch("k8s_api.get_client")
 @pytest.mark.parametrize(
     "message, expect_status",
     [
@@ -107,33 +368,73 @@ STATUS_MESSAGES = {
         ("INVALID_STATUS", MaintenanceStatus("waiting for node")),
     ],
 )
-def test_microk8s_get_unit_status(run: mock.MagicMock, message: str, expect_status):
-    run.return_value.stdout = STATUS_MESSAGES[message].encode()
+def test_microk8s_get_unit_status(get_client: mock.MagicMock, message: str, expect_status):
+    try:
+        conditions = [{"type": "MemoryPressure"}, json.loads(STATUS_MESSAGES[message])]
+    except json.JSONDecodeError:
+        conditions = []
+    get_client.return_value.get.return_value = {"status": {"conditions": conditions}}
 
     status = microk8s.get_unit_status("node-1")
-    run.assert_called_once_with(
-        [
-            "/snap/microk8s/current/kubectl",
-            "--kubeconfig=/var/snap/microk8s/current/credentials/kubelet.config",
-            "get",
-            "node",
-            "node-1",
-            "-o",
-            "jsonpath={.status.conditions[?(@.type=='Ready')]}",
-        ],
-        capture_output=True,
+    get_client.assert_called_once_with(
+        Path("/var/snap/microk8s/current/credentials/kubelet.config")
     )
+    get_client.return_value.get.assert_called_once_with("v1", "Node", "node-1")
     assert status == expect_status
 
 
+@mock.patch("k8s_api.get_client")
+def test_microk8s_get_unit_status_api_error(get_client: mock.MagicMock):
+    get_client.return_value.get.side_effect = k8s_api.ApiError(404, "Not Found")
+    assert microk8s.get_unit_status("node-1") == MaintenanceStatus("waiting for node")
+
+    get_client.return_value.get.side_effect = ConnectionRefusedError()
+    assert microk8s.get_unit_status("node-1") == MaintenanceStatus("waiting for node")
+
+    get_client.side_effect = ValueError("invalid kubeconfig")
+    assert microk8s.get_unit_status("node-1") == MaintenanceStatus("waiting for node")
+
+    get_client.side_effect = None
+    get_client.return_value.get.side_effect = None
+    get_client.return_value.get.return_value = {"status": {"conditions": ["invalid"]}}
+    assert microk8s.get_unit_status("node-1") == MaintenanceStatus("waiting for node")
+
+
+@mock.patch("k8s_api.get_client")
+def test_microk8s_get_node_statuses(get_client: mock.MagicMock):
+    get_client.return_value.list.return_value = [
+        {
+            "metadata": {"name": "node-1"},
+            "status": {"conditions": [json.loads(STATUS_MESSAGES["READY_STATUS"])]},
+        },
+        {
+            "metadata": {"name": "node-2"},
+            "status": {"conditions": [json.loads(STATUS_MESSAGES["NOT_READY_STATUS"])]},
+        },
+        {"metadata": {"name": "node-3"}, "status": {}},
+    ]
+
+    assert microk8s.get_node_statuses() == {
+        "node-1": {"ready": True, "reason": "KubeletReady"},
+        "node-2": {"ready": False, "reason": "KubeletNotReady"},
+        "node-3": {"ready": False, "reason": ""},
+    }
+    get_client.assert_called_once_with(Path("/var/snap/microk8s/current/credentials/client.config"))
+    get_client.return_value.list.assert_called_once_with("v1", "Node")
+
+    get_client.return_value.list.return_value = [{"status": {}}]
+    with pytest.raises(ValueError):
+        microk8s.get_node_statuses()
+
+
 @mock.patch("microk8s.snap_data_dir", autospec=True)
 @mock.patch("util.ensure_file", autospec=True)
 @mock.patch("util.ensure_block", autospec=True)
-@mock.patch("util.ensure_call", autospec=True)
+@mock.patch("microk8s.schedule_restart", autospec=True)
 @pytest.mark.parametrize("changed", (True, False))
 @pytest.mark.parametrize("containerd_env_contents", ("", "ulimit -n 1000"))
 def test_microk8s_set_containerd_proxy_options(
-    ensure_call: mock.MagicMock,
+    schedule_restart: mock.MagicMock,
     ensure_block: mock.MagicMock,
     ensure_file: mock.MagicMock,
     snap_data_dir: mock.MagicMock,
@@ -152,7 +453,7 @@ def test_microk8s_set_containerd_proxy_options(
     microk8s.set_containerd_proxy_options("", "", "")
     ensure_file.assert_not_called()
     ensure_block.assert_not_called()
-    ensure_call.assert_not_called()
+    schedule_restart.assert_not_called()
 
     # change config and restart service if something changed
     microk8s.set_containerd_proxy_options("fake1", "fake2", "no-proxy")
@@ -165,9 +466,9 @@ def test_microk8s_set_containerd_proxy_options(
         tmp_path / "args" / "containerd-env", ensure_block.return_value, 0o600, 0, 0
     )
     if changed:
-        ensure_call.assert_called_once_with(["snap", "restart", "microk8s.daemon-containerd"])
+        schedule_restart.assert_called_once_with("microk8s.daemon-containerd")
     else:
-        ensure_call.assert_not_called()
+        schedule_restart.assert_not_called()
 
 
 @mock.patch("microk8s.snap_data_dir")
@@ -261,62 +562,253 @@ def test_microk8s_apply_launch_configuration(ensure_call: mock.MagicMock):
     )
 
 
+@mock.patch("microk8s._pending_launch_configuration", {})
+@mock.patch("microk8s.apply_launch_configuration")
+def test_microk8s_apply_pending_launch_configuration(apply_launch_configuration: mock.MagicMock):
+    # fragments are merged and applied once
+    microk8s.schedule_launch_configuration({"extraKubeletArgs": {"--cluster-dns": "10.0.0.10"}})
+    microk8s.schedule_launch_configuration({"extraKubeletArgs": {"--cluster-domain": "local"}})
+    microk8s.schedule_launch_configuration(
+        {"extraKubeAPIServerArgs": {"--authorization-mode": "AlwaysAllow"}}
+    )
+
+    applied = microk8s.apply_pending_launch_configuration({})
+    assert applied == {
+        "extraKubeletArgs": {"--cluster-dns": "10.0.0.10", "--cluster-domain": "local"},
+        "extraKubeAPIServerArgs": {"--authorization-mode": "AlwaysAllow"},
+    }
+    apply_launch_configuration.assert_called_once_with(applied)
+
+    # nothing scheduled, nothing applied
+    apply_launch_configuration.reset_mock()
+    assert microk8s.apply_pending_launch_configuration(applied) == applied
+    apply_launch_configuration.assert_not_called()
+
+    # fragments that do not change the applied document are skipped
+    microk8s.schedule_launch_configuration({"extraKubeletArgs": {"--cluster-domain": "local"}})
+    assert microk8s.apply_pending_launch_configuration(applied) == applied
+    apply_launch_configuration.assert_not_called()
+
+    # changed fragments are merged with the last applied document
+    microk8s.schedule_launch_configuration(
+        {"extraKubeAPIServerArgs": {"--authorization-mode": "Node,RBAC"}}
+    )
+    new_applied = microk8s.apply_pending_launch_configuration(applied)
+    assert new_applied == {
+        "extraKubeletArgs": {"--cluster-dns": "10.0.0.10", "--cluster-domain": "local"},
+        "extraKubeAPIServerArgs": {"--authorization-mode": "Node,RBAC"},
+    }
+    apply_launch_configuration.assert_called_once_with(new_applied)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("", {}),
+        ("dns", {"dns": "dns"}),
+        (
+            " dns,ingress  registry:size=40Gi\n",
+            {"dns": "dns", "ingress": "ingress", "registry": "registry:size=40Gi"},
+        ),
+        ("core/dns", {"core/dns": "core/dns"}),
+    ],
+)
+def test_microk8s_parse_addons(value: str, expected: dict):
+    assert microk8s.parse_addons(value) == expected
+
+
+@pytest.mark.parametrize("value", ["DNS", "dns;ingress", ":10.0.0.1", "a/b/c"])
+def test_microk8s_parse_addons_invalid(value: str):
+    with pytest.raises(ValueError):
+        microk8s.parse_addons(value)
+
+
 @pytest.mark.parametrize(
-    "status, enable, expect_calls",
+    "enable, disable, expect_calls, enabled",
     [
-        ("enabled", True, []),
-        ("disabled", False, []),
-        ("enabled", False, [mock.call(["microk8s", "disable", "hostpath-storage"], input=b"n")]),
-        ("disabled", True, [mock.call(["microk8s", "enable", "hostpath-storage"])]),
+        ([], [], [], []),
+        (["dns", "core/hostpath-storage"], ["ingress"], [], []),
+        (
+            ["dns", "ingress", "registry:size=40Gi"],
+            [],
+            [mock.call(["microk8s", "enable", "ingress", "registry:size=40Gi"])],
+            ["ingress", "registry"],
+        ),
+        (
+            [],
+            ["dns", "hostpath-storage", "metallb"],
+            [mock.call(["microk8s", "disable", "dns", "hostpath-storage"], input=b"n")],
+            [],
+        ),
+        (
+            ["metallb:10.0.0.100-10.0.0.120"],
+            ["dns"],
+            [
+                mock.call(["microk8s", "disable", "dns"], input=b"n"),
+                mock.call(["microk8s", "enable", "metallb:10.0.0.100-10.0.0.120"]),
+            ],
+            ["metallb"],
+        ),
     ],
 )
 @mock.patch("util.ensure_call")
-def test_microk8s_configure_hostpath_storage(
-    ensure_call: mock.MagicMock, status: str, enable: bool, expect_calls: list
+def test_microk8s_configure_addons(
+    ensure_call: mock.MagicMock, enable: list, disable: list, expect_calls: list, enabled: list
 ):
-    ensure_call.return_value.stdout = status.encode()
-
-    microk8s.configure_hostpath_storage(enable)
+    ensure_call.return_value.stdout = b"""
+microk8s:
+  running: True
+addons:
+  - name: dns
+    status: enabled
+  - name: hostpath-storage
+    status: enabled
+  - name: ingress
+    status: disabled
+  - name: metallb
+    status: disabled
+"""
+
+    assert microk8s.configure_addons(enable, disable) == enabled
 
     assert ensure_call.mock_calls == [
-        mock.call(["microk8s", "status", "-a", "hostpath-storage"], capture_output=True),
+        mock.call(["microk8s", "status", "--format", "yaml"], capture_output=True),
         *expect_calls,
     ]
 
 
 @pytest.mark.parametrize("enable,method", [(True, "Node,RBAC"), (False, "AlwaysAllow")])
-@mock.patch("microk8s.apply_launch_configuration")
+@mock.patch("microk8s.schedule_launch_configuration")
 def test_microk8s_configure_rbac(
-    apply_launch_configuration: mock.MagicMock, enable: bool, method: str
+    schedule_launch_configuration: mock.MagicMock, enable: bool, method: str
 ):
     microk8s.configure_rbac(enable)
-    apply_launch_configuration.assert_called_once_with(
+    schedule_launch_configuration.assert_called_once_with(
         {"extraKubeAPIServerArgs": {"--authorization-mode": method}}
     )
 
 
+@mock.patch("microk8s._default_ip", autospec=True)
+@mock.patch("microk8s.snap_data_dir", autospec=True)
+@mock.patch("microk8s.local_kubeconfig", autospec=True)
 @mock.patch("util.ensure_call", autospec=True)
 @mock.patch("util.ensure_file", autospec=True)
-def test_microk8s_write_local_kubeconfig(ensure_file: mock.MagicMock, ensure_call: mock.MagicMock):
-    microk8s.write_local_kubeconfig()
+def test_microk8s_write_local_kubeconfig(
+    ensure_file: mock.MagicMock,
+    ensure_call: mock.MagicMock,
+    local_kubeconfig: mock.MagicMock,
+    snap_data_dir: mock.MagicMock,
+    default_ip: mock.MagicMock,
+    tmp_path: Path,
+):
+    snap_data_dir.return_value = tmp_path
+    local_kubeconfig.return_value = tmp_path / "kubeconfig"
+    default_ip.return_value = "10.0.0.10"
+    (tmp_path / "certs").mkdir()
+    (tmp_path / "certs" / "ca.crt").write_text("ca")
+
+    fingerprint = microk8s.write_local_kubeconfig()
 
     ensure_call.assert_called_once_with(["microk8s", "config"], capture_output=True)
     ensure_file.assert_called_once_with(
-        Path("/root/.kube/config"), ensure_call.return_value.stdout.decode.return_value, 0o600, 0, 0
+        tmp_path / "kubeconfig", ensure_call.return_value.stdout.decode.return_value, 0o600, 0, 0
     )
 
+    # kubeconfig not written yet, export again
+    ensure_call.reset_mock()
+    assert microk8s.write_local_kubeconfig(fingerprint) == fingerprint
+    ensure_call.assert_called_once()
 
-@mock.patch("microk8s.apply_launch_configuration")
-def test_microk8s_configure_dns(apply_launch_configuration: mock.MagicMock):
+    # kubeconfig up to date, skip export
+    ensure_call.reset_mock()
+    (tmp_path / "kubeconfig").write_text("kubeconfig")
+    assert microk8s.write_local_kubeconfig(fingerprint) == fingerprint
+    ensure_call.assert_not_called()
+
+    # certificates refreshed
+    (tmp_path / "certs" / "server.crt").write_text("new server cert")
+    new_fingerprint = microk8s.write_local_kubeconfig(fingerprint)
+    assert new_fingerprint != fingerprint
+    ensure_call.assert_called_once()
+
+    # address changed
+    ensure_call.reset_mock()
+    default_ip.return_value = "10.0.0.11"
+    assert microk8s.write_local_kubeconfig(new_fingerprint) != new_fingerprint
+    ensure_call.assert_called_once()
+
+
+@mock.patch("microk8s.schedule_launch_configuration")
+def test_microk8s_configure_dns(schedule_launch_configuration: mock.MagicMock):
     microk8s.configure_dns("fakeip", "fakedomain")
 
-    apply_launch_configuration.assert_called_once_with(
+    schedule_launch_configuration.assert_called_once_with(
         {"extraKubeletArgs": {"--cluster-dns": "fakeip", "--cluster-domain": "fakedomain"}}
     )
 
 
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("", {}),
+        ("{}", {}),
+        ('{"max-pods": 250}', {"--max-pods": "250"}),
+        (
+            "serialize-image-pulls: false\n--registry-qps: 20\nregistry-burst: 40",
+            {
+                "--serialize-image-pulls": "false",
+                "--registry-qps": "20",
+                "--registry-burst": "40",
+            },
+        ),
+        (
+            '{"image-gc-high-threshold": 90, "image-gc-low-threshold": 70}',
+            {"--image-gc-high-threshold": "90", "--image-gc-low-threshold": "70"},
+        ),
+    ],
+)
+def test_microk8s_parse_kubelet_args(value: str, expected: dict):
+    assert microk8s.parse_kubelet_args(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "not: valid: yaml",
+        "[max-pods]",
+        '{"cluster-dns": "10.0.0.1"}',
+        '{"max-pods": "many"}',
+        '{"max-pods": true}',
+        '{"max-pods": -1}',
+        '{"serialize-image-pulls": "false"}',
+        '{"image-gc-high-threshold": 101}',
+        '{"image-gc-low-threshold": 90}',
+    ],
+)
+def test_microk8s_parse_kubelet_args_invalid(value: str):
+    with pytest.raises(ValueError):
+        microk8s.parse_kubelet_args(value)
+
+
+@mock.patch("microk8s.schedule_launch_configuration")
+def test_microk8s_configure_kubelet_args(schedule_launch_configuration: mock.MagicMock):
+    microk8s.configure_kubelet_args(
+        {"--max-pods": "250"}, ["--cluster-dns", "--max-pods", "--registry-qps"]
+    )
+
+    # removed arguments are reset, unmanaged arguments are left alone
+    schedule_launch_configuration.assert_called_once_with(
+        {"extraKubeletArgs": {"--max-pods": "250", "--registry-qps": None}}
+    )
+
+
+@mock.patch("microk8s.snap_dir")
 @mock.patch("util.run")
-def test_microk8s_get_kubernetes_version(run: mock.MagicMock):
+def test_microk8s_get_kubernetes_version(
+    run: mock.MagicMock, snap_dir: mock.MagicMock, tmp_path: Path
+):
+    snap_dir.return_value = tmp_path
+
     # parse output
     run.return_value.stdout = b"microk8s 1.28.1 revision 4217\n"
     version = microk8s.get_kubernetes_version()
@@ -337,3 +829,21 @@ def test_microk8s_get_kubernetes_version(run: mock.MagicMock):
     run.side_effect = subprocess.CalledProcessError(returncode=1, cmd="microk8s version")
     version = microk8s.get_kubernetes_version()
     assert version is None
+
+    # read from snap metadata
+    run.reset_mock()
+    (tmp_path / "meta").mkdir()
+    (tmp_path / "meta" / "snap.yaml").write_text("name: microk8s\nversion: v1.28.3\n")
+    version = microk8s.get_kubernetes_version()
+    run.assert_not_called()
+    assert version == "1.28.3"
+
+
+@mock.patch("microk8s.snap_dir")
+def test_microk8s_get_snap_revision(snap_dir: mock.MagicMock, tmp_path: Path):
+    snap_dir.return_value = tmp_path / "current"
+    assert microk8s.get_snap_revision() is None
+
+    (tmp_path / "4217").mkdir()
+    (tmp_path / "current").symlink_to("4217")
+    assert microk8s.get_snap_revision() == "4217"
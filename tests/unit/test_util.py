@@ -7,36 +7,115 @@ from unittest import mock
 
 import pytest
 
+import microk8s
 import util
 
 
 @mock.patch("os.uname")
+@mock.patch("util._installed_packages")
 @mock.patch("util.run")
-def test_install_required_packages(run: mock.MagicMock, uname: mock.MagicMock):
+def test_install_required_packages(
+    run: mock.MagicMock, installed_packages: mock.MagicMock, uname: mock.MagicMock
+):
     uname.return_value.release = "fakerelease"
+    installed_packages.return_value = {"open-iscsi"}
     util.install_required_packages()
 
     assert run.mock_calls == [
         mock.call(["apt-get", "install", "--yes", "nfs-common"]),
-        mock.call(["apt-get", "install", "--yes", "open-iscsi"]),
         mock.call(["apt-get", "install", "--yes", "linux-modules-extra-fakerelease"]),
     ]
 
+    # only the modules package is missing
+    run.reset_mock()
+    installed_packages.return_value = {"nfs-common", "open-iscsi"}
+    util.install_required_packages()
+    run.assert_called_once_with(["apt-get", "install", "--yes", "linux-modules-extra-fakerelease"])
+
+    # all packages installed
+    run.reset_mock()
+    installed_packages.return_value = {
+        "nfs-common",
+        "open-iscsi",
+        "linux-modules-extra-fakerelease",
+    }
+    util.install_required_packages()
+    run.assert_not_called()
+
 
 @mock.patch("os.uname")
+@mock.patch("util._installed_packages")
 @mock.patch("util.run")
-def test_install_required_packages_exceptions(run: mock.MagicMock, uname: mock.MagicMock):
+def test_install_required_packages_exceptions(
+    run: mock.MagicMock, installed_packages: mock.MagicMock, uname: mock.MagicMock
+):
     uname.side_effect = OSError("fake exception")
+    installed_packages.return_value = set()
     run.side_effect = subprocess.CalledProcessError(1, "fake exception")
 
     util.install_required_packages()
 
     assert run.mock_calls == [
-        mock.call(["apt-get", "install", "--yes", "nfs-common"]),
-        mock.call(["apt-get", "install", "--yes", "open-iscsi"]),
+        mock.call(["apt-get", "install", "--yes", "nfs-common", "open-iscsi"]),
     ]
 
 
+@mock.patch("os.uname")
+@mock.patch("util._installed_packages")
+@mock.patch("util.run")
+def test_install_required_packages_modules_unavailable(
+    run: mock.MagicMock,
+    installed_packages: mock.MagicMock,
+    uname: mock.MagicMock,
+    caplog: pytest.LogCaptureFixture,
+):
+    uname.return_value.release = "fakerelease"
+    installed_packages.return_value = set()
+
+    def fake_run(cmd):
+        if "linux-modules-extra-fakerelease" in cmd:
+            raise subprocess.CalledProcessError(100, cmd)
+
+    run.side_effect = fake_run
+
+    # one missing modules package costs a single extra apt run
+    with caplog.at_level("INFO", logger="util"):
+        util.install_required_packages()
+    assert run.mock_calls == [
+        mock.call(["apt-get", "install", "--yes", "nfs-common", "open-iscsi"]),
+        mock.call(["apt-get", "install", "--yes", "linux-modules-extra-fakerelease"]),
+    ]
+
+    # installed and failed packages are reported separately
+    assert (
+        "Installed packages ['nfs-common', 'open-iscsi'], "
+        "failed to install ['linux-modules-extra-fakerelease']"
+    ) in caplog.text
+
+
+def test_installed_packages(tmp_path: Path):
+    (tmp_path / "status").write_text(
+        """Package: nfs-common
+Status: install ok installed
+Priority: optional
+Description: NFS support files
+ common to client and server
+
+Package: open-iscsi
+Status: deinstall ok config-files
+
+Package: linux-modules-extra-fakerelease
+Status: install ok installed
+"""
+    )
+
+    assert util._installed_packages(tmp_path / "status") == {
+        "nfs-common",
+        "linux-modules-extra-fakerelease",
+    }
+    assert util._installed_packages(tmp_path / "missing") == set()
+
+
 @mock.patch("os.chown")
 @mock.patch("os.chmod")
 def test_ensure_file(chmod: mock.MagicMock, chown: mock.MagicMock, tmp_path: Path):
@@ -119,6 +198,39 @@ def test_ensure_call(run: mock.MagicMock, sleep: mock.MagicMock):
     sleep.assert_called_once_with(2)
 
 
+@mock.patch("time.sleep")
+@mock.patch("util.run")
+def test_ensure_call_captures_output(run: mock.MagicMock, sleep: mock.MagicMock):
+    # output is captured to classify failures
+    policy = util.RetryPolicy(max_attempts=2, fatal_output=("fatal",))
+    util.ensure_call(["echo"], policy=policy)
+    run.assert_called_once_with(["echo"], capture_output=True)
+
+    run.reset_mock()
+    util.ensure_call(["echo"], policy=policy, stderr=subprocess.DEVNULL)
+    run.assert_called_once_with(["echo"], stderr=subprocess.DEVNULL)
+
+    # fatal failures are not retried
+    run.reset_mock()
+    run.side_effect = subprocess.CalledProcessError(1, "cmd", stderr=b"fatal error")
+    with pytest.raises(subprocess.CalledProcessError):
+        util.ensure_call(["echo"], policy=policy)
+    run.assert_called_once()
+    sleep.assert_not_called()
+
+
+@mock.patch.dict("util.RETRY_STATS", clear=True)
+@mock.patch("time.sleep")
+def test_ensure_func_wrapper(sleep: mock.MagicMock):
+    m = mock.MagicMock()
+    m.side_effect = [ValueError("some error"), "retval"]
+
+    assert util.ensure_func(m, 1, key="value", retry_on=ValueError, name="fake") == "retval"
+    assert m.mock_calls == [mock.call(1, key="value")] * 2
+    sleep.assert_called_once_with(2)
+    assert util.RETRY_STATS["fake"]["retries"] == 1
+
+
 @mock.patch("time.sleep")
 def test_ensure_func(sleep: mock.MagicMock):
     m = mock.MagicMock()
@@ -153,6 +265,132 @@ def test_ensure_func(sleep: mock.MagicMock):
     assert sleep.mock_calls == [mock.call(20)] * 2
 
 
+@pytest.mark.parametrize(
+    "policy, expected_delays",
+    [
+        (util.DEFAULT_RETRY_POLICY, [2, 2, 2, 2]),
+        (util.RetryPolicy(backoff=1), [1, 2, 4, 8]),
+        (util.RetryPolicy(backoff=1, max_backoff=5), [1, 2, 4, 5]),
+    ],
+)
+def test_retry_policy_delay(policy: util.RetryPolicy, expected_delays: list):
+    assert [policy.delay(attempt) for attempt in range(1, 5)] == expected_delays
+
+
+def test_retry_policy_jitter():
+    policy = util.RetryPolicy(backoff=10, max_backoff=10, jitter=0.5)
+    for _ in range(100):
+        assert 5 <= policy.delay(1) <= 15
+
+
+@pytest.mark.parametrize(
+    "policy, exc, expected",
+    [
+        (util.RetryPolicy(), ValueError(), True),
+        (util.RetryPolicy(), subprocess.CalledProcessError(1, "cmd"), True),
+        (util.RetryPolicy(retry_exit_codes=(1,)), subprocess.CalledProcessError(1, "cmd"), True),
+        (util.RetryPolicy(retry_exit_codes=(1,)), subprocess.CalledProcessError(2, "cmd"), False),
+        (
+            util.RetryPolicy(retry_output=("change in progress",)),
+            subprocess.CalledProcessError(
+                1, "cmd", stderr=b'snap has "refresh" change in progress'
+            ),
+            True,
+        ),
+        (
+            util.RetryPolicy(retry_output=("change in progress",)),
+            subprocess.CalledProcessError(1, "cmd", stderr=b"not found"),
+            False,
+        ),
+        (
+            util.RetryPolicy(retry_output=("change in progress",)),
+            subprocess.CalledProcessError(1, "cmd"),
+            True,
+        ),
+        (
+            util.RetryPolicy(fatal_output=("Invalid token",)),
+            subprocess.CalledProcessError(1, "cmd", output=b"Connection failed. Invalid token"),
+            False,
+        ),
+        (
+            util.RetryPolicy(fatal_output=("Invalid token",)),
+            subprocess.CalledProcessError(1, "cmd", output=b"", stderr=b"Connection failed."),
+            True,
+        ),
+        (
+            microk8s.SNAP_RETRY_POLICY,
+            subprocess.CalledProcessError(
+                1, "cmd", stderr=b'error: snap "microk8s" has "auto-refresh" change in progress'
+            ),
+            True,
+        ),
+        (
+            microk8s.SNAP_RETRY_POLICY,
+            subprocess.CalledProcessError(
+                1, "cmd", stderr=b'error: requested channel "1.99/stable" is not available'
+            ),
+            False,
+        ),
+        (
+            microk8s.JOIN_RETRY_POLICY,
+            subprocess.CalledProcessError(1, "cmd", output=b"Connection failed (503)"),
+            True,
+        ),
+        (
+            microk8s.JOIN_RETRY_POLICY,
+            subprocess.CalledProcessError(1, "cmd", output=b"Connection failed. Invalid token"),
+            False,
+        ),
+    ],
+)
+def test_retry_policy_is_retryable(policy: util.RetryPolicy, exc: Exception, expected: bool):
+    assert policy.is_retryable(exc) == expected
+
+
+@mock.patch.dict("util.RETRY_STATS", clear=True)
+@mock.patch("time.monotonic")
+@mock.patch("time.sleep")
+def test_ensure_func_policy(sleep: mock.MagicMock, monotonic: mock.MagicMock):
+    m = mock.MagicMock()
+    m.side_effect = ValueError("some error")
+
+    # deadline is reached
+    monotonic.side_effect = [0, 0, 1, 3, 7, 7]
+    policy = util.RetryPolicy(max_attempts=10, backoff=1, deadline=10)
+    with pytest.raises(ValueError):
+        util._ensure_func(m, [], {}, ValueError, policy=policy, name="fake")
+
+    assert m.call_count == 4
+    assert sleep.mock_calls == [mock.call(1), mock.call(2), mock.call(4)]
+    assert util.RETRY_STATS["fake"] == {"calls": 1, "retries": 3, "seconds": 7}
+
+    # non-retryable errors are raised immediately
+    m.reset_mock()
+    sleep.reset_mock()
+    monotonic.side_effect = None
+    monotonic.return_value = 0
+    m.side_effect = subprocess.CalledProcessError(2, "cmd")
+    policy = util.RetryPolicy(retry_exit_codes=(1,))
+    with pytest.raises(subprocess.CalledProcessError):
+        util._ensure_func(m, [], {}, subprocess.CalledProcessError, policy=policy, name="fake")
+
+    m.assert_called_once_with()
+    sleep.assert_not_called()
+    assert util.RETRY_STATS["fake"] == {"calls": 2, "retries": 3, "seconds": 7}
+
+
+@mock.patch.dict("util.RETRY_STATS", clear=True)
+def test_log_retry_stats(caplog: pytest.LogCaptureFixture):
+    util.RETRY_STATS["snap restart"] = {"calls": 2, "retries": 3, "seconds": 6.5}
+    util.RETRY_STATS["microk8s join"] = {"calls": 1, "retries": 0, "seconds": 1.0}
+
+    with caplog.at_level("INFO"):
+        util.log_retry_stats()
+
+    assert "snap restart: 2 calls, 3 retries, 6.50 seconds" in caplog.text
+    assert "microk8s join" not in caplog.text
+
+
 def test_charm_dir():
     assert (util.charm_dir() / "metadata.yaml").exists()
     assert (util.charm_dir() / "src" / "charm.py").exists()